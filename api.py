@@ -1,53 +1,92 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 import fastapi
-from fastapi import BackgroundTasks
+from fastapi import HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
+from claim_processing.jobs import ClaimJobQueue
 from claim_processing.utils.decision_engines import SimpleLLMDecisionEngine
-from claim_processing.process import list_available_decision_ids, process_claim, upload_claim, upload_decision
-from claim_processing.pydantic_models import ClaimRequest, ClaimDecision, UploadResponse
+from claim_processing.process import list_available_decision_ids, upload_claim
+from claim_processing.pydantic_models import ClaimJob, ClaimRequest, ClaimDecision, QueueStatus, UploadResponse
+from claim_processing.utils.events import format_server_sent_event
 from claim_processing.utils.load import load_claim_decision
+from claim_processing.utils.metrics import get_metrics_registry
 
-from typing import List
-
-app = fastapi.FastAPI()
+from typing import List, Literal, Optional
 
 decision_engine = SimpleLLMDecisionEngine()
+job_queue = ClaimJobQueue(decision_engine=decision_engine)
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 @app.get("/health")
 def health():
     return {"message": "OK"}
 
 @app.post("/claims")
-def claims(claim_request: ClaimRequest, background_tasks: BackgroundTasks) -> UploadResponse:
-    upload_response = upload_claim(
-        claim_id=claim_request.claim_id, 
-        description_text=claim_request.description_text, 
-        supporting_documents=claim_request.supporting_documents,
-    )
-    
-    # Add processing and upload to background tasks
-    background_tasks.add_task(
-        process_and_upload_claim,
-        claim_id=claim_request.claim_id,
-        decision_engine=decision_engine
-    )
-    
-    return upload_response
+async def claims(claim_request: ClaimRequest) -> UploadResponse:
+    # Reject before storing the claim when the queue can not take it, and keep its
+    # slot while storing so a stored claim is always queued
+    with job_queue.reserve_slot():
+        upload_response = await asyncio.to_thread(
+            upload_claim,
+            claim_id=claim_request.claim_id,
+            description_text=claim_request.description_text,
+            supporting_documents=claim_request.supporting_documents,
+        )
+
+        # Add processing and upload to the job queue
+        job = await job_queue.submit(claim_request.claim_id, reserved=True)
+    upload_response.job_id = job.job_id
 
-def process_and_upload_claim(claim_id: int, decision_engine: SimpleLLMDecisionEngine):
-    """Background task to process claim and upload decision"""
-    claim_decision = process_claim(claim_id=claim_id, decision_engine=decision_engine)
-    upload_decision(claim_decision=claim_decision, claim_id=claim_id)
+    return upload_response
 
 @app.post("/process_claim")
-def post_process_claim(claim_id: int) -> ClaimDecision:
-    claim_decision = process_claim(claim_id=claim_id, decision_engine=decision_engine)
-    upload_decision(claim_decision=claim_decision, claim_id=claim_id)
-    return claim_decision
+async def post_process_claim(claim_id: int) -> ClaimDecision:
+    job = await job_queue.submit(claim_id)
+    job = await job_queue.wait(job.job_id)
+    if job.state == "failed":
+        raise HTTPException(status_code=500, detail=f"Claim processing failed: {job.error}")
+    return job.decision
 
 @app.get("/claims/{claim_id}")
 def get_claim_decision(claim_id: int) -> ClaimDecision:
     return load_claim_decision(claim_id)
 
+@app.get("/claims/{claim_id}/events")
+async def get_claim_events(claim_id: int) -> StreamingResponse:
+    # Server-sent events of the claim job, from queued to the final decision
+    events = await job_queue.subscribe_events(claim_id)
+
+    async def stream():
+        async for claim_event in job_queue.stream_events(claim_id, events):
+            yield format_server_sent_event(claim_event)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 @app.get("/claims")
-def get_claims() -> List[int]:
-    return list_available_decision_ids()
+def get_claims(
+    decision: Optional[Literal["APPROVE", "DENY", "UNCERTAIN"]] = None,
+    after_claim_id: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+) -> List[int]:
+    return list_available_decision_ids(decision=decision, after_claim_id=after_claim_id, limit=limit)
+
+@app.get("/jobs")
+def get_queue_status() -> QueueStatus:
+    return job_queue.status()
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> ClaimJob:
+    return job_queue.get_job(job_id)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> str:
+    return get_metrics_registry().render_prometheus()
@@ -0,0 +1,468 @@
+import argparse
+import asyncio
+import base64
+import importlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw
+
+from claim_processing.constants import (
+    BENCHMARK_API_CONCURRENCY,
+    BENCHMARK_BASELINE_DIRECTORY,
+    BENCHMARK_MODEL_JITTER_SECONDS,
+    BENCHMARK_MODEL_LATENCY_SECONDS,
+    BENCHMARK_REGRESSION_TOLERANCE,
+    BENCHMARK_SCENARIOS,
+    CLAIM_DIRECTORY,
+    MODEL_RATE_LIMITS,
+    POLICY_DIRECTORY,
+)
+from claim_processing.process import process_and_upload_all_claims
+from claim_processing.pydantic_models import BenchmarkResult, ClaimTrace
+from claim_processing.utils.decision_engines import SimpleLLMDecisionEngine
+from claim_processing.utils.fake_model import (
+    AsyncFakeModelTransport,
+    FakeModelTransport,
+)
+from claim_processing.utils.image_utils import get_preprocessing_pool
+from claim_processing.utils.metrics import get_metrics_registry
+from claim_processing.utils.openai_utils import set_model_api_transports
+from claim_processing.utils.rate_limit import get_model_call_scheduler
+
+logger = logging.getLogger()
+
+WORDS = (
+    "vehicle collision damage repair invoice hospital treatment flight delay "
+    "baggage lost stolen receipt police report policy holder coverage claim "
+    "amount date location witness insurer medical bill cancellation refund"
+).split()
+
+
+def generate_text(n_words: int, rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=n_words)
+    # Break the text into sentences of 12 words
+    return " ".join(
+        " ".join(words[start : start + 12]).capitalize() + "."
+        for start in range(0, n_words, 12)
+    )
+
+
+def generate_document_image(size: Tuple[int, int], rng: random.Random) -> bytes:
+    """Render a scanned-document-like PNG: lines of text on an off-white page."""
+    image = Image.new("RGB", size, (250, 248, 240))
+    draw = ImageDraw.Draw(image)
+    line_height = max(12, size[1] // 60)
+    for y in range(line_height, size[1] - line_height, line_height):
+        draw.text((line_height, y), generate_text(10, rng), fill=(20, 20, 20))
+    image_buffer = io.BytesIO()
+    image.save(image_buffer, format="PNG")
+    return image_buffer.getvalue()
+
+
+def generate_claim_documents(
+    scenario_config: Dict, rng: random.Random
+) -> Tuple[str, Dict[str, bytes]]:
+    """Generate the description and supporting documents (file name -> bytes) of a claim."""
+    description = generate_text(scenario_config["description_words"], rng)
+    documents = {}
+    for i in range(scenario_config["n_text_documents"]):
+        documents[f"note_{i}.md"] = generate_text(
+            scenario_config["text_document_words"], rng
+        ).encode("utf-8")
+    for i in range(scenario_config["n_images"]):
+        documents[f"scan_{i}.png"] = generate_document_image(
+            tuple(scenario_config["image_size"]), rng
+        )
+    return description, documents
+
+
+def write_synthetic_policy(scenario_config: Dict, seed: int = 0):
+    os.makedirs(POLICY_DIRECTORY, exist_ok=True)
+    with open(os.path.join(POLICY_DIRECTORY, "policy.md"), "w") as policy_file:
+        policy_file.write(
+            generate_text(scenario_config["policy_words"], random.Random(seed))
+        )
+
+
+def write_synthetic_claims(scenario_config: Dict, seed: int = 0) -> List[int]:
+    """Write synthetic claims to the claim directory, as `claim {id}` folders."""
+    claim_ids = list(range(1, scenario_config["n_claims"] + 1))
+    for claim_id in claim_ids:
+        description, documents = generate_claim_documents(
+            scenario_config, random.Random(seed + claim_id)
+        )
+        claim_directory = os.path.join(CLAIM_DIRECTORY, f"claim {claim_id}")
+        os.makedirs(claim_directory, exist_ok=True)
+        with open(os.path.join(claim_directory, "description.txt"), "w") as file:
+            file.write(description)
+        for file_name, document_bytes in documents.items():
+            with open(os.path.join(claim_directory, file_name), "wb") as file:
+                file.write(document_bytes)
+    return claim_ids
+
+
+def build_claim_requests(scenario_config: Dict, seed: int = 0) -> List[Dict]:
+    """Build synthetic `POST /claims` payloads."""
+    claim_requests = []
+    for claim_id in range(1, scenario_config["n_claims"] + 1):
+        description, documents = generate_claim_documents(
+            scenario_config, random.Random(seed + claim_id)
+        )
+        claim_requests.append(
+            {
+                "claim_id": claim_id,
+                "description_text": description,
+                "supporting_documents": [
+                    {
+                        "file_name": file_name,
+                        "document_bytes": base64.b64encode(document_bytes).decode(
+                            "utf-8"
+                        ),
+                    }
+                    for file_name, document_bytes in documents.items()
+                ],
+            }
+        )
+    return claim_requests
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def summarize_run(
+    scenario: str,
+    target: str,
+    latencies: List[float],
+    n_failed: int,
+    elapsed_seconds: float,
+    traces: List[ClaimTrace],
+) -> BenchmarkResult:
+    stage_seconds = defaultdict(float)
+    for trace in traces:
+        for span in trace.spans:
+            stage_seconds[span.stage] += span.seconds
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+    n_claims = len(latencies)
+    return BenchmarkResult(
+        scenario=scenario,
+        target=target,
+        n_claims=n_claims,
+        n_failed=n_failed,
+        elapsed_seconds=elapsed_seconds,
+        claims_per_second=n_claims / elapsed_seconds if elapsed_seconds else 0.0,
+        latency_p50_seconds=p50,
+        latency_p95_seconds=p95,
+        latency_p99_seconds=p99,
+        peak_rss_mb=get_peak_rss_mb(),
+        stage_seconds={
+            stage: seconds / max(len(traces), 1)
+            for stage, seconds in sorted(stage_seconds.items())
+        },
+    )
+
+
+def run_batch(scenario: str, scenario_config: Dict, seed: int) -> BenchmarkResult:
+    write_synthetic_claims(scenario_config, seed)
+    results_dir = os.path.join("results", "benchmark")
+    summary = process_and_upload_all_claims(
+        decision_engine=SimpleLLMDecisionEngine(use_cache=False),
+        results_dir=results_dir,
+        check_authenticity=True,
+        use_ocr=True,
+    )
+    with open(os.path.join(results_dir, "traces.jsonl"), "r") as traces_file:
+        traces = [ClaimTrace.model_validate_json(line) for line in traces_file]
+    return summarize_run(
+        scenario,
+        "batch",
+        latencies=[trace.seconds for trace in traces],
+        n_failed=summary.n_failed,
+        elapsed_seconds=summary.elapsed_seconds,
+        traces=traces,
+    )
+
+
+async def drive_api(
+    app, claim_requests: List[Dict], concurrency: int, poll_interval: float = 0.02
+) -> Tuple[List[float], int, float]:
+    """Submit claims to the API and wait for their jobs, returns latencies, failures and wall time."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with (
+        app.router.lifespan_context(app),
+        httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://benchmark"
+        ) as client,
+    ):
+
+        async def submit_and_wait(claim_request: Dict) -> Tuple[float, bool]:
+            async with semaphore:
+                start_time = time.time()
+                response = await client.post("/claims", json=claim_request)
+                if response.status_code != 200:
+                    return time.time() - start_time, False
+                job_id = response.json()["job_id"]
+                while True:
+                    job = (await client.get(f"/jobs/{job_id}")).json()
+                    if job["state"] in ("done", "failed"):
+                        return job["finished_at"] - start_time, job["state"] == "done"
+                    await asyncio.sleep(poll_interval)
+
+        start_time = time.perf_counter()
+        outcomes = await asyncio.gather(
+            *[submit_and_wait(claim_request) for claim_request in claim_requests]
+        )
+        elapsed_seconds = time.perf_counter() - start_time
+
+    latencies = [latency for latency, _ in outcomes]
+    n_failed = sum(not succeeded for _, succeeded in outcomes)
+    return latencies, n_failed, elapsed_seconds
+
+
+def run_api(
+    scenario: str, scenario_config: Dict, seed: int, app, concurrency: int
+) -> BenchmarkResult:
+    claim_requests = build_claim_requests(scenario_config, seed)
+    latencies, n_failed, elapsed_seconds = asyncio.run(
+        drive_api(app, claim_requests, concurrency)
+    )
+    return summarize_run(
+        scenario,
+        "api",
+        latencies=latencies,
+        n_failed=n_failed,
+        elapsed_seconds=elapsed_seconds,
+        traces=get_metrics_registry().recent_traces(),
+    )
+
+
+def run_target(
+    target: str,
+    scenario: str,
+    directory: str,
+    model_latency_seconds: float,
+    model_jitter_seconds: float,
+    app_path: str,
+    api_concurrency: int,
+    seed: int,
+) -> BenchmarkResult:
+    """Run one benchmark target, in its own process and working directory."""
+    logging.getLogger().setLevel(logging.WARNING)
+    # The app lives in the repository root, keep it importable after leaving it
+    sys.path.insert(0, os.getcwd())
+    # All relative data, results and cache paths now resolve inside the scratch directory
+    os.chdir(directory)
+    scenario_config = BENCHMARK_SCENARIOS[scenario]
+    write_synthetic_policy(scenario_config, seed)
+
+    transport = FakeModelTransport(
+        model_latency_seconds, model_jitter_seconds, seed=seed
+    )
+    async_transport = AsyncFakeModelTransport(
+        model_latency_seconds, model_jitter_seconds, seed=seed
+    )
+    set_model_api_transports(transport, async_transport)
+    # Provider rate limits would dominate the measurement, only our own overhead is of interest
+    get_model_call_scheduler().rate_limits = {
+        model: {"requests_per_minute": 10**9, "tokens_per_minute": 10**12}
+        for model in MODEL_RATE_LIMITS
+    }
+
+    try:
+        if target == "batch":
+            result = run_batch(scenario, scenario_config, seed)
+        elif target == "api":
+            # Imported once the synthetic policy exists, the app loads it on import
+            module_name, app_name = app_path.split(":")
+            app = getattr(importlib.import_module(module_name), app_name)
+            result = run_api(scenario, scenario_config, seed, app, api_concurrency)
+        else:
+            raise ValueError(f"Unsupported benchmark target: {target}")
+    finally:
+        # A worker process joins its children before exit handlers run, so the
+        # image pool has to be stopped here or the worker never exits
+        get_preprocessing_pool().shutdown()
+    result.n_model_requests = transport.n_requests + async_transport.n_requests
+    return result
+
+
+def run_benchmark(
+    scenario: str,
+    targets: List[str],
+    model_latency_seconds: float = BENCHMARK_MODEL_LATENCY_SECONDS,
+    model_jitter_seconds: float = BENCHMARK_MODEL_JITTER_SECONDS,
+    app_path: str = "api:app",
+    api_concurrency: int = BENCHMARK_API_CONCURRENCY,
+    seed: int = 0,
+) -> List[BenchmarkResult]:
+    """Benchmark the pipeline on synthetic claims against a local fake model backend.
+
+    Every target runs in a fresh process, so peak RSS and the shared clients,
+    stores and caches are not carried over between targets.
+    """
+    results = []
+    for target in targets:
+        logger.info(f"Benchmarking {target} on scenario {scenario}")
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor,
+        ):
+            results.append(
+                executor.submit(
+                    run_target,
+                    target,
+                    scenario,
+                    directory,
+                    model_latency_seconds,
+                    model_jitter_seconds,
+                    app_path,
+                    api_concurrency,
+                    seed,
+                ).result()
+            )
+    return results
+
+
+def get_baseline_path(scenario: str) -> str:
+    return os.path.join(BENCHMARK_BASELINE_DIRECTORY, f"{scenario}.json")
+
+
+def save_baseline(scenario: str, results: List[BenchmarkResult]):
+    os.makedirs(BENCHMARK_BASELINE_DIRECTORY, exist_ok=True)
+    with open(get_baseline_path(scenario), "w") as baseline_file:
+        json.dump([result.model_dump() for result in results], baseline_file, indent=2)
+
+
+def load_baseline(scenario: str) -> Dict[str, BenchmarkResult]:
+    baseline_path = get_baseline_path(scenario)
+    if not os.path.exists(baseline_path):
+        return {}
+    with open(baseline_path, "r") as baseline_file:
+        return {
+            result["target"]: BenchmarkResult.model_validate(result)
+            for result in json.load(baseline_file)
+        }
+
+
+def find_regressions(
+    result: BenchmarkResult,
+    baseline: BenchmarkResult,
+    tolerance: float = BENCHMARK_REGRESSION_TOLERANCE,
+) -> List[str]:
+    regressions = []
+    if result.claims_per_second < baseline.claims_per_second * (1 - tolerance):
+        regressions.append(
+            f"claims/sec {result.claims_per_second:.2f} < baseline {baseline.claims_per_second:.2f}"
+        )
+    for percentile in ("p50", "p95", "p99"):
+        value = getattr(result, f"latency_{percentile}_seconds")
+        baseline_value = getattr(baseline, f"latency_{percentile}_seconds")
+        if value > baseline_value * (1 + tolerance):
+            regressions.append(
+                f"{percentile} {value:.3f}s > baseline {baseline_value:.3f}s"
+            )
+    if result.peak_rss_mb > baseline.peak_rss_mb * (1 + tolerance):
+        regressions.append(
+            f"peak RSS {result.peak_rss_mb:.0f}MB > baseline {baseline.peak_rss_mb:.0f}MB"
+        )
+    return regressions
+
+
+def format_result(result: BenchmarkResult) -> str:
+    stages = ", ".join(
+        f"{stage} {seconds:.3f}s" for stage, seconds in result.stage_seconds.items()
+    )
+    return (
+        f"[{result.scenario}/{result.target}] {result.n_claims} claims "
+        f"({result.n_failed} failed, {result.n_model_requests} model requests) in {result.elapsed_seconds:.2f}s: "
+        f"{result.claims_per_second:.2f} claims/sec, "
+        f"p50 {result.latency_p50_seconds:.3f}s, p95 {result.latency_p95_seconds:.3f}s, "
+        f"p99 {result.latency_p99_seconds:.3f}s, peak RSS {result.peak_rss_mb:.0f}MB\n"
+        f"    per claim: {stages}"
+    )
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the claim pipeline against a local fake model backend"
+    )
+    parser.add_argument(
+        "--scenario", choices=sorted(BENCHMARK_SCENARIOS), default="small"
+    )
+    parser.add_argument("--target", choices=["batch", "api", "all"], default="all")
+    parser.add_argument(
+        "--model-latency", type=float, default=BENCHMARK_MODEL_LATENCY_SECONDS
+    )
+    parser.add_argument(
+        "--model-jitter", type=float, default=BENCHMARK_MODEL_JITTER_SECONDS
+    )
+    parser.add_argument(
+        "--api-concurrency", type=int, default=BENCHMARK_API_CONCURRENCY
+    )
+    parser.add_argument("--app", default="api:app", help="FastAPI app to benchmark")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store the results as baseline"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Compare against the baseline, exits with 1 on a regression or a missing baseline",
+    )
+    parsed_args = parser.parse_args(args)
+
+    targets = ["batch", "api"] if parsed_args.target == "all" else [parsed_args.target]
+    results = run_benchmark(
+        parsed_args.scenario,
+        targets,
+        model_latency_seconds=parsed_args.model_latency,
+        model_jitter_seconds=parsed_args.model_jitter,
+        app_path=parsed_args.app,
+        api_concurrency=parsed_args.api_concurrency,
+    )
+
+    exit_code = 0
+    baseline = load_baseline(parsed_args.scenario) if parsed_args.compare else {}
+    for result in results:
+        print(format_result(result))
+        if not parsed_args.compare:
+            continue
+        if result.target not in baseline:
+            # A missing baseline must not pass as a comparison without regressions
+            print(
+                f"    NO BASELINE for {result.target} in {get_baseline_path(parsed_args.scenario)}, "
+                "store one with --save-baseline"
+            )
+            exit_code = 1
+            continue
+        regressions = find_regressions(result, baseline[result.target])
+        for regression in regressions:
+            print(f"    REGRESSION: {regression}")
+        exit_code = 1 if regressions else exit_code
+
+    if parsed_args.save_baseline:
+        save_baseline(parsed_args.scenario, results)
+        print(f"Saved baseline to {get_baseline_path(parsed_args.scenario)}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
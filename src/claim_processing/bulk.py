@@ -0,0 +1,329 @@
+import argparse
+import json
+import logging
+import os
+import time
+from functools import partial
+from typing import Dict, List, Optional, Tuple, Union
+
+from claim_processing.constants import (
+    AUTHENTICITY_IMAGE_PROFILE,
+    AUTHENTICITY_MODEL_NAME,
+    AUTHENTICITY_THRESHOLD,
+    BATCH_API_BACKEND,
+    BATCH_DIRECTORY,
+    BATCH_POLL_INTERVAL_SECONDS,
+    CHECK_AUTHENTICITY,
+    OCR_IMAGE_PROFILE,
+    OCR_MODEL_NAME,
+    RESULTS_DIRECTORY,
+    USE_OCR,
+    USE_VISION_CACHE,
+)
+from claim_processing.process import list_available_claim_ids
+from claim_processing.prompts import (
+    AUTHENTICITY_PROMPT,
+    DOCUMENT_FORMAT_PROMPT,
+    OCR_PROMPT,
+)
+from claim_processing.pydantic_models import (
+    AuthenticityResponse,
+    BatchSummary,
+    Claim,
+    ClaimDecision,
+)
+from claim_processing.utils.batch_api import (
+    BatchBackend,
+    BatchJob,
+    get_batch_backend,
+    get_response_content,
+)
+from claim_processing.utils.decision_engines import BatchDecisionEngine
+from claim_processing.utils.decision_store import get_decision_store
+from claim_processing.utils.image_utils import (
+    build_vision_batch_request,
+    extract_text_from_doc,
+    get_vision_cache,
+    get_vision_cache_key,
+)
+from claim_processing.utils.load import load_claim
+from claim_processing.utils.metrics import record_cache_lookup
+
+logger = logging.getLogger()
+
+# Stage, claim id and document name of a vision response
+VisionKey = Tuple[str, int, str]
+
+
+def run_vision_batch(
+    claims: List[Claim],
+    backend: BatchBackend,
+    batch_directory: str,
+    check_authenticity: bool = CHECK_AUTHENTICITY,
+    use_ocr: bool = USE_OCR,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    authenticity_model_name: str = AUTHENTICITY_MODEL_NAME,
+    poll_interval_seconds: float = BATCH_POLL_INTERVAL_SECONDS,
+) -> Dict[VisionKey, str]:
+    """Authenticity and OCR responses of all image documents, from the vision cache or a single batch job."""
+    # Resolved up front, so a model the backend does not serve fails before the batch is written
+    batch_model_names = {
+        model_name: backend.get_model_name(model_name)
+        for model_name, enabled in (
+            (authenticity_model_name, check_authenticity),
+            (ocr_model_name, use_ocr),
+        )
+        if enabled
+    }
+    stages = []
+    if check_authenticity:
+        stages.append(
+            (
+                "authenticity",
+                AUTHENTICITY_PROMPT,
+                authenticity_model_name,
+                AuthenticityResponse,
+                AUTHENTICITY_IMAGE_PROFILE,
+            )
+        )
+    if use_ocr:
+        stages.append(("ocr", OCR_PROMPT, ocr_model_name, None, OCR_IMAGE_PROFILE))
+
+    responses = {}
+    requests = {}
+    for claim in claims:
+        for index, doc in enumerate(claim.supporting_documents):
+            if doc.type != "image supporting document":
+                continue
+            for stage, system_prompt, model_name, response_format, profile in stages:
+                key = (stage, claim.claim_id, doc.name)
+                cache_key = get_vision_cache_key(
+                    system_prompt, doc, model_name, response_format, profile
+                )
+                if USE_VISION_CACHE:
+                    cached_response = get_vision_cache().get(cache_key)
+                    record_cache_lookup("vision", hit=cached_response is not None)
+                    if cached_response is not None:
+                        responses[key] = cached_response
+                        continue
+                # The request hash in the id keeps results of changed documents from being reused on resume
+                custom_id = f"{stage}-{claim.claim_id}-{index}-{cache_key[:16]}"
+                requests[custom_id] = (
+                    key,
+                    cache_key,
+                    # Images are only encoded when their request is written to a batch
+                    partial(
+                        build_vision_batch_request,
+                        custom_id,
+                        system_prompt,
+                        doc,
+                        batch_model_names[model_name],
+                        response_format,
+                        profile,
+                    ),
+                )
+
+    results = BatchJob(
+        batch_directory, backend, poll_interval_seconds=poll_interval_seconds
+    ).run(
+        {
+            custom_id: build_request
+            for custom_id, (_, _, build_request) in requests.items()
+        }
+    )
+    for custom_id, result in results.items():
+        key, cache_key, _ = requests[custom_id]
+        responses[key] = get_response_content(result)
+        if USE_VISION_CACHE:
+            get_vision_cache().set(cache_key, responses[key])
+    return responses
+
+
+def prepare_claim(
+    claim: Claim,
+    vision_responses: Dict[VisionKey, str],
+    check_authenticity: bool = CHECK_AUTHENTICITY,
+    use_ocr: bool = USE_OCR,
+    authenticity_threshold: int = AUTHENTICITY_THRESHOLD,
+) -> Union[Claim, ClaimDecision]:
+    """The claim with parsed documents, or a DENY when a document is not authentic."""
+    image_docs = [
+        doc
+        for doc in claim.supporting_documents
+        if doc.type == "image supporting document"
+    ]
+    if check_authenticity:
+        for doc in image_docs:
+            authenticity_response = vision_responses.get(
+                ("authenticity", claim.claim_id, doc.name)
+            )
+            if authenticity_response is None:
+                logger.warning(
+                    f"No authenticity response for {doc.name} of claim id {claim.claim_id}. Skipping authentication step..."
+                )
+                continue
+            try:
+                authenticity_response = json.loads(authenticity_response)
+                authenticity_score = int(authenticity_response["authenticity_score"])
+            except Exception as e:
+                logger.warning(
+                    f"During authentication, faced exception {e} for claim id {claim.claim_id}. Skipping authentication step..."
+                )
+                continue
+            if authenticity_score < authenticity_threshold:
+                return ClaimDecision(
+                    reasoning="The claim was declined because supporting documents were deemed to be not authentic:\n"
+                    + authenticity_response["reasoning"],
+                    decision="DENY",
+                )
+
+    supporting_documents = []
+    for doc in claim.supporting_documents:
+        if doc.type == "image supporting document" and use_ocr:
+            # Raises for a failed OCR request, the claim is retried when the run is resumed
+            supporting_documents.append(
+                DOCUMENT_FORMAT_PROMPT.format(
+                    document_name=doc.name,
+                    document_content=vision_responses[
+                        ("ocr", claim.claim_id, doc.name)
+                    ],
+                )
+            )
+        else:
+            supporting_documents.append(extract_text_from_doc(doc, use_ocr=False))
+    return claim.model_copy(update={"supporting_documents": supporting_documents})
+
+
+def process_all_claims_with_batch_api(
+    decision_engine: Optional[BatchDecisionEngine] = None,
+    claim_ids: Optional[List[int]] = None,
+    overwrite: bool = True,
+    results_dir: str = RESULTS_DIRECTORY,
+    batch_directory: str = BATCH_DIRECTORY,
+    check_authenticity: bool = CHECK_AUTHENTICITY,
+    use_ocr: bool = USE_OCR,
+    authenticity_threshold: int = AUTHENTICITY_THRESHOLD,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    authenticity_model_name: str = AUTHENTICITY_MODEL_NAME,
+    poll_interval_seconds: float = BATCH_POLL_INTERVAL_SECONDS,
+) -> BatchSummary:
+    """Process claims through a batch backend, one batch job for the vision requests and one for the decisions.
+
+    Both jobs are checkpointed under `batch_directory`, running again with the
+    same directory resumes an interrupted run without repeating finished requests.
+    """
+    decision_engine = decision_engine or BatchDecisionEngine(
+        batch_directory=os.path.join(batch_directory, "decisions"),
+        poll_interval_seconds=poll_interval_seconds,
+    )
+    claim_ids = claim_ids if claim_ids is not None else list_available_claim_ids()
+    decision_store = get_decision_store(results_dir)
+    if not overwrite:
+        decided_claim_ids = set(decision_store.list_claim_ids())
+        claim_ids = [
+            claim_id for claim_id in claim_ids if claim_id not in decided_claim_ids
+        ]
+    n_claims = len(claim_ids)
+    logger.info(f"Processing {n_claims} claims through batch jobs in {batch_directory}")
+    start_time = time.perf_counter()
+
+    claims = []
+    failed_claim_ids = []
+    for claim_id in claim_ids:
+        try:
+            claims.append(load_claim(claim_id))
+        except Exception as e:
+            logger.warning(
+                f"Faced exception {e} when loading claim id {claim_id}. Skipping..."
+            )
+            failed_claim_ids.append(claim_id)
+    vision_responses = run_vision_batch(
+        claims,
+        decision_engine.backend,
+        os.path.join(batch_directory, "vision"),
+        check_authenticity=check_authenticity,
+        use_ocr=use_ocr,
+        ocr_model_name=ocr_model_name,
+        authenticity_model_name=authenticity_model_name,
+        poll_interval_seconds=poll_interval_seconds,
+    )
+
+    decisions = {}
+    claims_to_decide = []
+    for claim in claims:
+        try:
+            prepared_claim = prepare_claim(
+                claim,
+                vision_responses,
+                check_authenticity=check_authenticity,
+                use_ocr=use_ocr,
+                authenticity_threshold=authenticity_threshold,
+            )
+        except Exception as e:
+            logger.warning(
+                f"Faced exception {e} for claim id {claim.claim_id}. Skipping..."
+            )
+            failed_claim_ids.append(claim.claim_id)
+            continue
+        if isinstance(prepared_claim, ClaimDecision):
+            decisions[claim.claim_id] = prepared_claim
+        else:
+            claims_to_decide.append(prepared_claim)
+
+    decisions.update(decision_engine.decide_claims(claims_to_decide))
+    failed_claim_ids.extend(
+        claim.claim_id for claim in claims_to_decide if claim.claim_id not in decisions
+    )
+    decision_store.put_many(decisions, overwrite=overwrite)
+
+    elapsed_seconds = time.perf_counter() - start_time
+    summary = BatchSummary(
+        n_claims=n_claims,
+        n_succeeded=len(decisions),
+        n_failed=len(failed_claim_ids),
+        failed_claim_ids=sorted(failed_claim_ids),
+        elapsed_seconds=elapsed_seconds,
+        claims_per_second=n_claims / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+    )
+    logger.info(
+        f"Processed {summary.n_succeeded}/{n_claims} claims ({summary.n_failed} failed) "
+        f"in {elapsed_seconds:.1f}s, run again with the same batch directory to retry failed claims"
+    )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Process all claims through a batch API, resuming from the checkpoints in the batch directory"
+    )
+    parser.add_argument(
+        "--backend", choices=["openai", "local"], default=BATCH_API_BACKEND
+    )
+    parser.add_argument(
+        "--batch-dir",
+        default=BATCH_DIRECTORY,
+        help="Checkpoints of the run, use a new directory for every run",
+    )
+    parser.add_argument("--results-dir", default=RESULTS_DIRECTORY)
+    parser.add_argument(
+        "--poll-interval", type=float, default=BATCH_POLL_INTERVAL_SECONDS
+    )
+    parser.add_argument("--claim-ids", type=int, nargs="*")
+    args = parser.parse_args()
+
+    summary = process_all_claims_with_batch_api(
+        decision_engine=BatchDecisionEngine(
+            backend=get_batch_backend(args.backend),
+            batch_directory=os.path.join(args.batch_dir, "decisions"),
+            poll_interval_seconds=args.poll_interval,
+        ),
+        claim_ids=args.claim_ids,
+        results_dir=args.results_dir,
+        batch_directory=args.batch_dir,
+        poll_interval_seconds=args.poll_interval,
+    )
+    print(summary.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
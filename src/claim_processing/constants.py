@@ -8,14 +8,247 @@ MODEL_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL_API_URL = "https://openrouter.ai/api/v1"
 # MODEL_NAME = "google/gemini-2.5-flash"
 MODEL_NAME = "google/gemini-2.5-pro"
+# Fast first tier of the cascading decision engine, claims it is not sure about escalate to MODEL_NAME
+CASCADE_FAST_MODEL_NAME = "google/gemini-2.5-flash"
 AUTHENTICITY_MODEL_NAME = "openai/gpt-5-image-mini"
 OCR_MODEL_NAME = "qwen/qwen2.5-vl-72b-instruct"
+# Model of a single document analysis call that returns the text and authenticity of an
+# image at once, instead of separate OCR and authenticity calls. None makes the two calls
+FUSED_VISION_MODEL_NAME = None
+
+# Connection pool and timeouts (seconds) of the shared model API client
+MODEL_API_MAX_CONNECTIONS = 64
+MODEL_API_MAX_KEEPALIVE_CONNECTIONS = 32
+MODEL_API_KEEPALIVE_EXPIRY = 60.0
+MODEL_API_TIMEOUT = 300.0
+MODEL_API_CONNECT_TIMEOUT = 10.0
+
+# "live" sends model requests to the API, "record" also saves every request and response
+# to the recording, "replay" serves recorded responses without any network access
+MODEL_API_MODE = os.getenv("MODEL_API_MODE", "live")
+MODEL_API_RECORDING_PATH = os.getenv(
+    "MODEL_API_RECORDING_PATH", "recordings/model_api.jsonl"
+)
+# Replayed responses take their recorded latency times this scale, unless a fixed latency is set
+REPLAY_LATENCY_SCALE = float(os.getenv("REPLAY_LATENCY_SCALE", "1.0"))
+REPLAY_LATENCY_SECONDS = (
+    float(os.environ["REPLAY_LATENCY_SECONDS"])
+    if "REPLAY_LATENCY_SECONDS" in os.environ
+    else None
+)
+# Fraction of replayed requests that fail with one of the given status codes
+REPLAY_ERROR_RATE = float(os.getenv("REPLAY_ERROR_RATE", "0.0"))
+REPLAY_ERROR_STATUS_CODES = [429, 500, 503]
+REPLAY_SEED = 0
+
+# Retries, backoff (seconds) and rate limits of model calls
+MODEL_API_MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Consecutive server errors before a model is paused for the reset timeout
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30.0
+# Tokens reserved per image before the actual usage is known
+IMAGE_TOKEN_ESTIMATE = 1500
+DEFAULT_MODEL_RATE_LIMIT = {"requests_per_minute": 60, "tokens_per_minute": 1_000_000}
+MODEL_RATE_LIMITS = {
+    MODEL_NAME: {"requests_per_minute": 60, "tokens_per_minute": 1_000_000},
+    CASCADE_FAST_MODEL_NAME: {
+        "requests_per_minute": 120,
+        "tokens_per_minute": 2_000_000,
+    },
+    AUTHENTICITY_MODEL_NAME: {
+        "requests_per_minute": 120,
+        "tokens_per_minute": 2_000_000,
+    },
+    OCR_MODEL_NAME: {"requests_per_minute": 120, "tokens_per_minute": 2_000_000},
+}
+
+# Mark the system prompt and policy as a cacheable prefix for providers that need explicit hints
+USE_PROMPT_CACHE_CONTROL = True
+
+# Approximate prices in USD per million tokens, used to estimate the cost per claim
+MODEL_PRICES = {
+    "google/gemini-2.5-pro": {"input": 1.25, "cached_input": 0.31, "output": 10.0},
+    "google/gemini-2.5-flash": {"input": 0.30, "cached_input": 0.075, "output": 2.50},
+    "openai/gpt-5-image-mini": {"input": 2.50, "cached_input": 0.25, "output": 2.00},
+    "qwen/qwen2.5-vl-72b-instruct": {
+        "input": 0.25,
+        "cached_input": 0.25,
+        "output": 0.75,
+    },
+}
+TRACE_HISTORY_SIZE = 1000  # Number of recent claim traces kept in memory
+
+# A fast tier decision escalates when its confidence (1 to 5) is below the minimum, when it
+# is one of the escalated decisions, or when the claim contains one of the keywords
+CASCADE_MIN_CONFIDENCE = 4
+CASCADE_ESCALATE_DECISIONS = ["UNCERTAIN"]
+CASCADE_ESCALATION_KEYWORDS = []
+
+# Claim types of the routing decision engine: keywords that classify a claim, and the
+# heading keywords of the policy sections its specialist engine gets. A specialist can
+# use its own "model_name", claims without a matching type go to the full policy engine
+CLAIM_ROUTES = {
+    "medical": {
+        "keywords": ["hospital", "doctor", "medical", "illness", "injury", "surgery"],
+        "policy_sections": ["medical", "health", "emergency", "illness"],
+    },
+    "travel": {
+        "keywords": ["flight", "delay", "delayed", "cancelled", "trip", "missed"],
+        "policy_sections": ["travel", "trip", "delay", "cancellation"],
+    },
+    "baggage": {
+        "keywords": ["baggage", "luggage", "suitcase", "lost"],
+        "policy_sections": ["baggage", "luggage", "belongings"],
+    },
+    "theft": {
+        "keywords": ["stolen", "theft", "robbery", "burglary", "pickpocket"],
+        "policy_sections": ["theft", "belongings", "property"],
+    },
+    "legal": {
+        "keywords": ["lawyer", "legal", "court", "liability", "lawsuit"],
+        "policy_sections": ["legal", "liability"],
+    },
+}
+# Policy sections every specialist gets, matched on their headings
+GENERAL_POLICY_SECTIONS = ["definition", "general", "exclusion", "claim", "coverage"]
+DEFAULT_CLAIM_ROUTE = "general"
+ROUTER_CLASSIFIER = "keyword"  # "keyword" or "llm"
+ROUTER_MODEL_NAME = CASCADE_FAST_MODEL_NAME  # Model of the "llm" claim classifier
+
+# Decisions get only the policy sections most relevant to the claim from a retriever,
+# "bm25" or "tfidf", instead of the full policy. None sends the full policy
+POLICY_RETRIEVER = None
+POLICY_TOP_K = 5
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Log and count the policy tokens retrieval saves compared to sending the full policy
+REPORT_POLICY_TOKENS_SAVED = True
+
+# OCR of image documents: "remote" sends every image to OCR_MODEL_NAME, "tesseract" reads
+# them locally and "gated" reads them locally first and only sends images to the vision
+# model when Tesseract is not confident enough (0 to 100) or reads too few words
+OCR_BACKEND = "remote"
+OCR_LOCAL_LANGUAGE = "eng"
+OCR_LOCAL_MIN_CONFIDENCE = 80.0
+OCR_LOCAL_MIN_WORDS = 5
+OCR_LOCAL_WORKERS = 2
 
 CHECK_AUTHENTICITY = True
 USE_OCR = True
 AUTHENTICITY_THRESHOLD = 2  # Scores greater or equal to this are determined authentic
 
+MAX_CONCURRENT_CLAIMS = 8  # Number of claims processed in parallel during batch runs
+MAX_CONCURRENT_DOCUMENT_REQUESTS = 4  # Number of parallel vision requests per claim
+
+CLAIM_QUEUE_WORKERS = 4  # Number of claims the API processes in parallel
+CLAIM_QUEUE_MAX_SIZE = 1000  # Submissions are rejected once this many claims are queued
+CLAIM_JOB_HISTORY_SIZE = 10000  # Number of finished jobs kept for status lookups
+# Progress events of the latest job of this many claims are kept for late subscribers
+CLAIM_EVENT_HISTORY_SIZE = 1000
+CLAIM_EVENT_KEEPALIVE_SECONDS = 15.0
+# Decisions of API jobs are streamed token by token into the claim events. Only in live
+# mode, as recordings hold the complete responses of non-streamed requests
+STREAM_DECISION_TOKENS = MODEL_API_MODE == "live"
+
 CLAIM_DIRECTORY = "data"
 POLICY_DIRECTORY = "data"
 RESULTS_DIRECTORY = os.path.join("results", "latest")
+DECISION_STORE_BACKEND = "filesystem"  # "filesystem" or "sqlite"
+DECISION_STORE_PATH = os.path.join("results", "decisions.sqlite")
+DECISION_FLUSH_SIZE = 100  # Decisions of a bulk run are stored in writes of this many
 FILES_TO_EXCLUDE = ["description.txt", "answer.json"]
+TEXT_DOCUMENT_EXTENSIONS = (".md",)
+IMAGE_DOCUMENT_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+# Claims submitted through the API are stored as deduplicated blobs with a metadata index
+CLAIM_STORE_DIRECTORY = os.path.join(CLAIM_DIRECTORY, "store")
+MAX_DOCUMENT_BYTES = 20 * 1024 * 1024
+BASE64_DECODE_CHUNK_SIZE = 64 * 1024  # Multiple of 4 so chunks decode independently
+
+# Images are downscaled and recompressed before vision calls, authenticity checks
+# keep the original image by default as recompression can hide signs of editing
+OCR_IMAGE_PROFILE = {
+    "enabled": True,
+    "max_edge": 2048,
+    "format": "WEBP",
+    "quality": 90,
+    "grayscale": True,
+    "deskew": False,
+    "strip_exif": True,
+}
+AUTHENTICITY_IMAGE_PROFILE = {
+    "enabled": False,
+    "max_edge": None,
+    "format": "PNG",
+    "quality": 100,
+    "grayscale": False,
+    "deskew": False,
+    "strip_exif": False,
+}
+IMAGE_PREPROCESSING_WORKERS = 2
+
+CACHE_DIRECTORY = ".cache"
+# Caches track their size in memory, and re-read it from disk every this many writes
+# to pick up the writes of other processes sharing the cache file
+CACHE_SIZE_SYNC_INTERVAL = 1000
+USE_VISION_CACHE = True  # Reuse OCR and authenticity responses for identical images
+VISION_CACHE_PATH = os.path.join(CACHE_DIRECTORY, "vision_cache.sqlite")
+VISION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Reuse decisions for byte-identical decision requests, off by default so every
+# request gets a fresh decision from the model
+USE_DECISION_CACHE = False
+DECISION_CACHE_PATH = os.path.join(CACHE_DIRECTORY, "decision_cache.sqlite")
+DECISION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DECISION_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+# Requests for a claim whose inputs did not change since its stored decision are served
+# from the decision store, the input hash of every stored decision is kept here
+CLAIM_FINGERPRINT_CACHE_PATH = os.path.join(
+    CACHE_DIRECTORY, "claim_fingerprints.sqlite"
+)
+CLAIM_FINGERPRINT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Bulk runs can go through a provider batch interface, "local" is a file-based
+# stand-in that sends the requests of a batch through the regular client
+BATCH_API_BACKEND = os.getenv("BATCH_API_BACKEND", "local")
+BATCH_API_URL = os.getenv("BATCH_API_URL", "https://api.openai.com/v1")
+BATCH_API_KEY = os.getenv("BATCH_API_KEY", os.getenv("OPENAI_API_KEY"))
+# Names of the models in the "openai" batch backend, "openai/..." models need no entry
+# and the backend refuses every other model instead of sending it to the wrong provider
+BATCH_MODEL_NAMES = {}
+# Provider batch requests are billed at this fraction of the regular price
+BATCH_PRICE_FACTOR = 0.5
+BATCH_MAX_REQUESTS = 50_000  # Requests per submitted batch
+BATCH_MAX_BYTES = 190 * 1024 * 1024  # Size of the input file per submitted batch
+BATCH_POLL_INTERVAL_SECONDS = 60.0
+BATCH_LOCAL_WORKERS = 8  # Requests the local stand-in sends in parallel
+BATCH_DIRECTORY = os.path.join("results", "batch")  # Checkpoints of batch runs
+
+# Synthetic workloads of the benchmark suite, image sizes are (width, height) in pixels
+BENCHMARK_SCENARIOS = {
+    "small": {
+        "n_claims": 50,
+        "description_words": 150,
+        "n_text_documents": 1,
+        "text_document_words": 300,
+        "n_images": 1,
+        "image_size": (1240, 1754),
+        "policy_words": 2000,
+    },
+    "large": {
+        "n_claims": 200,
+        "description_words": 1500,
+        "n_text_documents": 3,
+        "text_document_words": 2000,
+        "n_images": 4,
+        "image_size": (2480, 3508),
+        "policy_words": 20000,
+    },
+}
+# Latency (seconds) of the fake model backend used by the benchmark suite
+BENCHMARK_MODEL_LATENCY_SECONDS = 0.2
+BENCHMARK_MODEL_JITTER_SECONDS = 0.05
+BENCHMARK_API_CONCURRENCY = 32
+BENCHMARK_BASELINE_DIRECTORY = os.path.join("benchmarks", "baselines")
+# Relative drop in throughput or rise in latency that counts as a regression
+BENCHMARK_REGRESSION_TOLERANCE = 0.2
@@ -1,57 +1,470 @@
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import mlflow
+import numpy as np
 import pandas as pd
 
-from claim_processing.process import process_and_upload_all_claims
+from claim_processing.constants import (
+    AUTHENTICITY_MODEL_NAME,
+    AUTHENTICITY_THRESHOLD,
+    MAX_CONCURRENT_CLAIMS,
+    OCR_BACKEND,
+    OCR_MODEL_NAME,
+)
+from claim_processing.process import (
+    get_claim_fingerprint,
+    get_pipeline_fingerprint,
+    list_available_claim_ids,
+    process_and_upload_all_claims,
+)
+from claim_processing.pydantic_models import ClaimDecision, ClaimTrace, EvaluationConfig
+from claim_processing.utils.claim_classifier import get_claim_classifier
 from claim_processing.utils.decision_engines import (
+    CascadeDecisionEngine,
+    DecisionEngine,
     DummyDecisionEngine,
+    RouterDecisionEngine,
     SimpleLLMDecisionEngine,
 )
-from claim_processing.utils.load import load_all_answers, load_all_decisions
+from claim_processing.utils.decision_store import get_decision_store
+from claim_processing.utils.load import load_all_answers, load_all_decisions, load_claim
 
 logger = logging.getLogger()
 
+DECISION_LABELS = ["APPROVE", "DENY", "UNCERTAIN"]
+
+
+def compute_metrics(decision_true: pd.Series, decision_pred: pd.Series) -> Dict:
+    """Accuracy, confusion matrix and per-class precision and recall of decisions."""
+    true_index = pd.Categorical(decision_true, categories=DECISION_LABELS).codes
+    pred_index = pd.Categorical(decision_pred, categories=DECISION_LABELS).codes
+    # Rows are the true decisions, columns the predicted decisions
+    confusion_matrix = np.zeros((len(DECISION_LABELS), len(DECISION_LABELS)), int)
+    np.add.at(confusion_matrix, (true_index, pred_index), 1)
+
+    true_positives = np.diag(confusion_matrix)
+    n_predicted = confusion_matrix.sum(axis=0)
+    n_true = confusion_matrix.sum(axis=1)
+    precision = np.divide(
+        true_positives,
+        n_predicted,
+        out=np.zeros(len(DECISION_LABELS)),
+        where=n_predicted > 0,
+    )
+    recall = np.divide(
+        true_positives, n_true, out=np.zeros(len(DECISION_LABELS)), where=n_true > 0
+    )
+    n_claims = int(confusion_matrix.sum())
+    return {
+        "n_claims": n_claims,
+        "accuracy": float(true_positives.sum() / n_claims) if n_claims else 0.0,
+        "confusion_matrix": {
+            true_label: dict(zip(DECISION_LABELS, confusion_matrix[i].tolist()))
+            for i, true_label in enumerate(DECISION_LABELS)
+        },
+        "per_class": {
+            label: {
+                "precision": float(precision[i]),
+                "recall": float(recall[i]),
+                "support": int(n_true[i]),
+            }
+            for i, label in enumerate(DECISION_LABELS)
+        },
+    }
 
-def evaluate_decisions(results_dir: str):
-    available_decisions = load_all_decisions(results_dir=results_dir)
-    available_answers = load_all_answers()
-    common_claim_ids = available_decisions.keys() & available_answers.keys()
 
-    evaluation_data = [
+def compute_run_statistics(
+    traces: List[ClaimTrace], early_denied_claim_ids: Optional[set] = None
+) -> Dict:
+    """Cost and latency of a run, early denied claims only count the stages before the DENY."""
+    early_denied_claim_ids = early_denied_claim_ids or set()
+    if not traces:
+        return {}
+    costs = np.array(
         [
-            claim_id,
-            available_answers[claim_id].decision,
-            available_decisions[claim_id].decision,
-            available_answers[claim_id].reasoning,
-            available_decisions[claim_id].reasoning,
+            sum(
+                span.cost_usd
+                for span in trace.spans
+                if trace.claim_id not in early_denied_claim_ids
+                or span.stage in ("load", "authenticity", "document_analysis")
+            )
+            for trace in traces
         ]
-        for claim_id in common_claim_ids
+    )
+    seconds = np.array([trace.seconds for trace in traces])
+    # Requests with an image, a fused document analysis replaces an OCR and an authenticity request
+    vision_calls = np.array(
+        [
+            sum(
+                span.model_calls
+                for span in trace.spans
+                if span.stage in ("authenticity", "ocr", "document_analysis")
+            )
+            for trace in traces
+        ]
+    )
+    statistics = {
+        "cost_usd": float(costs.sum()),
+        "cost_usd_per_claim": float(costs.mean()),
+        "latency_mean_seconds": float(seconds.mean()),
+        "latency_p50_seconds": float(np.percentile(seconds, 50)),
+        "latency_p95_seconds": float(np.percentile(seconds, 95)),
+        "vision_calls_per_claim": float(vision_calls.mean()),
+    }
+
+    # Share of the OCR'd image documents each OCR backend read, to tune the local OCR gate
+    ocr_backends = [
+        backend for trace in traces for backend in trace.ocr_backends.values()
     ]
+    for backend in sorted(set(ocr_backends)):
+        statistics[f"ocr_hit_rate_{backend}"] = ocr_backends.count(backend) / len(
+            ocr_backends
+        )
+
+    # Claims decided by a cascading decision engine, per deciding tier
+    tiers = np.array([trace.decision_tier for trace in traces])
+    if any(tier is not None for tier in tiers):
+        statistics["escalation_rate"] = float(np.mean(tiers == "escalated"))
+        for tier in ("fast", "escalated"):
+            if np.any(tiers == tier):
+                statistics[f"latency_p50_seconds_{tier}"] = float(
+                    np.percentile(seconds[tiers == tier], 50)
+                )
+    return statistics
+
+
+def compute_route_metrics(
+    decisions: Dict[int, ClaimDecision],
+    traces: Dict[int, ClaimTrace],
+    early_denied_claim_ids: Optional[set] = None,
+) -> Dict[str, Dict]:
+    """Accuracy, latency and cost per claim type of a routing decision engine."""
+    answers = load_all_answers()
+    claim_ids_per_route = {}
+    for claim_id, trace in traces.items():
+        if trace.decision_route is not None:
+            claim_ids_per_route.setdefault(trace.decision_route, []).append(claim_id)
+
+    route_metrics = {}
+    for route, claim_ids in sorted(claim_ids_per_route.items()):
+        common_claim_ids = [
+            claim_id
+            for claim_id in claim_ids
+            if claim_id in decisions and claim_id in answers
+        ]
+        metrics = compute_metrics(
+            pd.Series([answers[claim_id].decision for claim_id in common_claim_ids]),
+            pd.Series([decisions[claim_id].decision for claim_id in common_claim_ids]),
+        )
+        statistics = compute_run_statistics(
+            [traces[claim_id] for claim_id in claim_ids], early_denied_claim_ids
+        )
+        route_metrics[route] = {
+            "n_claims": len(claim_ids),
+            "accuracy": metrics["accuracy"],
+            "latency_p50_seconds": statistics["latency_p50_seconds"],
+            "cost_usd": statistics["cost_usd"],
+        }
+    return route_metrics
+
+
+def evaluate_decisions(
+    results_dir: str, decisions: Optional[Dict[int, ClaimDecision]] = None
+) -> Dict:
+    available_decisions = (
+        decisions if decisions is not None else load_all_decisions(results_dir)
+    )
+    available_answers = load_all_answers()
+    common_claim_ids = sorted(available_decisions.keys() & available_answers.keys())
+
     evaluation_df = pd.DataFrame(
-        evaluation_data,
-        columns=[
-            "claim_id",
-            "decision_true",
-            "decision_pred",
-            "reasoning_true",
-            "reasoning_pred",
-        ],
+        {
+            "claim_id": common_claim_ids,
+            "decision_true": [
+                available_answers[claim_id].decision for claim_id in common_claim_ids
+            ],
+            "decision_pred": [
+                available_decisions[claim_id].decision for claim_id in common_claim_ids
+            ],
+            "reasoning_true": [
+                available_answers[claim_id].reasoning for claim_id in common_claim_ids
+            ],
+            "reasoning_pred": [
+                available_decisions[claim_id].reasoning for claim_id in common_claim_ids
+            ],
+        }
     )
     evaluation_df.to_csv(os.path.join(results_dir, "results.csv"))
 
-    n_correct = 0
-    for _, row in evaluation_df.iterrows():
-        if row["decision_true"] == row["decision_pred"]:
-            n_correct += 1
-    accuracy = n_correct / len(evaluation_df)
-
+    metrics = compute_metrics(
+        evaluation_df["decision_true"], evaluation_df["decision_pred"]
+    )
     with open(os.path.join(results_dir, "results.json"), "w") as results_file:
-        json.dump({"accuracy": accuracy}, results_file)
+        json.dump(metrics, results_file, indent=2)
+
+    print(f"Accuracy: {metrics['accuracy']}")
+    return metrics
+
+
+def build_decision_engine(config: EvaluationConfig) -> DecisionEngine:
+    if config.decision_model == "SimpleLLM":
+        engine_kwargs = {}
+        if config.model_name is not None:
+            engine_kwargs["model_name"] = config.model_name
+        if config.system_prompt is not None:
+            engine_kwargs["system_prompt"] = config.system_prompt
+        if config.policy_retriever is not None:
+            engine_kwargs["policy_retriever"] = config.policy_retriever
+        if config.policy_top_k is not None:
+            engine_kwargs["policy_top_k"] = config.policy_top_k
+        return SimpleLLMDecisionEngine(**engine_kwargs)
+    elif config.decision_model == "Cascade":
+        engine_kwargs = {}
+        if config.model_name is not None:
+            engine_kwargs["model_name"] = config.model_name
+        if config.system_prompt is not None:
+            engine_kwargs["system_prompt"] = config.system_prompt
+        if config.fast_model_name is not None:
+            engine_kwargs["fast_model_name"] = config.fast_model_name
+        if config.min_confidence is not None:
+            engine_kwargs["min_confidence"] = config.min_confidence
+        return CascadeDecisionEngine(**engine_kwargs)
+    elif config.decision_model == "Router":
+        engine_kwargs = {}
+        if config.model_name is not None:
+            engine_kwargs["model_name"] = config.model_name
+        if config.system_prompt is not None:
+            engine_kwargs["system_prompt"] = config.system_prompt
+        if config.router_classifier is not None:
+            engine_kwargs["classifier"] = get_claim_classifier(config.router_classifier)
+        return RouterDecisionEngine(**engine_kwargs)
+    elif config.decision_model == "DummyDeny":
+        return DummyDecisionEngine(decision="DENY")
+    raise Exception(f"Model not supported: {config.decision_model}")
+
+
+def get_vision_model_names(config: EvaluationConfig) -> Tuple[str, str]:
+    """OCR and authenticity models of a configuration."""
+    return (
+        config.ocr_model_name or OCR_MODEL_NAME,
+        config.authenticity_model_name or AUTHENTICITY_MODEL_NAME,
+    )
 
-    print(f"Accuracy: {accuracy}")
+
+def load_evaluation_state(results_dir: str) -> Dict[int, Dict]:
+    """Fingerprint and trace of every claim evaluated in `results_dir`."""
+    state_path = os.path.join(results_dir, "evaluation_state.json")
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as state_file:
+        return {
+            int(claim_id): entry for claim_id, entry in json.load(state_file).items()
+        }
+
+
+def save_evaluation_state(results_dir: str, state: Dict[int, Dict]):
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, "evaluation_state.json"), "w") as state_file:
+        json.dump(
+            {str(claim_id): entry for claim_id, entry in state.items()}, state_file
+        )
+
+
+def find_changed_claims(
+    claim_ids: List[int],
+    pipeline_fingerprint: str,
+    state: Dict[int, Dict],
+    results_dir: str,
+    max_workers: int = MAX_CONCURRENT_CLAIMS,
+) -> Tuple[List[int], Dict[int, str]]:
+    """Claims whose inputs or pipeline changed since the last run, or that have no decision."""
+
+    def fingerprint_claim(claim_id: int) -> str:
+        return get_claim_fingerprint(load_claim(claim_id), pipeline_fingerprint)
+
+    # Hashing the documents is I/O bound, fingerprint the claims concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fingerprints = dict(zip(claim_ids, executor.map(fingerprint_claim, claim_ids)))
+
+    decided_claim_ids = set(get_decision_store(results_dir).list_claim_ids())
+    changed_claim_ids = [
+        claim_id
+        for claim_id in claim_ids
+        if claim_id not in decided_claim_ids
+        or state.get(claim_id, {}).get("fingerprint") != fingerprints[claim_id]
+    ]
+    return changed_claim_ids, fingerprints
+
+
+def run_config(
+    config: EvaluationConfig,
+    results_dir: str,
+    incremental: bool = True,
+    max_workers: int = MAX_CONCURRENT_CLAIMS,
+) -> Tuple[DecisionEngine, Dict[int, ClaimTrace]]:
+    """Process the claims of a configuration, incrementally only the claims that changed.
+
+    The pipeline runs at the lowest authenticity threshold of the configuration,
+    the decisions at higher thresholds are derived from the recorded scores.
+    """
+    decision_engine = build_decision_engine(config)
+    ocr_model_name, authenticity_model_name = get_vision_model_names(config)
+    authenticity_threshold = min(
+        config.authenticity_thresholds or [AUTHENTICITY_THRESHOLD]
+    )
+    pipeline_fingerprint = get_pipeline_fingerprint(
+        decision_engine,
+        check_authenticity=config.check_authenticity,
+        use_ocr=config.use_ocr,
+        authenticity_threshold=authenticity_threshold,
+        ocr_model_name=ocr_model_name,
+        authenticity_model_name=authenticity_model_name,
+        fused_vision_model_name=config.fused_vision_model_name,
+        ocr_backend=config.ocr_backend or OCR_BACKEND,
+    )
+
+    claim_ids = list_available_claim_ids()
+    state = load_evaluation_state(results_dir) if incremental else {}
+    changed_claim_ids, fingerprints = find_changed_claims(
+        claim_ids, pipeline_fingerprint, state, results_dir, max_workers=max_workers
+    )
+    logger.info(
+        f"Processing {len(changed_claim_ids)} of {len(claim_ids)} claims for configuration {config.name}"
+    )
+
+    if changed_claim_ids:
+        process_and_upload_all_claims(
+            decision_engine=decision_engine,
+            results_dir=results_dir,
+            check_authenticity=config.check_authenticity,
+            use_ocr=config.use_ocr,
+            claim_ids=changed_claim_ids,
+            max_workers=max_workers,
+            authenticity_threshold=authenticity_threshold,
+            ocr_model_name=ocr_model_name,
+            authenticity_model_name=authenticity_model_name,
+            fused_vision_model_name=config.fused_vision_model_name,
+            ocr_backend=config.ocr_backend or OCR_BACKEND,
+        )
+        with open(os.path.join(results_dir, "traces.jsonl"), "r") as traces_file:
+            for line in traces_file:
+                trace = ClaimTrace.model_validate_json(line)
+                # Failed claims keep their old entry, so they are retried next run
+                if trace.decision is not None:
+                    state[trace.claim_id] = {
+                        "fingerprint": fingerprints[trace.claim_id],
+                        "trace": trace.model_dump(),
+                    }
+        save_evaluation_state(results_dir, state)
+
+    traces = {
+        claim_id: ClaimTrace.model_validate(state[claim_id]["trace"])
+        for claim_id in claim_ids
+        if claim_id in state
+    }
+    return decision_engine, traces
+
+
+def apply_authenticity_threshold(
+    decisions: Dict[int, ClaimDecision],
+    traces: Dict[int, ClaimTrace],
+    authenticity_threshold: int,
+) -> Tuple[Dict[int, ClaimDecision], set]:
+    """Decisions at a higher threshold than the pipeline ran at, and the claims it denies early."""
+    thresholded_decisions = dict(decisions)
+    early_denied_claim_ids = set()
+    for claim_id, trace in traces.items():
+        scores = trace.authenticity_scores.values()
+        if (
+            claim_id in decisions
+            and scores
+            and min(scores) < authenticity_threshold
+            and decisions[claim_id].decision != "DENY"
+        ):
+            thresholded_decisions[claim_id] = ClaimDecision(
+                reasoning="The claim was declined because supporting documents were deemed to be not authentic",
+                decision="DENY",
+            )
+            early_denied_claim_ids.add(claim_id)
+    return thresholded_decisions, early_denied_claim_ids
+
+
+def evaluate_config(
+    config: EvaluationConfig,
+    incremental: bool = True,
+    max_workers: int = MAX_CONCURRENT_CLAIMS,
+) -> List[Dict]:
+    """Run and evaluate a configuration, with one result per authenticity threshold."""
+    results_dir = os.path.join("results", config.name)
+    decision_engine, traces = run_config(
+        config, results_dir, incremental=incremental, max_workers=max_workers
+    )
+    decisions = load_all_decisions(results_dir)
+
+    results = []
+    for authenticity_threshold in sorted(
+        config.authenticity_thresholds or [AUTHENTICITY_THRESHOLD]
+    ):
+        thresholded_decisions, early_denied_claim_ids = apply_authenticity_threshold(
+            decisions, traces, authenticity_threshold
+        )
+        if thresholded_decisions == decisions:
+            metrics = evaluate_decisions(results_dir, decisions)
+        else:
+            answers = load_all_answers()
+            common_claim_ids = sorted(thresholded_decisions.keys() & answers.keys())
+            metrics = compute_metrics(
+                pd.Series(
+                    [answers[claim_id].decision for claim_id in common_claim_ids]
+                ),
+                pd.Series(
+                    [
+                        thresholded_decisions[claim_id].decision
+                        for claim_id in common_claim_ids
+                    ]
+                ),
+            )
+        metrics.update(
+            compute_run_statistics(list(traces.values()), early_denied_claim_ids)
+        )
+        if isinstance(decision_engine, RouterDecisionEngine):
+            metrics["per_route"] = compute_route_metrics(
+                thresholded_decisions, traces, early_denied_claim_ids
+            )
+        results.append(
+            {
+                "config": config.name,
+                "authenticity_threshold": authenticity_threshold,
+                **metrics,
+            }
+        )
+
+    if isinstance(
+        decision_engine,
+        (SimpleLLMDecisionEngine, CascadeDecisionEngine, RouterDecisionEngine),
+    ):
+        token_usage = decision_engine.usage_summary()
+        logger.info(f"Decision token usage: {token_usage}")
+        with open(os.path.join(results_dir, "token_usage.json"), "w") as usage_file:
+            json.dump({"summary": token_usage}, usage_file)
+    return results
+
+
+def get_config_name(
+    decision_model: str, check_authenticity: bool, use_ocr: bool
+) -> str:
+    if decision_model == "DummyDeny":
+        return "DummyDeny"
+    config_name = decision_model
+    if check_authenticity:
+        config_name += "Auth"
+    if use_ocr:
+        config_name += "OCR"
+    return config_name + "ProImproved"
 
 
 if __name__ == "__main__":
@@ -61,31 +474,20 @@ if __name__ == "__main__":
     check_authenticity = True
     use_ocr = True
 
-    if decision_model == "SimpleLLM":
-        decision_engine = SimpleLLMDecisionEngine()
-        config_name = "SimpleLLM"
-        if check_authenticity:
-            config_name += "Auth"
-        if use_ocr:
-            config_name += "OCR"
-        config_name += "ProImproved"
-    elif decision_model == "DummyDeny":
-        decision_engine = DummyDecisionEngine(decision="DENY")
+    if decision_model == "DummyDeny":
         check_authenticity = False  # No effect to check authenticity for dummy
         use_ocr = False  # No effect to use ocr for dummy
-        config_name = "DummyDeny"
-    else:
-        raise Exception(f"Model not supported: {decision_model}")
 
     logger.info(
         f"Using configuration:\nModel: {decision_model}\nCheck authenticity: {check_authenticity}\nUse OCR: {use_ocr}"
     )
 
-    results_dir = os.path.join("results", config_name)
-    process_and_upload_all_claims(
-        decision_engine=decision_engine,
-        results_dir=results_dir,
+    config = EvaluationConfig(
+        name=get_config_name(decision_model, check_authenticity, use_ocr),
+        decision_model=decision_model,
         check_authenticity=check_authenticity,
         use_ocr=use_ocr,
     )
-    evaluate_decisions(results_dir)
+    evaluate_config(config)
+
+    # Sweeps over models, prompts and thresholds are run with `claim_processing.sweep`
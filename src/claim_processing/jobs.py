@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from claim_processing.constants import (
+    CLAIM_EVENT_KEEPALIVE_SECONDS,
+    CLAIM_FINGERPRINT_CACHE_MAX_BYTES,
+    CLAIM_FINGERPRINT_CACHE_PATH,
+    CLAIM_JOB_HISTORY_SIZE,
+    CLAIM_QUEUE_MAX_SIZE,
+    CLAIM_QUEUE_WORKERS,
+    RESULTS_DIRECTORY,
+)
+from claim_processing.process import (
+    get_claim_fingerprint,
+    get_pipeline_fingerprint,
+    process_and_upload_claim,
+)
+from claim_processing.pydantic_models import (
+    ClaimDecision,
+    ClaimEvent,
+    ClaimJob,
+    QueueStatus,
+)
+from claim_processing.utils.cache import DiskCache, make_cache_key
+from claim_processing.utils.decision_engines import DecisionEngine
+from claim_processing.utils.decision_store import get_decision_store
+from claim_processing.utils.events import (
+    TERMINAL_EVENTS,
+    ClaimEventBroker,
+    listen_to_events,
+)
+from claim_processing.utils.load import load_claim
+from claim_processing.utils.metrics import get_metrics_registry
+
+logger = logging.getLogger()
+
+
+class ClaimJobQueue:
+    """Bounded in-process queue of claims, processed by a fixed number of async workers."""
+
+    def __init__(
+        self,
+        decision_engine: DecisionEngine,
+        n_workers: int = CLAIM_QUEUE_WORKERS,
+        max_queue_size: int = CLAIM_QUEUE_MAX_SIZE,
+        history_size: int = CLAIM_JOB_HISTORY_SIZE,
+        results_dir: str = RESULTS_DIRECTORY,
+    ):
+        self.decision_engine = decision_engine
+        self.n_workers = n_workers
+        self.max_queue_size = max_queue_size
+        self.history_size = history_size
+        self.results_dir = results_dir
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._jobs: "OrderedDict[str, ClaimJob]" = OrderedDict()
+        self._job_events: Dict[str, asyncio.Event] = {}
+        # Queued and running jobs by claim id and input hash
+        self._in_flight: Dict[Tuple[int, Optional[str]], str] = {}
+        self._fingerprint_cache = DiskCache(
+            CLAIM_FINGERPRINT_CACHE_PATH, max_bytes=CLAIM_FINGERPRINT_CACHE_MAX_BYTES
+        )
+        self.pipeline_fingerprint = get_pipeline_fingerprint(decision_engine)
+        self.events = ClaimEventBroker()
+        self._n_running = 0
+        # Queue slots held for claims that are being stored before they are submitted
+        self._n_reserved = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._workers = [
+            asyncio.create_task(self._work(), name=f"claim-worker-{i}")
+            for i in range(self.n_workers)
+        ]
+        logger.info(f"Started claim job queue with {self.n_workers} workers")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def check_capacity(self, reserved: bool = False):
+        """Raise when the queue can not take a claim, `reserved` when the caller holds a slot."""
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="Claim queue is not running")
+        n_taken = self._queue.qsize() + self._n_reserved - int(reserved)
+        if n_taken >= self.max_queue_size:
+            raise HTTPException(
+                status_code=503, detail="Claim queue is full, please retry later"
+            )
+
+    @contextmanager
+    def reserve_slot(self) -> Iterator[None]:
+        """Hold a queue slot while a claim is stored, so its submission is not rejected afterwards."""
+        self.check_capacity()
+        self._n_reserved += 1
+        try:
+            yield
+        finally:
+            self._n_reserved -= 1
+
+    def get_input_hash(self, claim_id: int) -> Optional[str]:
+        """Hash of the claim inputs and pipeline, None when the claim can not be loaded."""
+        try:
+            claim = load_claim(claim_id)
+        except Exception:
+            return None
+        return get_claim_fingerprint(claim, self.pipeline_fingerprint)
+
+    def _fingerprint_cache_key(self, claim_id: int) -> str:
+        return make_cache_key(self.results_dir, str(claim_id))
+
+    def get_stored_decision(
+        self, claim_id: int, input_hash: str
+    ) -> Optional[ClaimDecision]:
+        """The stored decision of a claim, if it was made from the same inputs."""
+        if (
+            self._fingerprint_cache.get(self._fingerprint_cache_key(claim_id))
+            != input_hash
+        ):
+            return None
+        return get_decision_store(self.results_dir).get(claim_id)
+
+    async def submit(self, claim_id: int, reserved: bool = False) -> ClaimJob:
+        """Job for a claim, shared with concurrent requests for the same claim inputs.
+
+        A claim that was decided before from the same inputs gets a finished job
+        with the stored decision, without going through the queue.
+        """
+        input_hash = await asyncio.to_thread(self.get_input_hash, claim_id)
+        stored_decision = None
+        if input_hash is not None:
+            stored_decision = await asyncio.to_thread(
+                self.get_stored_decision, claim_id, input_hash
+            )
+        if stored_decision is not None:
+            get_metrics_registry().inc("claim_requests_total", result="stored")
+            now = time.time()
+            job = ClaimJob(
+                job_id=uuid.uuid4().hex,
+                claim_id=claim_id,
+                state="done",
+                submitted_at=now,
+                started_at=now,
+                finished_at=now,
+                decision=stored_decision,
+                input_hash=input_hash,
+            )
+            self._jobs[job.job_id] = job
+            self._prune_history()
+            self.events.publish(claim_id, "queued", {"job_id": job.job_id})
+            self.events.publish(
+                claim_id, "done", {"decision": stored_decision.model_dump()}
+            )
+            return job
+
+        # Nothing is awaited from here on, so concurrent requests can not both queue a job
+        in_flight_job_id = self._in_flight.get((claim_id, input_hash))
+        if in_flight_job_id is not None:
+            get_metrics_registry().inc("claim_requests_total", result="coalesced")
+            return self._jobs[in_flight_job_id]
+
+        self.check_capacity(reserved=reserved)
+        get_metrics_registry().inc("claim_requests_total", result="queued")
+        job = ClaimJob(
+            job_id=uuid.uuid4().hex,
+            claim_id=claim_id,
+            state="queued",
+            submitted_at=time.time(),
+            input_hash=input_hash,
+        )
+        self._jobs[job.job_id] = job
+        self._job_events[job.job_id] = asyncio.Event()
+        self._in_flight[(claim_id, input_hash)] = job.job_id
+        self._queue.put_nowait(job.job_id)
+        self._prune_history()
+        self.events.publish(claim_id, "queued", {"job_id": job.job_id})
+        return job
+
+    def get_job(self, job_id: str) -> ClaimJob:
+        if job_id not in self._jobs:
+            raise HTTPException(status_code=404, detail="Job does not exist")
+        return self._jobs[job_id]
+
+    async def wait(self, job_id: str) -> ClaimJob:
+        job = self.get_job(job_id)
+        if job.job_id in self._job_events:
+            await self._job_events[job.job_id].wait()
+        return job
+
+    async def subscribe_events(self, claim_id: int) -> asyncio.Queue:
+        """Queue of the progress events of a claim, replaying the events of its latest job.
+
+        A claim without jobs since the API started only gets a "done" event
+        with its stored decision.
+        """
+        queue = self.events.subscribe(claim_id)
+        if self.events.has_history(claim_id):
+            return queue
+        decision = await asyncio.to_thread(
+            get_decision_store(self.results_dir).get, claim_id
+        )
+        if decision is None:
+            self.events.unsubscribe(claim_id, queue)
+            raise HTTPException(status_code=404, detail="Claim is not being processed")
+        queue.put_nowait(
+            ClaimEvent(
+                claim_id=claim_id,
+                event="done",
+                data={"decision": decision.model_dump()},
+                timestamp=time.time(),
+            )
+        )
+        return queue
+
+    async def stream_events(
+        self,
+        claim_id: int,
+        queue: asyncio.Queue,
+        keepalive_seconds: float = CLAIM_EVENT_KEEPALIVE_SECONDS,
+    ) -> AsyncIterator[Optional[ClaimEvent]]:
+        """Events of a subscription until the job finishes, None when there was no event for `keepalive_seconds`."""
+        try:
+            while True:
+                try:
+                    claim_event = await asyncio.wait_for(
+                        queue.get(), timeout=keepalive_seconds
+                    )
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield claim_event
+                if claim_event.event in TERMINAL_EVENTS:
+                    return
+        finally:
+            self.events.unsubscribe(claim_id, queue)
+
+    def status(self) -> QueueStatus:
+        return QueueStatus(
+            queue_depth=self._queue.qsize() if self._queue is not None else 0,
+            n_running=self._n_running,
+            n_workers=self.n_workers,
+            max_queue_size=self.max_queue_size,
+        )
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self._jobs[job_id]
+            job.state = "running"
+            job.started_at = time.time()
+            self._n_running += 1
+            self.events.publish(job.claim_id, "started", {"job_id": job_id})
+            try:
+                # The pipeline makes blocking model calls, run it off the event loop.
+                # The thread gets a copy of the context, so the events it emits reach subscribers
+                with listen_to_events(self.events.listener(job.claim_id)):
+                    job.decision = await asyncio.to_thread(
+                        process_and_upload_claim,
+                        job.claim_id,
+                        decision_engine=self.decision_engine,
+                        results_dir=self.results_dir,
+                    )
+                if job.input_hash is not None:
+                    await asyncio.to_thread(
+                        self._fingerprint_cache.set,
+                        self._fingerprint_cache_key(job.claim_id),
+                        job.input_hash,
+                    )
+                job.state = "done"
+                self.events.publish(
+                    job.claim_id, "done", {"decision": job.decision.model_dump()}
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Faced exception {e} for claim id {job.claim_id} in job {job_id}"
+                )
+                job.error = str(e)
+                job.state = "failed"
+                self.events.publish(job.claim_id, "failed", {"error": job.error})
+            finally:
+                job.finished_at = time.time()
+                self._n_running -= 1
+                self._in_flight.pop((job.claim_id, job.input_hash), None)
+                self._job_events.pop(job_id).set()
+                self._queue.task_done()
+
+    def _prune_history(self):
+        # Only finished jobs are dropped, queued and running jobs stay visible
+        n_to_remove = len(self._jobs) - self.history_size
+        for job_id in list(self._jobs.keys()):
+            if n_to_remove <= 0:
+                break
+            if self._jobs[job_id].state in ("done", "failed"):
+                del self._jobs[job_id]
+                n_to_remove -= 1
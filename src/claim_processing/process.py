@@ -1,28 +1,63 @@
-import base64
+import json
 import logging
 import os
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from fastapi import HTTPException
 
 from claim_processing.constants import (
+    AUTHENTICITY_IMAGE_PROFILE,
+    AUTHENTICITY_MODEL_NAME,
     AUTHENTICITY_THRESHOLD,
     CHECK_AUTHENTICITY,
     CLAIM_DIRECTORY,
+    DECISION_FLUSH_SIZE,
+    FUSED_VISION_MODEL_NAME,
+    MAX_CONCURRENT_CLAIMS,
+    MAX_CONCURRENT_DOCUMENT_REQUESTS,
+    OCR_BACKEND,
+    OCR_IMAGE_PROFILE,
+    OCR_MODEL_NAME,
     RESULTS_DIRECTORY,
     USE_OCR,
 )
+from claim_processing.prompts import (
+    AUTHENTICITY_PROMPT,
+    DOCUMENT_ANALYSIS_PROMPT,
+    DOCUMENT_FORMAT_PROMPT,
+    OCR_PROMPT,
+)
 from claim_processing.pydantic_models import (
+    BatchSummary,
+    Claim,
     ClaimDecision,
+    ClaimTrace,
     DocumentUpload,
     UploadResponse,
 )
+from claim_processing.utils.cache import make_cache_key
+from claim_processing.utils.claim_store import get_claim_store
 from claim_processing.utils.decision_engines import DecisionEngine, DummyDecisionEngine
+from claim_processing.utils.decision_store import get_decision_store
+from claim_processing.utils.events import emit_event
 from claim_processing.utils.image_utils import (
+    analyze_document,
     extract_text_from_doc,
+    format_document_analysis,
+    get_ocr_backend,
     judge_image_authenticity,
 )
 from claim_processing.utils.load import load_claim
+from claim_processing.utils.metrics import (
+    get_current_trace,
+    get_metrics_registry,
+    run_stage,
+    submit_with_context,
+    trace_claim,
+    trace_stage,
+)
 
 logger = logging.getLogger()
 
@@ -32,88 +67,418 @@ def process_claim(
     decision_engine: DecisionEngine = DummyDecisionEngine(decision="DENY"),
     check_authenticity: bool = CHECK_AUTHENTICITY,
     use_ocr: bool = USE_OCR,
+    max_document_workers: int = MAX_CONCURRENT_DOCUMENT_REQUESTS,
+    authenticity_threshold: int = AUTHENTICITY_THRESHOLD,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    authenticity_model_name: str = AUTHENTICITY_MODEL_NAME,
+    fused_vision_model_name: Optional[str] = FUSED_VISION_MODEL_NAME,
+    ocr_backend: str = OCR_BACKEND,
 ) -> ClaimDecision:
-    claim = load_claim(claim_id)
-    if check_authenticity:
-        logger.info("Checking authenticity")
-        for supporting_doc in claim.supporting_documents:
-            if supporting_doc.type == "image supporting document":
-                try:
-                    authenticity_response = judge_image_authenticity(
-                        supporting_doc.content, supporting_doc.name
-                    )
-                    if (
-                        int(authenticity_response["authenticity_score"])
-                        < AUTHENTICITY_THRESHOLD
-                    ):
-                        logger.info(
-                            f"Claim {claim_id} was declined because of unauthenticity with score: {authenticity_response['authenticity_score']}"
-                        )
-                        return ClaimDecision(
-                            reasoning="The claim was declined because supporting documents were deemed to be not authentic:\n"
-                            + authenticity_response["reasoning"],
-                            decision="DENY",
-                        )
-                except Exception as e:
-                    print(
-                        f"During authentication, faced exception {e} for claim id {claim_id}. Skipping authentication step..."
-                    )
+    with trace_claim(claim_id) as trace:
+        decision = _process_claim(
+            claim_id,
+            decision_engine=decision_engine,
+            check_authenticity=check_authenticity,
+            use_ocr=use_ocr,
+            max_document_workers=max_document_workers,
+            authenticity_threshold=authenticity_threshold,
+            ocr_model_name=ocr_model_name,
+            authenticity_model_name=authenticity_model_name,
+            fused_vision_model_name=fused_vision_model_name,
+            ocr_backend=ocr_backend,
+        )
+        trace.decision = decision.decision
+        return decision
 
-    parsed_supporting_documents = []
-    logger.info("Parsing documents")
-    for doc in claim.supporting_documents:
-        parsed_supporting_documents.append(extract_text_from_doc(doc, use_ocr=use_ocr))
-    claim.supporting_documents = parsed_supporting_documents
+
+def _process_claim(
+    claim_id: int,
+    decision_engine: DecisionEngine,
+    check_authenticity: bool,
+    use_ocr: bool,
+    max_document_workers: int,
+    authenticity_threshold: int,
+    ocr_model_name: str,
+    authenticity_model_name: str,
+    fused_vision_model_name: Optional[str],
+    ocr_backend: str,
+) -> ClaimDecision:
+    with trace_stage("load"):
+        claim = load_claim(claim_id)
+
+    image_docs = [
+        doc
+        for doc in claim.supporting_documents
+        if doc.type == "image supporting document"
+    ]
+    # Authenticity checks and document parsing run concurrently, authenticity checks
+    # are submitted first so they are picked up first when the pool is saturated
+    executor = ThreadPoolExecutor(max_workers=max_document_workers)
+    try:
+        # A fused document analysis reads and judges an image in one request, its
+        # response serves as both the authenticity response and the parsed document
+        analysis_futures = {}
+        if fused_vision_model_name is not None and check_authenticity and use_ocr:
+            logger.info("Analyzing documents")
+            analysis_futures = {
+                supporting_doc.name: submit_with_context(
+                    executor,
+                    run_stage,
+                    "document_analysis",
+                    supporting_doc.name,
+                    analyze_document,
+                    supporting_doc,
+                    vision_model_name=fused_vision_model_name,
+                )
+                for supporting_doc in image_docs
+            }
+
+        authenticity_futures = {}
+        if analysis_futures:
+            authenticity_futures = {
+                analysis_future: doc_name
+                for doc_name, analysis_future in analysis_futures.items()
+            }
+        elif check_authenticity:
+            logger.info("Checking authenticity")
+            authenticity_futures = {
+                submit_with_context(
+                    executor,
+                    run_stage,
+                    "authenticity",
+                    supporting_doc.name,
+                    judge_image_authenticity,
+                    supporting_doc,
+                    vision_model_name=authenticity_model_name,
+                ): supporting_doc.name
+                for supporting_doc in image_docs
+            }
+
+        logger.info("Parsing documents")
+        parsing_futures = [
+            analysis_futures[doc.name]
+            if doc.name in analysis_futures
+            else submit_with_context(
+                executor,
+                run_stage,
+                "ocr" if doc.type == "image supporting document" else "parse",
+                doc.name,
+                extract_text_from_doc,
+                doc,
+                use_ocr=use_ocr,
+                ocr_model_name=ocr_model_name,
+                ocr_backend=ocr_backend,
+            )
+            for doc in claim.supporting_documents
+        ]
+
+        for authenticity_future in as_completed(authenticity_futures):
+            try:
+                authenticity_response = authenticity_future.result()
+                authenticity_score = int(authenticity_response["authenticity_score"])
+            except Exception as e:
+                logger.warning(
+                    f"During authentication, faced exception {e} for claim id {claim_id}. Skipping authentication step..."
+                )
+                continue
+            emit_event(
+                "authenticity",
+                document=authenticity_futures[authenticity_future],
+                authenticity_score=authenticity_score,
+                reasoning=authenticity_response.get("reasoning"),
+            )
+            trace = get_current_trace()
+            if trace is not None:
+                trace.authenticity_scores[authenticity_futures[authenticity_future]] = (
+                    authenticity_score
+                )
+            if authenticity_score < authenticity_threshold:
+                logger.info(
+                    f"Claim {claim_id} was declined because of unauthenticity with score: {authenticity_response['authenticity_score']}"
+                )
+                return ClaimDecision(
+                    reasoning="The claim was declined because supporting documents were deemed to be not authentic:\n"
+                    + authenticity_response["reasoning"],
+                    decision="DENY",
+                )
+
+        claim.supporting_documents = [
+            format_document_analysis(doc, future.result())
+            if doc.name in analysis_futures
+            else future.result()
+            for doc, future in zip(claim.supporting_documents, parsing_futures)
+        ]
+    finally:
+        # On an early DENY, queued requests are cancelled and requests that are
+        # already in flight are left to finish in the background, their results
+        # are discarded
+        executor.shutdown(wait=False, cancel_futures=True)
 
     logger.info("Making decision")
-    decision = decision_engine.decide_claim(claim=claim)
+    with trace_stage("decision"):
+        decision = decision_engine.decide_claim(claim=claim)
     return decision
 
 
-def process_and_upload_all_claims(
-    decision_engine: DecisionEngine = DummyDecisionEngine(decision="DENY"),
+def get_pipeline_fingerprint(
+    decision_engine: DecisionEngine,
+    check_authenticity: bool = CHECK_AUTHENTICITY,
+    use_ocr: bool = USE_OCR,
+    authenticity_threshold: int = AUTHENTICITY_THRESHOLD,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    authenticity_model_name: str = AUTHENTICITY_MODEL_NAME,
+    fused_vision_model_name: Optional[str] = FUSED_VISION_MODEL_NAME,
+    ocr_backend: str = OCR_BACKEND,
+) -> str:
+    """Hash of the pipeline configuration, including the models and prompts of every stage."""
+    if fused_vision_model_name is not None and check_authenticity and use_ocr:
+        return make_cache_key(
+            decision_engine.fingerprint(),
+            json.dumps([check_authenticity, use_ocr, authenticity_threshold]),
+            fused_vision_model_name,
+            DOCUMENT_ANALYSIS_PROMPT,
+            json.dumps(AUTHENTICITY_IMAGE_PROFILE, sort_keys=True),
+            DOCUMENT_FORMAT_PROMPT,
+        )
+    pipeline_fingerprint = make_cache_key(
+        decision_engine.fingerprint(),
+        json.dumps([check_authenticity, use_ocr, authenticity_threshold]),
+        authenticity_model_name if check_authenticity else "",
+        AUTHENTICITY_PROMPT if check_authenticity else "",
+        json.dumps(AUTHENTICITY_IMAGE_PROFILE, sort_keys=True)
+        if check_authenticity
+        else "",
+        ocr_model_name if use_ocr else "",
+        OCR_PROMPT if use_ocr else "",
+        json.dumps(OCR_IMAGE_PROFILE, sort_keys=True) if use_ocr else "",
+        DOCUMENT_FORMAT_PROMPT,
+    )
+    if use_ocr and ocr_backend != "remote":
+        pipeline_fingerprint = make_cache_key(
+            pipeline_fingerprint,
+            get_ocr_backend(ocr_backend, ocr_model_name).fingerprint(),
+        )
+    return pipeline_fingerprint
+
+
+def get_claim_fingerprint(claim: Claim, pipeline_fingerprint: str) -> str:
+    """Hash of the claim inputs and pipeline configuration, equal fingerprints give equal decisions."""
+    return make_cache_key(
+        pipeline_fingerprint,
+        claim.description.content,
+        *[
+            f"{doc.name}:{doc.content_hash()}"
+            for doc in sorted(claim.supporting_documents, key=lambda doc: doc.name)
+        ],
+    )
+
+
+def process_and_upload_claim(
+    claim_id: int,
+    decision_engine: DecisionEngine,
     overwrite: bool = True,
     results_dir: str = RESULTS_DIRECTORY,
     check_authenticity: bool = CHECK_AUTHENTICITY,
     use_ocr: bool = USE_OCR,
-):
-    # available_claim_ids = list_available_claim_ids()
-    available_claim_ids = [3, 4, 5, 6, 7, 8, 9]
-    for claim_id in available_claim_ids:
-        logger.info(f"Processing claim id {claim_id}")
+    authenticity_threshold: int = AUTHENTICITY_THRESHOLD,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    authenticity_model_name: str = AUTHENTICITY_MODEL_NAME,
+    fused_vision_model_name: Optional[str] = FUSED_VISION_MODEL_NAME,
+    ocr_backend: str = OCR_BACKEND,
+) -> ClaimDecision:
+    decision = process_claim(
+        claim_id,
+        decision_engine=decision_engine,
+        check_authenticity=check_authenticity,
+        use_ocr=use_ocr,
+        authenticity_threshold=authenticity_threshold,
+        ocr_model_name=ocr_model_name,
+        authenticity_model_name=authenticity_model_name,
+        fused_vision_model_name=fused_vision_model_name,
+        ocr_backend=ocr_backend,
+    )
+    upload_decision(decision, claim_id, overwrite=overwrite, results_dir=results_dir)
+    return decision
+
+
+def _process_traced_claim(
+    claim_id: int, **kwargs
+) -> Tuple[Optional[ClaimDecision], ClaimTrace, Optional[Exception]]:
+    with trace_claim(claim_id) as trace:
         try:
-            decision = process_claim(
-                claim_id,
-                decision_engine=decision_engine,
-                check_authenticity=check_authenticity,
-                use_ocr=use_ocr,
-            )
-            upload_decision(
-                decision, claim_id, overwrite=overwrite, results_dir=results_dir
-            )
+            return process_claim(claim_id, **kwargs), trace, None
         except Exception as e:
-            print(f"Faced exception {e} for claim id {claim_id}. Skipping...")
+            return None, trace, e
+
+
+def store_decisions(
+    decisions: Dict[int, ClaimDecision],
+    overwrite: bool = True,
+    results_dir: str = RESULTS_DIRECTORY,
+) -> List[int]:
+    """Store decisions, returns the claim ids that could not be stored."""
+    if not decisions:
+        return []
+    decision_store = get_decision_store(results_dir)
+    failed_claim_ids = []
+    if not decision_store.supports_bulk_writes:
+        for claim_id, decision in decisions.items():
+            try:
+                decision_store.put(claim_id, decision, overwrite=overwrite)
+            except Exception as e:
+                failed_claim_ids.append(claim_id)
+                logger.warning(
+                    f"Faced exception {e} when storing decision of claim id {claim_id}. Skipping..."
+                )
+        return failed_claim_ids
+
+    if not overwrite:
+        # A single existing decision would fail the whole write, leave those claims out
+        existing_claim_ids = set(decision_store.list_claim_ids())
+        failed_claim_ids = [
+            claim_id for claim_id in decisions if claim_id in existing_claim_ids
+        ]
+        for claim_id in failed_claim_ids:
+            logger.warning(
+                f"Decision of claim id {claim_id} already exists. Skipping..."
+            )
+        decisions = {
+            claim_id: decision
+            for claim_id, decision in decisions.items()
+            if claim_id not in existing_claim_ids
+        }
+    try:
+        decision_store.put_many(decisions, overwrite=overwrite)
+    except Exception as e:
+        failed_claim_ids.extend(decisions)
+        logger.warning(
+            f"Faced exception {e} when storing decisions of claim ids {sorted(decisions)}. Skipping..."
+        )
+    return failed_claim_ids
+
+
+def process_and_upload_all_claims(
+    decision_engine: DecisionEngine = DummyDecisionEngine(decision="DENY"),
+    overwrite: bool = True,
+    results_dir: str = RESULTS_DIRECTORY,
+    check_authenticity: bool = CHECK_AUTHENTICITY,
+    use_ocr: bool = USE_OCR,
+    claim_ids: Optional[Iterable[int]] = None,
+    exclude_claim_ids: Optional[Iterable[int]] = None,
+    max_workers: int = MAX_CONCURRENT_CLAIMS,
+    authenticity_threshold: int = AUTHENTICITY_THRESHOLD,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    authenticity_model_name: str = AUTHENTICITY_MODEL_NAME,
+    fused_vision_model_name: Optional[str] = FUSED_VISION_MODEL_NAME,
+    ocr_backend: str = OCR_BACKEND,
+) -> BatchSummary:
+    """Process claims concurrently, storing every decision as its claim finishes.
+
+    Stores with bulk writes get the decisions in writes of `DECISION_FLUSH_SIZE`.
+
+    By default all claims in the claim directory are processed, `claim_ids` and
+    `exclude_claim_ids` can be used to select a subset.
+    """
+    available_claim_ids = list_available_claim_ids()
+    if claim_ids is not None:
+        selected_claim_ids = set(claim_ids)
+        available_claim_ids = [
+            claim_id
+            for claim_id in available_claim_ids
+            if claim_id in selected_claim_ids
+        ]
+    if exclude_claim_ids is not None:
+        excluded_claim_ids = set(exclude_claim_ids)
+        available_claim_ids = [
+            claim_id
+            for claim_id in available_claim_ids
+            if claim_id not in excluded_claim_ids
+        ]
+
+    n_claims = len(available_claim_ids)
+    logger.info(f"Processing {n_claims} claims with {max_workers} workers")
+    failed_claim_ids = []
+    decisions = {}
+    n_completed = 0
+    start_time = time.perf_counter()
+
+    # Per-claim traces are written next to the decisions as each claim finishes
+    os.makedirs(results_dir, exist_ok=True)
+    flush_size = (
+        DECISION_FLUSH_SIZE
+        if get_decision_store(results_dir).supports_bulk_writes
+        else 1
+    )
+    try:
+        with (
+            open(os.path.join(results_dir, "traces.jsonl"), "w") as traces_file,
+            ThreadPoolExecutor(max_workers=max_workers) as executor,
+        ):
+            futures = {
+                executor.submit(
+                    _process_traced_claim,
+                    claim_id,
+                    decision_engine=decision_engine,
+                    check_authenticity=check_authenticity,
+                    use_ocr=use_ocr,
+                    authenticity_threshold=authenticity_threshold,
+                    ocr_model_name=ocr_model_name,
+                    authenticity_model_name=authenticity_model_name,
+                    fused_vision_model_name=fused_vision_model_name,
+                    ocr_backend=ocr_backend,
+                ): claim_id
+                for claim_id in available_claim_ids
+            }
+            for future in as_completed(futures):
+                claim_id = futures[future]
+                n_completed += 1
+                decision, trace, exception = future.result()
+                traces_file.write(trace.model_dump_json() + "\n")
+                if exception is None:
+                    logger.info(
+                        f"Processed claim id {claim_id} ({n_completed}/{n_claims})"
+                    )
+                    decisions[claim_id] = decision
+                    if len(decisions) >= flush_size:
+                        failed_claim_ids.extend(
+                            store_decisions(decisions, overwrite, results_dir)
+                        )
+                        decisions = {}
+                else:
+                    failed_claim_ids.append(claim_id)
+                    logger.warning(
+                        f"Faced exception {exception} for claim id {claim_id} ({n_completed}/{n_claims}). Skipping..."
+                    )
+    finally:
+        # Decisions already made are stored even when the run is interrupted
+        failed_claim_ids.extend(store_decisions(decisions, overwrite, results_dir))
+
+    elapsed_seconds = time.perf_counter() - start_time
+    summary = BatchSummary(
+        n_claims=n_claims,
+        n_succeeded=n_claims - len(failed_claim_ids),
+        n_failed=len(failed_claim_ids),
+        failed_claim_ids=sorted(failed_claim_ids),
+        elapsed_seconds=elapsed_seconds,
+        claims_per_second=n_claims / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+    )
+    logger.info(
+        f"Processed {summary.n_succeeded}/{n_claims} claims ({summary.n_failed} failed) "
+        f"in {elapsed_seconds:.1f}s ({summary.claims_per_second:.2f} claims/s)"
+    )
+    with open(os.path.join(results_dir, "metrics.prom"), "w") as metrics_file:
+        metrics_file.write(get_metrics_registry().render_prometheus())
+    return summary
 
 
 def upload_claim(
     claim_id: int, description_text: str, supporting_documents: List[DocumentUpload]
 ) -> UploadResponse:
-    claim_dir = os.path.join(CLAIM_DIRECTORY, f"claim {claim_id}")
-
-    if os.path.exists(claim_dir):
+    if os.path.exists(os.path.join(CLAIM_DIRECTORY, f"claim {claim_id}")):
         raise HTTPException(
             status_code=500, detail="Claim submission failed, claim id already exists"
         )
-    os.makedirs(claim_dir)
-
-    with open(os.path.join(claim_dir, "description.txt"), "w") as description_file:
-        description_file.write(description_text)
-
-    for supporting_doc in supporting_documents:
-        with open(
-            os.path.join(claim_dir, supporting_doc.file_name), "wb"
-        ) as supporting_file:
-            supporting_file.write(base64.b64decode(supporting_doc.document_bytes))
+    get_claim_store().add_claim(claim_id, description_text, supporting_documents)
 
     return UploadResponse(
         status=200,
@@ -123,37 +488,31 @@ def upload_claim(
 
 def upload_decision(
     claim_decision: ClaimDecision,
-    claim_id: str,
+    claim_id: int,
     overwrite: bool = False,
     results_dir: str = RESULTS_DIRECTORY,
 ):
-    os.makedirs(results_dir, exist_ok=True)
-    claim_decision_path = os.path.join(results_dir, f"claim {claim_id} decision.json")
-
-    if os.path.exists(claim_decision_path) and not overwrite:
-        raise HTTPException(
-            status_code=500,
-            detail="Claim decision already exists and overwrite is set to False",
-        )
-
-    with open(claim_decision_path, "w") as decision_file:
-        decision_file.write(claim_decision.model_dump_json())
+    get_decision_store(results_dir).put(claim_id, claim_decision, overwrite=overwrite)
 
 
 def list_available_claim_ids() -> List[int]:
     available_claim_directories = os.listdir(CLAIM_DIRECTORY)
-    claim_ids = [
+    claim_ids = {
         int(claim_dir.replace("claim ", ""))
         for claim_dir in available_claim_directories
-        if os.path.isdir(os.path.join(CLAIM_DIRECTORY, claim_dir))
-    ]
-    return claim_ids
+        if claim_dir.startswith("claim ")
+        and os.path.isdir(os.path.join(CLAIM_DIRECTORY, claim_dir))
+    }
+    claim_ids.update(get_claim_store().list_claim_ids())
+    return sorted(claim_ids)
 
 
-def list_available_decision_ids() -> List[int]:
-    available_decision_files = os.listdir(RESULTS_DIRECTORY)
-    decision_ids = [
-        int(result_file.replace("claim ", "").replace(" decision.json"))
-        for result_file in available_decision_files
-    ]
-    return decision_ids
+def list_available_decision_ids(
+    results_dir: str = RESULTS_DIRECTORY,
+    decision: Optional[str] = None,
+    after_claim_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[int]:
+    return get_decision_store(results_dir).list_claim_ids(
+        decision=decision, after_claim_id=after_claim_id, limit=limit
+    )
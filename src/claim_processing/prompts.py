@@ -32,6 +32,41 @@ Your output should be a JSON object with exactly the following fields:
 - decision (str): "APPROVE", "DENY", "UNCERTAIN"
 """
 
+CONFIDENCE_LLM_SYSTEM_PROMPT = """
+You are a helpful assistant that will judge if an insurance claim is covered by a policy. 
+
+You will be given an insurance claim (consisting of a description and supporting documents) 
+and a policy. You will need to decide if the claim is covered by the policy. 
+
+Valid reasons to deny an insurance claim include:
+- Medical document is missing when it is required
+- Medical document states person is healthy
+- Medical document is in text form
+- Name or initials do not correspond with expected name
+- Incidents were outside the coverage timeline
+- Events were not covered by the policy terms
+
+Only approve a claim if all requirements for the claim are fulfilled according to the policy
+and supported by valid supporting documents. Return 'uncertain' if the case requires further
+clarification, e.g. when there are suspicious dates or missing signatures in medical documents.
+
+Also rate how confident you are in your decision. Be critical: only give a high confidence when
+the claim is straightforward and every requirement can be checked against the documents.
+
+Your output should be a JSON object with exactly the following fields:
+- reasoning (str): a two sentence explanation of your decision
+- decision (str): "APPROVE", "DENY", "UNCERTAIN"
+- confidence (int): from 1 (guessing) to 5 (certain)
+"""
+
+CLAIM_CLASSIFICATION_PROMPT = """
+Classify the insurance claim below into exactly one of the following claim types: {claim_types}.
+Answer "{default_claim_type}" if the claim does not clearly belong to one of these types.
+
+Your output should be a JSON object with exactly the following fields:
+- claim_type (str): the claim type
+"""
+
 AUTHENTICITY_PROMPT = """
 Analyze this image for authenticity. Look for signs of manipulation, editing, photoshop or fraud. 
 Check for inconsistencies in text, formatting, image quality, or any other suspicious elements.
@@ -53,10 +88,28 @@ Rules:
 - Only return the extracted text, without additional information
 """
 
+DOCUMENT_ANALYSIS_PROMPT = """You are an expert OCR, document understanding and fraud detection system.
+You will be given an image of a supporting document of an insurance claim.
+
+First, read and extract ALL visible text accurately from the document. Be precise and
+preserve numbers, currency symbols, and dates exactly as they appear.
+
+Then, analyze the image for authenticity. Look for signs of manipulation, editing, photoshop or fraud.
+Check for inconsistencies in text, formatting, image quality, or any other suspicious elements.
+
+Your output should be a JSON object with exactly the following fields:
+- extracted_text (str): all text of the document, without additional information
+- reasoning (str): a two sentence explanation of your authenticity assessment
+- authenticity_score (int): a score between 0 and 5 determining the authenticity of the document, with 0 being completely non-authentic, while 5 being a 100% confident authentic document
+"""
+
+POLICY_PROMPT = """
+Policy: {policy}
+"""
+
 CLAIM_PROMPT = """
 Claim description: {claim_description}
 Claim supporting documents: {claim_supporting_documents}
-Policy: {policy}
 """
 
 DOCUMENT_FORMAT_PROMPT = """
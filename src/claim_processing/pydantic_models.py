@@ -1,12 +1,50 @@
-from typing import List, Literal
+import base64
+import hashlib
+from typing import Dict, List, Literal, Optional
 
 from pydantic import BaseModel
 
 
 class Document(BaseModel):
     name: str
-    content: str
+    content: str = ""
     type: str
+    # Image documents only reference their file, the bytes are read when a model needs them
+    path: Optional[str] = None
+    size_bytes: Optional[int] = None
+
+    def read_bytes(self) -> bytes:
+        if self.path is None:
+            return base64.b64decode(self.content)
+        with open(self.path, "rb") as file:
+            return file.read()
+
+    def read_base64(self) -> str:
+        if self.path is None:
+            return self.content
+        return base64.b64encode(self.read_bytes()).decode("utf-8")
+
+    def content_hash(self) -> str:
+        if self.path is not None:
+            with open(self.path, "rb") as file:
+                return hashlib.file_digest(file, "sha256").hexdigest()
+        if self.type == "image supporting document":
+            return hashlib.sha256(base64.b64decode(self.content)).hexdigest()
+        return hashlib.sha256(self.content.encode("utf-8")).hexdigest()
+
+
+class PolicySection(BaseModel):
+    title: str
+    # Titles of the enclosing headings, from the top level down to this section
+    path: List[str]
+    content: str
+
+
+class StoredDocument(BaseModel):
+    file_name: str
+    blob_hash: str
+    path: str
+    size_bytes: int
 
 
 class DocumentUpload(BaseModel):
@@ -23,6 +61,7 @@ class ClaimRequest(BaseModel):
 class UploadResponse(BaseModel):
     status: int
     message: str
+    job_id: Optional[str] = None
 
 
 class AuthenticityResponse(BaseModel):
@@ -30,6 +69,20 @@ class AuthenticityResponse(BaseModel):
     authenticity_score: int
 
 
+class OCRResult(BaseModel):
+    text: str
+    backend: str
+    # Mean word confidence (0 to 100) and word count, for backends that report them
+    confidence: Optional[float] = None
+    n_words: Optional[int] = None
+
+
+class DocumentAnalysisResponse(BaseModel):
+    extracted_text: str
+    reasoning: str
+    authenticity_score: int
+
+
 class Claim(BaseModel):
     claim_id: int
     description: Document
@@ -39,3 +92,133 @@ class Claim(BaseModel):
 class ClaimDecision(BaseModel):
     reasoning: str
     decision: Literal["APPROVE", "DENY", "UNCERTAIN"]
+
+
+class ClaimClassification(BaseModel):
+    claim_type: str
+
+
+class ConfidentClaimDecision(BaseModel):
+    reasoning: str
+    decision: Literal["APPROVE", "DENY", "UNCERTAIN"]
+    confidence: int
+
+
+class BatchSummary(BaseModel):
+    n_claims: int
+    n_succeeded: int
+    n_failed: int
+    failed_claim_ids: List[int]
+    elapsed_seconds: float
+    claims_per_second: float
+
+
+class ClaimJob(BaseModel):
+    job_id: str
+    claim_id: int
+    state: Literal["queued", "running", "done", "failed"]
+    submitted_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    decision: Optional[ClaimDecision] = None
+    error: Optional[str] = None
+    # Hash of the claim inputs and pipeline, requests with equal hashes share one job
+    input_hash: Optional[str] = None
+
+
+class ClaimEvent(BaseModel):
+    claim_id: int
+    # "queued", "started", "stage", "authenticity", "decision_token", "done" or "failed"
+    event: str
+    data: Dict = {}
+    timestamp: float
+
+
+class QueueStatus(BaseModel):
+    queue_depth: int
+    n_running: int
+    n_workers: int
+    max_queue_size: int
+
+
+class TokenUsage(BaseModel):
+    model: str
+    input_tokens: int
+    cached_input_tokens: int
+    output_tokens: int
+
+
+class StageSpan(BaseModel):
+    stage: str
+    name: Optional[str] = None
+    start_offset_seconds: float
+    seconds: float = 0.0
+    model_calls: int = 0
+    models: List[str] = []
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 0
+    cost_usd: float = 0.0
+    retries: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+
+class ClaimTrace(BaseModel):
+    claim_id: int
+    started_at: float
+    seconds: float = 0.0
+    decision: Optional[str] = None
+    # Authenticity score per checked document, lets threshold sweeps reuse a run
+    authenticity_scores: Dict[str, int] = {}
+    # Tier of a cascading decision engine that made the decision, and why it escalated
+    decision_tier: Optional[str] = None
+    escalation_reason: Optional[str] = None
+    # Claim type a routing decision engine sent the claim to
+    decision_route: Optional[str] = None
+    # OCR backend that read each image document
+    ocr_backends: Dict[str, str] = {}
+    spans: List[StageSpan] = []
+
+
+class BenchmarkResult(BaseModel):
+    scenario: str
+    target: Literal["batch", "api"]
+    n_claims: int
+    n_failed: int
+    n_model_requests: int = 0
+    elapsed_seconds: float
+    claims_per_second: float
+    latency_p50_seconds: float
+    latency_p95_seconds: float
+    latency_p99_seconds: float
+    peak_rss_mb: float
+    # Mean seconds per claim spent in each stage, summed over the documents of a claim
+    stage_seconds: Dict[str, float]
+
+
+class EvaluationConfig(BaseModel):
+    name: str
+    decision_model: Literal["SimpleLLM", "Cascade", "Router", "DummyDeny"] = "SimpleLLM"
+    # Defaults of the decision engine are used when not set
+    model_name: Optional[str] = None
+    system_prompt: Optional[str] = None
+    # First tier of the cascade and the confidence below which it escalates
+    fast_model_name: Optional[str] = None
+    min_confidence: Optional[int] = None
+    # Retriever of the policy sections sent with a claim, "bm25" or "tfidf", and how many
+    policy_retriever: Optional[str] = None
+    policy_top_k: Optional[int] = None
+    # Claim classifier of the router, "keyword" or "llm"
+    router_classifier: Optional[str] = None
+    check_authenticity: bool = True
+    use_ocr: bool = True
+    # Vision models of the pipeline are used when not set
+    ocr_model_name: Optional[str] = None
+    authenticity_model_name: Optional[str] = None
+    # A single document analysis call with this model replaces the OCR and authenticity calls
+    fused_vision_model_name: Optional[str] = None
+    # "remote", "tesseract" or "gated", defaults to OCR_BACKEND
+    ocr_backend: Optional[str] = None
+    # Evaluated from a single pipeline run, defaults to AUTHENTICITY_THRESHOLD
+    authenticity_thresholds: Optional[List[int]] = None
@@ -0,0 +1,417 @@
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from claim_processing.constants import (
+    AUTHENTICITY_THRESHOLD,
+    MAX_CONCURRENT_CLAIMS,
+    MAX_CONCURRENT_DOCUMENT_REQUESTS,
+    OCR_BACKEND,
+)
+from claim_processing.evaluate import (
+    build_decision_engine,
+    evaluate_decisions,
+    get_vision_model_names,
+)
+from claim_processing.process import list_available_claim_ids
+from claim_processing.pydantic_models import (
+    Claim,
+    ClaimDecision,
+    EvaluationConfig,
+    StageSpan,
+)
+from claim_processing.utils.cache import make_cache_key
+from claim_processing.utils.decision_engines import DecisionEngine
+from claim_processing.utils.decision_store import get_decision_store
+from claim_processing.utils.image_utils import (
+    analyze_document,
+    extract_text_from_doc,
+    format_document_analysis,
+    judge_image_authenticity,
+)
+from claim_processing.utils.load import load_claim
+from claim_processing.utils.metrics import trace_stage
+
+logger = logging.getLogger()
+
+StageKey = Tuple[str, ...]
+
+
+class StageGraph:
+    """Stage outputs keyed by their inputs, every unique output is computed once.
+
+    Each stage runs on the executor of its level, so a stage that waits on the
+    outputs of an earlier level never blocks the workers of that level.
+    """
+
+    def __init__(self, executors: Dict[str, ThreadPoolExecutor]):
+        self.executors = executors
+        self.spans: Dict[StageKey, StageSpan] = {}
+        self.n_requested: Dict[str, int] = defaultdict(int)
+        self._nodes: Dict[StageKey, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: StageKey, function: Callable, *args, **kwargs) -> Future:
+        stage = key[0]
+        with self._lock:
+            self.n_requested[stage] += 1
+            future = self._nodes.get(key)
+            if future is None:
+                future = self.executors[stage].submit(
+                    self._run, key, function, *args, **kwargs
+                )
+                self._nodes[key] = future
+        return future
+
+    def _run(self, key: StageKey, function: Callable, *args, **kwargs):
+        with trace_stage(key[0], key[1]) as span:
+            self.spans[key] = span
+            return function(*args, **kwargs)
+
+    def n_computed(self) -> Dict[str, int]:
+        n_computed = defaultdict(int)
+        for key in self.spans:
+            n_computed[key[0]] += 1
+        return dict(n_computed)
+
+    def cost(self, keys: Optional[Set[StageKey]] = None) -> Dict[str, float]:
+        """Cost per stage of the given outputs, of all computed outputs by default."""
+        stage_costs = defaultdict(float)
+        for key, span in self.spans.items():
+            if keys is None or key in keys:
+                stage_costs[key[0]] += span.cost_usd
+        return dict(stage_costs)
+
+
+class SweepVariant:
+    """A configuration at a single authenticity threshold."""
+
+    def __init__(
+        self,
+        config: EvaluationConfig,
+        authenticity_threshold: int,
+        decision_engine: DecisionEngine,
+        results_dir: str,
+    ):
+        self.config = config
+        self.authenticity_threshold = authenticity_threshold
+        self.decision_engine = decision_engine
+        self.decision_fingerprint = decision_engine.fingerprint()
+        self.ocr_model_name, self.authenticity_model_name = get_vision_model_names(
+            config
+        )
+        self.ocr_backend = config.ocr_backend or OCR_BACKEND
+        self.results_dir = results_dir
+        self.decisions: Dict[int, ClaimDecision] = {}
+        self.stage_keys: Set[StageKey] = set()
+
+
+def build_config_grid(prefix: str = "Sweep", **options: List) -> List[EvaluationConfig]:
+    """A configuration for every combination of the given `EvaluationConfig` field values.
+
+    E.g. `build_config_grid(model_name=[...], use_ocr=[True, False])`.
+    """
+    fields = list(options.keys())
+    return [
+        EvaluationConfig(name=f"{prefix}{i:03d}", **dict(zip(fields, values)))
+        for i, values in enumerate(itertools.product(*options.values()))
+    ]
+
+
+def build_variants(
+    configs: List[EvaluationConfig], results_root: str
+) -> List[SweepVariant]:
+    # Configurations with the same decision engine share a single engine instance
+    engines: Dict[str, DecisionEngine] = {}
+    variants = []
+    for config in configs:
+        decision_engine = build_decision_engine(config)
+        decision_engine = engines.setdefault(
+            decision_engine.fingerprint(), decision_engine
+        )
+        thresholds = sorted(config.authenticity_thresholds or [AUTHENTICITY_THRESHOLD])
+        for authenticity_threshold in thresholds:
+            # Directory names double as config names in the SQLite decision store
+            name = config.name
+            if len(thresholds) > 1:
+                name += f"_threshold{authenticity_threshold}"
+            results_dir = os.path.join(results_root, name)
+            variants.append(
+                SweepVariant(
+                    config, authenticity_threshold, decision_engine, results_dir
+                )
+            )
+    return variants
+
+
+def decide_variant_claim(
+    graph: StageGraph,
+    variant: SweepVariant,
+    claim: Claim,
+    document_hashes: Dict[str, str],
+) -> ClaimDecision:
+    """Decision of a variant for a claim, built from the shared stage outputs."""
+    config = variant.config
+    image_docs = [
+        doc
+        for doc in claim.supporting_documents
+        if doc.type == "image supporting document"
+    ]
+
+    def submit(key: StageKey, function: Callable, *args, **kwargs):
+        variant.stage_keys.add(key)
+        return graph.submit(key, function, *args, **kwargs)
+
+    # Every stage of the claim is submitted before waiting on any of them, stages
+    # are not cancelled on an early DENY as other variants may still need them
+    analysis_futures = {}
+    if (
+        config.fused_vision_model_name is not None
+        and config.check_authenticity
+        and config.use_ocr
+    ):
+        analysis_futures = {
+            doc.name: submit(
+                (
+                    "document_analysis",
+                    document_hashes[doc.name],
+                    config.fused_vision_model_name,
+                ),
+                analyze_document,
+                doc,
+                vision_model_name=config.fused_vision_model_name,
+            )
+            for doc in image_docs
+        }
+    authenticity_futures = {}
+    if analysis_futures:
+        authenticity_futures = analysis_futures
+    elif config.check_authenticity:
+        authenticity_futures = {
+            doc.name: submit(
+                (
+                    "authenticity",
+                    document_hashes[doc.name],
+                    variant.authenticity_model_name,
+                ),
+                judge_image_authenticity,
+                doc,
+                vision_model_name=variant.authenticity_model_name,
+            )
+            for doc in image_docs
+        }
+    ocr_futures = {}
+    if config.use_ocr and not analysis_futures:
+        ocr_futures = {
+            # The parsed document includes its name, identical images under another
+            # name still share the OCR response through the vision cache
+            doc.name: submit(
+                (
+                    "ocr",
+                    document_hashes[doc.name],
+                    variant.ocr_model_name,
+                    variant.ocr_backend,
+                    doc.name,
+                ),
+                extract_text_from_doc,
+                doc,
+                ocr_model_name=variant.ocr_model_name,
+                ocr_backend=variant.ocr_backend,
+            )
+            for doc in image_docs
+        }
+
+    for authenticity_future in authenticity_futures.values():
+        try:
+            authenticity_response = authenticity_future.result()
+            authenticity_score = int(authenticity_response["authenticity_score"])
+        except Exception as e:
+            logger.warning(
+                f"During authentication, faced exception {e} for claim id {claim.claim_id}. Skipping authentication step..."
+            )
+            continue
+        if authenticity_score < variant.authenticity_threshold:
+            return ClaimDecision(
+                reasoning="The claim was declined because supporting documents were deemed to be not authentic:\n"
+                + authenticity_response["reasoning"],
+                decision="DENY",
+            )
+
+    supporting_documents = []
+    for doc in claim.supporting_documents:
+        if doc.name in analysis_futures:
+            supporting_documents.append(
+                format_document_analysis(doc, analysis_futures[doc.name].result())
+            )
+        elif doc.name in ocr_futures:
+            supporting_documents.append(ocr_futures[doc.name].result())
+        else:
+            supporting_documents.append(extract_text_from_doc(doc, use_ocr=False))
+    # Variants that build the same request from the same engine share the decision
+    decision_key = (
+        "decision",
+        make_cache_key(
+            variant.decision_fingerprint,
+            claim.description.content,
+            *supporting_documents,
+        ),
+    )
+    variant.stage_keys.add(decision_key)
+    return graph.submit(
+        decision_key,
+        variant.decision_engine.decide_claim,
+        claim=claim.model_copy(update={"supporting_documents": supporting_documents}),
+    ).result()
+
+
+def write_variant_results(variant: SweepVariant, graph: StageGraph) -> Dict:
+    os.makedirs(variant.results_dir, exist_ok=True)
+    get_decision_store(variant.results_dir).put_many(variant.decisions)
+    metrics = evaluate_decisions(variant.results_dir, variant.decisions)
+
+    # The cost of a variant as if it ran on its own, shared outputs count in full
+    stage_costs = graph.cost(variant.stage_keys)
+    cost = {
+        "cost_usd": sum(stage_costs.values()),
+        "stage_cost_usd": stage_costs,
+        "n_claims": len(variant.decisions),
+    }
+    with open(os.path.join(variant.results_dir, "cost.json"), "w") as cost_file:
+        json.dump(cost, cost_file, indent=2)
+
+    row = {
+        "config": variant.config.name,
+        "results_dir": variant.results_dir,
+        "decision_model": variant.config.decision_model,
+        "model_name": variant.config.model_name,
+        "ocr_model_name": variant.ocr_model_name if variant.config.use_ocr else None,
+        "ocr_backend": variant.ocr_backend if variant.config.use_ocr else None,
+        "authenticity_model_name": variant.authenticity_model_name
+        if variant.config.check_authenticity
+        else None,
+        "fused_vision_model_name": variant.config.fused_vision_model_name,
+        "check_authenticity": variant.config.check_authenticity,
+        "use_ocr": variant.config.use_ocr,
+        "authenticity_threshold": variant.authenticity_threshold,
+        "n_claims": metrics["n_claims"],
+        "accuracy": metrics["accuracy"],
+        "cost_usd": cost["cost_usd"],
+    }
+    for label, class_metrics in metrics["per_class"].items():
+        row[f"precision_{label}"] = class_metrics["precision"]
+        row[f"recall_{label}"] = class_metrics["recall"]
+    return row
+
+
+def run_sweep(
+    configs: List[EvaluationConfig],
+    claim_ids: Optional[List[int]] = None,
+    results_root: str = "results",
+    max_workers: int = MAX_CONCURRENT_CLAIMS,
+) -> pd.DataFrame:
+    """Evaluate a grid of configurations, sharing stage outputs between them.
+
+    The stages of all configurations form a single graph: every unique OCR and
+    authenticity output (per document and model) and every unique decision
+    request is computed once and fanned out to every configuration that uses
+    it. Decisions, results and cost totals are written per configuration, the
+    summary to `results/sweep.csv` and the actual spend to `results/sweep_cost.json`.
+    """
+    variants = build_variants(configs, results_root)
+    claim_ids = claim_ids if claim_ids is not None else list_available_claim_ids()
+    logger.info(f"Sweeping {len(variants)} configurations over {len(claim_ids)} claims")
+
+    def load_claim_inputs(claim_id: int) -> Tuple[Claim, Dict[str, str]]:
+        claim = load_claim(claim_id)
+        return claim, {
+            doc.name: doc.content_hash() for doc in claim.supporting_documents
+        }
+
+    vision_executor = ThreadPoolExecutor(
+        max_workers=max_workers * MAX_CONCURRENT_DOCUMENT_REQUESTS
+    )
+    decision_executor = ThreadPoolExecutor(max_workers=max_workers)
+    graph = StageGraph(
+        {
+            "authenticity": vision_executor,
+            "ocr": vision_executor,
+            "document_analysis": vision_executor,
+            "decision": decision_executor,
+        }
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as claim_executor:
+            load_futures = {
+                claim_id: claim_executor.submit(load_claim_inputs, claim_id)
+                for claim_id in claim_ids
+            }
+            claim_inputs = {}
+            for claim_id, load_future in load_futures.items():
+                try:
+                    claim_inputs[claim_id] = load_future.result()
+                except Exception as e:
+                    logger.warning(
+                        f"Faced exception {e} when loading claim id {claim_id}. Skipping..."
+                    )
+            futures = {
+                claim_executor.submit(
+                    decide_variant_claim,
+                    graph,
+                    variant,
+                    *claim_inputs[claim_id],
+                ): (variant, claim_id)
+                for variant in variants
+                for claim_id in claim_inputs
+            }
+            for future, (variant, claim_id) in futures.items():
+                try:
+                    variant.decisions[claim_id] = future.result()
+                except Exception as e:
+                    logger.warning(
+                        f"Faced exception {e} for claim id {claim_id} in configuration {variant.config.name}. Skipping..."
+                    )
+    finally:
+        vision_executor.shutdown()
+        decision_executor.shutdown()
+
+    sweep_df = pd.DataFrame(
+        [write_variant_results(variant, graph) for variant in variants]
+    )
+    os.makedirs(results_root, exist_ok=True)
+    sweep_df.to_csv(os.path.join(results_root, "sweep.csv"), index=False)
+
+    stage_costs = graph.cost()
+    sweep_cost = {
+        "cost_usd": sum(stage_costs.values()),
+        "stage_cost_usd": stage_costs,
+        "attributed_cost_usd": float(sweep_df["cost_usd"].sum()),
+        "n_stage_requests": dict(graph.n_requested),
+        "n_stage_outputs": graph.n_computed(),
+    }
+    with open(os.path.join(results_root, "sweep_cost.json"), "w") as cost_file:
+        json.dump(sweep_cost, cost_file, indent=2)
+
+    logger.info(
+        f"Computed {sweep_cost['n_stage_outputs']} stage outputs for {sweep_cost['n_stage_requests']} requests, "
+        f"cost ${sweep_cost['cost_usd']:.4f} instead of ${sweep_cost['attributed_cost_usd']:.4f}"
+    )
+    print(sweep_df.to_string(index=False))
+    return sweep_df
+
+
+if __name__ == "__main__":
+    run_sweep(
+        build_config_grid(
+            model_name=["google/gemini-2.5-pro", "google/gemini-2.5-flash"],
+            check_authenticity=[True, False],
+            use_ocr=[True, False],
+            authenticity_thresholds=[[1, 2, 3]],
+        )
+    )
@@ -0,0 +1,438 @@
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+from openai import BaseModel, OpenAI
+from openai.types.chat import ChatCompletion
+
+from claim_processing.constants import (
+    BATCH_API_BACKEND,
+    BATCH_API_KEY,
+    BATCH_API_URL,
+    BATCH_DIRECTORY,
+    BATCH_LOCAL_WORKERS,
+    BATCH_MAX_BYTES,
+    BATCH_MAX_REQUESTS,
+    BATCH_MODEL_NAMES,
+    BATCH_POLL_INTERVAL_SECONDS,
+    BATCH_PRICE_FACTOR,
+)
+from claim_processing.utils.metrics import record_model_call
+from claim_processing.utils.openai_utils import (
+    get_api_key,
+    get_http_client,
+    get_http_timeout,
+    get_openai_client,
+    get_token_usage,
+)
+from claim_processing.utils.rate_limit import estimate_tokens, get_model_call_scheduler
+
+logger = logging.getLogger()
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def build_response_format(response_format: BaseModel) -> Dict:
+    """JSON schema response format of a structured output model, as sent by `chat.completions.parse`."""
+    schema = response_format.model_json_schema()
+    # Strict structured outputs only accept closed objects
+    for object_schema in [schema, *schema.get("$defs", {}).values()]:
+        if object_schema.get("type") == "object":
+            object_schema["additionalProperties"] = False
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_format.__name__,
+            "schema": schema,
+            "strict": True,
+        },
+    }
+
+
+def build_batch_request(
+    custom_id: str,
+    model: str,
+    messages: List[Dict],
+    response_format: Optional[BaseModel] = None,
+) -> Dict:
+    """One line of a batch input file, a chat completion request with the same body as a regular call."""
+    body = {"model": model, "messages": messages}
+    if response_format is not None:
+        body["response_format"] = build_response_format(response_format)
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": body,
+    }
+
+
+def is_successful(result: Dict) -> bool:
+    return (
+        result.get("error") is None
+        and result.get("response") is not None
+        and result["response"]["status_code"] == 200
+    )
+
+
+def read_jsonl(path: str) -> List[Dict]:
+    """Lines of a JSONL file, skipping a last line that was cut off by an interruption."""
+    if not os.path.exists(path):
+        return []
+    lines = []
+    with open(path, "r") as jsonl_file:
+        for line in jsonl_file:
+            try:
+                lines.append(json.loads(line))
+            except ValueError:
+                continue
+    return lines
+
+
+def open_for_append(path: str):
+    """Open a JSONL file for appending, ending a last line that was cut off by an interruption."""
+    jsonl_file = open(path, "a")
+    if jsonl_file.tell() > 0:
+        with open(path, "rb") as existing_file:
+            existing_file.seek(-1, os.SEEK_END)
+            if existing_file.read(1) != b"\n":
+                jsonl_file.write("\n")
+    return jsonl_file
+
+
+def get_response_content(result: Dict) -> str:
+    return result["response"]["body"]["choices"][0]["message"]["content"]
+
+
+class BatchBackend(ABC):
+    # Fraction of the regular price that batch requests are billed at
+    price_factor: float = 1.0
+
+    def get_model_name(self, model: str) -> str:
+        """Name of `model` in the backend, raises a ValueError for a model the backend does not serve."""
+        return model
+
+    @abstractmethod
+    def submit(self, input_path: str) -> str:
+        """Submit a JSONL file of requests, returns the batch id."""
+        pass
+
+    @abstractmethod
+    def get_status(self, batch_id: str) -> str:
+        pass
+
+    @abstractmethod
+    def download(self, batch_id: str) -> List[Dict]:
+        """Result lines of a finished batch, including the requests that failed."""
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """Batch interface of an OpenAI compatible provider: upload, poll and download."""
+
+    price_factor = BATCH_PRICE_FACTOR
+
+    def __init__(
+        self,
+        base_url: str = BATCH_API_URL,
+        api_key: Optional[str] = None,
+        model_names: Optional[Dict[str, str]] = None,
+    ):
+        self.client = OpenAI(
+            base_url=base_url,
+            api_key=api_key or BATCH_API_KEY or get_api_key(),
+            timeout=get_http_timeout(),
+            http_client=get_http_client(),
+        )
+        self.model_names = model_names if model_names is not None else BATCH_MODEL_NAMES
+
+    def get_model_name(self, model: str) -> str:
+        # Model names are OpenRouter ids, only the "openai/" ones exist in the OpenAI API
+        if model in self.model_names:
+            return self.model_names[model]
+        if model.startswith("openai/"):
+            return model.removeprefix("openai/")
+        raise ValueError(
+            f"Model {model} is not served by the batch API at {self.client.base_url}, "
+            "add its name there to BATCH_MODEL_NAMES"
+        )
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as input_file:
+            uploaded_file = self.client.files.create(file=input_file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def get_status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id: str) -> List[Dict]:
+        batch = self.client.batches.retrieve(batch_id)
+        results = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = self.client.files.content(file_id).text
+                results.extend(
+                    json.loads(line) for line in content.splitlines() if line.strip()
+                )
+        return results
+
+
+class LocalBatchBackend(BatchBackend):
+    """File-based stand-in for a provider batch interface.
+
+    Every batch is a directory with an input and an output file. The requests
+    are sent through the regular client when the batch is polled, and results
+    are appended as they come in, so an interrupted batch continues where it stopped.
+    """
+
+    def __init__(
+        self,
+        directory: str = os.path.join(BATCH_DIRECTORY, "local"),
+        max_workers: int = BATCH_LOCAL_WORKERS,
+    ):
+        self.directory = directory
+        self.max_workers = max_workers
+
+    def _batch_path(self, batch_id: str, file_name: str) -> str:
+        return os.path.join(self.directory, batch_id, file_name)
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.directory, batch_id))
+        shutil.copyfile(input_path, self._batch_path(batch_id, "input.jsonl"))
+        return batch_id
+
+    def get_status(self, batch_id: str) -> str:
+        if not os.path.exists(self._batch_path(batch_id, "input.jsonl")):
+            return "failed"
+        self._run(batch_id)
+        return "completed"
+
+    def download(self, batch_id: str) -> List[Dict]:
+        return read_jsonl(self._batch_path(batch_id, "output.jsonl"))
+
+    def _run(self, batch_id: str):
+        completed_ids = {result["custom_id"] for result in self.download(batch_id)}
+        with open(self._batch_path(batch_id, "input.jsonl"), "r") as input_file:
+            requests = [
+                request
+                for request in map(json.loads, filter(str.strip, input_file))
+                if request["custom_id"] not in completed_ids
+            ]
+        if not requests:
+            return
+
+        logger.info(f"Sending {len(requests)} requests of local batch {batch_id}")
+        with (
+            open_for_append(self._batch_path(batch_id, "output.jsonl")) as output_file,
+            ThreadPoolExecutor(max_workers=self.max_workers) as executor,
+        ):
+            futures = [executor.submit(self._send, request) for request in requests]
+            for future in as_completed(futures):
+                output_file.write(json.dumps(future.result()) + "\n")
+                output_file.flush()
+
+    @staticmethod
+    def _send(request: Dict) -> Dict:
+        body = request["body"]
+        client = get_openai_client()
+        try:
+            # Usage is recorded once the results are collected, like for provider batches
+            response = get_model_call_scheduler().call(
+                body["model"],
+                lambda: client.chat.completions.create(**body),
+                estimated_tokens=estimate_tokens(body["messages"]),
+            )
+        except Exception as e:
+            return {
+                "custom_id": request["custom_id"],
+                "response": None,
+                "error": {"message": str(e)},
+            }
+        return {
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200, "body": response.model_dump()},
+            "error": None,
+        }
+
+
+@lru_cache(maxsize=1)
+def get_batch_backend(backend: str = BATCH_API_BACKEND) -> BatchBackend:
+    if backend == "openai":
+        return OpenAIBatchBackend()
+    elif backend == "local":
+        return LocalBatchBackend()
+    raise ValueError(f"Unsupported batch backend: {backend}")
+
+
+class BatchJob:
+    """Requests sent through a batch backend, checkpointed to a directory.
+
+    Submitted batches are saved before they are polled and results as soon as
+    a batch is downloaded. A job started again with the same directory resumes:
+    it polls the batches that are still running and only submits the requests
+    that have no result yet, including those that failed before. Results that
+    `is_valid` rejects count as failed, so they are submitted again on resume.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        backend: BatchBackend,
+        max_requests: int = BATCH_MAX_REQUESTS,
+        max_bytes: int = BATCH_MAX_BYTES,
+        poll_interval_seconds: float = BATCH_POLL_INTERVAL_SECONDS,
+        is_valid: Optional[Callable[[Dict], bool]] = None,
+    ):
+        self.directory = directory
+        self.backend = backend
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.poll_interval_seconds = poll_interval_seconds
+        self.is_valid = is_valid
+        self.state_path = os.path.join(directory, "state.json")
+        self.results_path = os.path.join(directory, "results.jsonl")
+        os.makedirs(directory, exist_ok=True)
+
+    def _load_state(self) -> Dict:
+        if not os.path.exists(self.state_path):
+            return {"batches": []}
+        with open(self.state_path, "r") as state_file:
+            return json.load(state_file)
+
+    def _save_state(self, state: Dict):
+        # Written to a temporary file first, so an interrupted write keeps the previous checkpoint
+        temporary_path = self.state_path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temporary_path, self.state_path)
+
+    def _is_usable(self, result: Dict) -> bool:
+        return is_successful(result) and (
+            self.is_valid is None or self.is_valid(result)
+        )
+
+    def _load_results(self) -> Dict[str, Dict]:
+        # Results saved before they were validated are dropped, so they are submitted again
+        return {
+            result["custom_id"]: result
+            for result in read_jsonl(self.results_path)
+            if self._is_usable(result)
+        }
+
+    def _submit(self, state: Dict, request_builders: Dict[str, Callable[[], Dict]]):
+        """Write the requests to input files of at most `max_requests` and `max_bytes` and submit them."""
+        input_file, input_path, custom_ids, n_bytes = None, None, [], 0
+
+        def submit_input_file():
+            input_file.close()
+            batch_id = self.backend.submit(input_path)
+            state["batches"].append(
+                {"id": batch_id, "custom_ids": custom_ids, "status": "submitted"}
+            )
+            self._save_state(state)
+            logger.info(f"Submitted batch {batch_id} with {len(custom_ids)} requests")
+
+        for custom_id, build_request in request_builders.items():
+            line = json.dumps(build_request()) + "\n"
+            if input_file is not None and (
+                len(custom_ids) >= self.max_requests
+                or n_bytes + len(line) > self.max_bytes
+            ):
+                submit_input_file()
+                input_file = None
+            if input_file is None:
+                input_path = os.path.join(
+                    self.directory, f"input_{len(state['batches']):05d}.jsonl"
+                )
+                input_file = open(input_path, "w")
+                custom_ids, n_bytes = [], 0
+            input_file.write(line)
+            custom_ids.append(custom_id)
+            n_bytes += len(line)
+        if input_file is not None:
+            submit_input_file()
+
+    def _collect(self, batch: Dict, results: Dict[str, Dict]):
+        n_failed = 0
+        with open_for_append(self.results_path) as results_file:
+            for result in self.backend.download(batch["id"]):
+                if result["custom_id"] in results:
+                    continue
+                # Failed requests are not saved, so they are submitted again on resume
+                if not self._is_usable(result):
+                    n_failed += 1
+                    continue
+                results[result["custom_id"]] = result
+                results_file.write(json.dumps(result) + "\n")
+                response = ChatCompletion.model_validate(result["response"]["body"])
+                record_model_call(
+                    response.model,
+                    get_token_usage(response),
+                    seconds=None,
+                    price_factor=self.backend.price_factor,
+                )
+        if n_failed:
+            logger.warning(f"{n_failed} requests of batch {batch['id']} failed")
+
+    def run(self, request_builders: Dict[str, Callable[[], Dict]]) -> Dict[str, Dict]:
+        """Successful results by custom id, requests are only built when they are submitted."""
+        state = self._load_state()
+        results = self._load_results()
+
+        running_batches = [
+            batch
+            for batch in state["batches"]
+            if batch["status"] not in FINAL_BATCH_STATUSES
+        ]
+        running_ids = {
+            custom_id for batch in running_batches for custom_id in batch["custom_ids"]
+        }
+        new_request_builders = {
+            custom_id: build_request
+            for custom_id, build_request in request_builders.items()
+            if custom_id not in results and custom_id not in running_ids
+        }
+        n_done = sum(custom_id in results for custom_id in request_builders)
+        logger.info(
+            f"Batch job {self.directory}: {n_done} requests done, "
+            f"{len(running_ids)} running, {len(new_request_builders)} to submit"
+        )
+        n_batches = len(state["batches"])
+        self._submit(state, new_request_builders)
+        running_batches.extend(state["batches"][n_batches:])
+
+        while running_batches:
+            for batch in list(running_batches):
+                status = self.backend.get_status(batch["id"])
+                if status not in FINAL_BATCH_STATUSES:
+                    continue
+                if status != "completed":
+                    logger.warning(f"Batch {batch['id']} ended with status {status}")
+                # Expired and cancelled batches keep the results of finished requests
+                if status != "failed":
+                    self._collect(batch, results)
+                batch["status"] = status
+                running_batches.remove(batch)
+                self._save_state(state)
+            if running_batches:
+                time.sleep(self.poll_interval_seconds)
+
+        return {
+            custom_id: results[custom_id]
+            for custom_id in request_builders
+            if custom_id in results
+        }
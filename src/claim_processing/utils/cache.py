@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Union
+
+from claim_processing.constants import CACHE_SIZE_SYNC_INTERVAL
+
+logger = logging.getLogger()
+
+
+def make_cache_key(*parts: Union[str, bytes]) -> str:
+    """Hash the given parts into a single content-addressed key."""
+    key_hash = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        # Length prefix each part so ("ab", "c") and ("a", "bc") get different keys
+        key_hash.update(len(part).to_bytes(8, "big"))
+        key_hash.update(part)
+    return key_hash.hexdigest()
+
+
+class DiskCache:
+    """Persistent SQLite-backed key-value cache with size-based LRU eviction.
+
+    Entries older than `ttl_seconds` are treated as missing, if a TTL is given.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: Optional[float] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL DEFAULT 0,
+                last_accessed REAL NOT NULL
+            )
+            """
+        )
+        columns = [
+            row[1] for row in self._connection.execute("PRAGMA table_info(cache)")
+        ]
+        if "created_at" not in columns:
+            # Caches created before TTL support are missing the creation time
+            self._connection.execute(
+                "ALTER TABLE cache ADD COLUMN created_at REAL NOT NULL DEFAULT 0"
+            )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_last_accessed ON cache (last_accessed)"
+        )
+        self._connection.commit()
+        self._n_writes = 0
+        self._total_size = self._read_total_size()
+
+    def _read_total_size(self) -> int:
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at, size FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if self.ttl_seconds is not None and time.time() - row[1] > self.ttl_seconds:
+                self.misses += 1
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._connection.commit()
+                self._total_size -= row[2]
+                return None
+            self.hits += 1
+            self._connection.execute(
+                "UPDATE cache SET last_accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._connection.commit()
+            return row[0]
+
+    def set(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            now = time.time()
+            replaced_row = self._connection.execute(
+                "SELECT size FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, created_at, last_accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._n_writes += 1
+            if self._n_writes % CACHE_SIZE_SYNC_INTERVAL == 0:
+                self._total_size = self._read_total_size()
+            else:
+                self._total_size += size - (replaced_row[0] if replaced_row else 0)
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        total_size = self._total_size
+        if total_size <= self.max_bytes:
+            return
+
+        # Walk entries from least to most recently used until enough space is freed
+        keys_to_evict = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM cache ORDER BY last_accessed ASC"
+        ):
+            if total_size <= self.max_bytes:
+                break
+            keys_to_evict.append((key,))
+            total_size -= size
+        self._connection.executemany("DELETE FROM cache WHERE key = ?", keys_to_evict)
+        self._total_size = total_size
+        logger.info(f"Evicted {len(keys_to_evict)} entries from cache {self.path}")
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache")
+            self._connection.commit()
+            self._total_size = 0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            n_entries, total_size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+            ).fetchone()
+        n_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+            "entries": n_entries,
+            "size_bytes": total_size,
+        }
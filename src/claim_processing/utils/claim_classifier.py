@@ -0,0 +1,155 @@
+import json
+import logging
+import re
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict
+
+from claim_processing.constants import (
+    CLAIM_ROUTES,
+    DEFAULT_CLAIM_ROUTE,
+    ROUTER_CLASSIFIER,
+    ROUTER_MODEL_NAME,
+)
+from claim_processing.prompts import CLAIM_CLASSIFICATION_PROMPT, CLAIM_PROMPT
+from claim_processing.pydantic_models import Claim, ClaimClassification
+from claim_processing.utils.cache import make_cache_key
+from claim_processing.utils.openai_utils import create_chat_completion, get_token_usage
+
+logger = logging.getLogger()
+
+
+class ClaimClassifier(ABC):
+    def __init__(
+        self,
+        routes: Dict[str, Dict] = CLAIM_ROUTES,
+        default_route: str = DEFAULT_CLAIM_ROUTE,
+    ):
+        self.routes = routes
+        self.default_route = default_route
+
+    @abstractmethod
+    def classify_claim(self, claim: Claim) -> str:
+        """One of the routes, or the default route when the claim fits none of them."""
+        pass
+
+    def fingerprint(self) -> str:
+        return make_cache_key(type(self).__name__, json.dumps(sorted(self.routes)))
+
+    def usage_summary(self) -> Dict[str, int]:
+        """Token usage of the classification requests, empty for classifiers without model calls."""
+        return {}
+
+
+class KeywordClaimClassifier(ClaimClassifier):
+    """Picks the route whose keywords occur most often in the claim, ties go to the first route."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.patterns = {
+            route: re.compile(
+                r"\b("
+                + "|".join(re.escape(keyword.lower()) for keyword in config["keywords"])
+                + r")\b"
+            )
+            for route, config in self.routes.items()
+            if config["keywords"]
+        }
+
+    def classify_claim(self, claim: Claim) -> str:
+        claim_text = " ".join(
+            [claim.description.content, *map(str, claim.supporting_documents)]
+        ).lower()
+        counts = {
+            route: len(pattern.findall(claim_text))
+            for route, pattern in self.patterns.items()
+        }
+        best_route = max(counts, key=counts.get, default=None)
+        if best_route is None or counts[best_route] == 0:
+            return self.default_route
+        return best_route
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            json.dumps(
+                {route: config["keywords"] for route, config in self.routes.items()}
+            ),
+        )
+
+
+class LLMClaimClassifier(ClaimClassifier):
+    """Asks a fast model for the claim type."""
+
+    def __init__(self, model_name: str = ROUTER_MODEL_NAME, **kwargs):
+        super().__init__(**kwargs)
+        self.model_name = model_name
+        self.n_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._token_usage_lock = threading.Lock()
+
+    def classify_claim(self, claim: Claim) -> str:
+        response = create_chat_completion(
+            model=self.model_name,
+            messages=[
+                {
+                    "role": "system",
+                    "content": CLAIM_CLASSIFICATION_PROMPT.format(
+                        claim_types=", ".join([*self.routes, self.default_route]),
+                        default_claim_type=self.default_route,
+                    ),
+                },
+                {
+                    "role": "user",
+                    "content": CLAIM_PROMPT.format(
+                        claim_description=claim.description.content,
+                        claim_supporting_documents=claim.supporting_documents,
+                    ),
+                },
+            ],
+            response_format=ClaimClassification,
+        )
+        token_usage = get_token_usage(response)
+        with self._token_usage_lock:
+            self.n_calls += 1
+            self.input_tokens += token_usage.input_tokens
+            self.output_tokens += token_usage.output_tokens
+        claim_type = (
+            ClaimClassification.model_validate_json(response.choices[0].message.content)
+            .claim_type.strip()
+            .lower()
+        )
+        if claim_type not in self.routes:
+            if claim_type != self.default_route:
+                logger.warning(
+                    f"Unknown claim type {claim_type} for claim {claim.claim_id}, using {self.default_route}"
+                )
+            return self.default_route
+        return claim_type
+
+    def usage_summary(self) -> Dict[str, int]:
+        with self._token_usage_lock:
+            return {
+                "n_calls": self.n_calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+            }
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            self.model_name,
+            json.dumps(sorted(self.routes)),
+            CLAIM_CLASSIFICATION_PROMPT,
+        )
+
+
+def get_claim_classifier(
+    classifier: str = ROUTER_CLASSIFIER, **kwargs
+) -> ClaimClassifier:
+    if classifier == "keyword":
+        return KeywordClaimClassifier(**kwargs)
+    if classifier == "llm":
+        return LLMClaimClassifier(**kwargs)
+    raise ValueError(f"Unknown claim classifier {classifier}")
@@ -0,0 +1,247 @@
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from claim_processing.constants import (
+    BASE64_DECODE_CHUNK_SIZE,
+    CLAIM_STORE_DIRECTORY,
+    FILES_TO_EXCLUDE,
+    IMAGE_DOCUMENT_EXTENSIONS,
+    MAX_DOCUMENT_BYTES,
+    TEXT_DOCUMENT_EXTENSIONS,
+)
+from claim_processing.pydantic_models import DocumentUpload, StoredDocument
+
+logger = logging.getLogger()
+
+
+def validate_document_names(supporting_documents: List[DocumentUpload]):
+    """Reject uploads that would fail when the claim is loaded, before anything is stored."""
+    file_names = set()
+    for supporting_doc in supporting_documents:
+        file_name = os.path.basename(supporting_doc.file_name)
+        if file_name in FILES_TO_EXCLUDE:
+            raise HTTPException(
+                status_code=422, detail=f"Document name {file_name} is reserved"
+            )
+        if not file_name.endswith(TEXT_DOCUMENT_EXTENSIONS + IMAGE_DOCUMENT_EXTENSIONS):
+            raise HTTPException(
+                status_code=422,
+                detail=f"Document {file_name} has an unsupported file type, supported are "
+                + ", ".join(TEXT_DOCUMENT_EXTENSIONS + IMAGE_DOCUMENT_EXTENSIONS),
+            )
+        if file_name in file_names:
+            raise HTTPException(
+                status_code=422, detail=f"Document name {file_name} is used twice"
+            )
+        file_names.add(file_name)
+
+
+class ClaimStore:
+    """Stores uploaded claims as content-addressed blobs plus a SQLite metadata index.
+
+    Every unique document is written once to `blobs/<sha256>`, regardless of how
+    many claims it is attached to.
+    """
+
+    def __init__(self, directory: str = CLAIM_STORE_DIRECTORY):
+        self.directory = directory
+        self.blob_directory = os.path.join(directory, "blobs")
+        os.makedirs(self.blob_directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"), check_same_thread=False, timeout=30
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS claims (
+                claim_id INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS claim_documents (
+                claim_id INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                blob_hash TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                PRIMARY KEY (claim_id, file_name)
+            )
+            """
+        )
+        self._connection.commit()
+
+    def blob_path(self, blob_hash: str) -> str:
+        return os.path.join(self.blob_directory, blob_hash)
+
+    def write_blob(self, document: DocumentUpload) -> Tuple[str, int, bool]:
+        """Decode a base64 document in chunks into a blob, returns the blob hash, size and whether the blob is new."""
+        base64_bytes = document.document_bytes
+        # Base64 encodes 3 bytes in 4 characters, reject oversized documents up front
+        if len(base64_bytes) * 3 // 4 > MAX_DOCUMENT_BYTES + 3:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Document {document.file_name} exceeds the maximum size of {MAX_DOCUMENT_BYTES} bytes",
+            )
+
+        blob_hash = hashlib.sha256()
+        size = 0
+        remainder = b""
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.blob_directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                for start in range(0, len(base64_bytes), BASE64_DECODE_CHUNK_SIZE):
+                    chunk = remainder + bytes(
+                        base64_bytes[start : start + BASE64_DECODE_CHUNK_SIZE]
+                    ).translate(None, b" \t\r\n")
+                    # Only decode complete 4 character groups, carry over the rest
+                    n_complete = len(chunk) - len(chunk) % 4
+                    try:
+                        decoded = base64.b64decode(chunk[:n_complete])
+                    except binascii.Error:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Document {document.file_name} is not valid base64",
+                        )
+                    remainder = chunk[n_complete:]
+                    blob_hash.update(decoded)
+                    temp_file.write(decoded)
+                    size += len(decoded)
+                if remainder:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Document {document.file_name} is not valid base64",
+                    )
+
+            blob_path = self.blob_path(blob_hash.hexdigest())
+            is_new = not os.path.exists(blob_path)
+            if is_new:
+                # Rename is atomic, readers never see a partially written blob
+                os.replace(temp_path, blob_path)
+            else:
+                os.remove(temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return blob_hash.hexdigest(), size, is_new
+
+    def remove_unreferenced_blobs(self, blob_hashes: List[str]):
+        """Remove blobs of a failed submission, unless a stored claim references them."""
+        with self._lock:
+            for blob_hash in blob_hashes:
+                row = self._connection.execute(
+                    "SELECT 1 FROM claim_documents WHERE blob_hash = ?", (blob_hash,)
+                ).fetchone()
+                if row is None and os.path.exists(self.blob_path(blob_hash)):
+                    os.remove(self.blob_path(blob_hash))
+
+    def add_claim(
+        self,
+        claim_id: int,
+        description_text: str,
+        supporting_documents: List[DocumentUpload],
+    ):
+        validate_document_names(supporting_documents)
+        if self.has_claim(claim_id):
+            raise HTTPException(
+                status_code=500,
+                detail="Claim submission failed, claim id already exists",
+            )
+
+        document_rows = []
+        new_blob_hashes = []
+        try:
+            for supporting_doc in supporting_documents:
+                blob_hash, size, is_new = self.write_blob(supporting_doc)
+                if is_new:
+                    new_blob_hashes.append(blob_hash)
+                document_rows.append(
+                    (
+                        claim_id,
+                        os.path.basename(supporting_doc.file_name),
+                        blob_hash,
+                        size,
+                    )
+                )
+
+            # Blobs are written first, the claim only becomes visible once it is fully indexed
+            with self._lock:
+                try:
+                    with self._connection:
+                        self._connection.execute(
+                            "INSERT INTO claims VALUES (?, ?, ?)",
+                            (claim_id, description_text, time.time()),
+                        )
+                        self._connection.executemany(
+                            "INSERT INTO claim_documents VALUES (?, ?, ?, ?)",
+                            document_rows,
+                        )
+                except sqlite3.IntegrityError:
+                    raise HTTPException(
+                        status_code=500,
+                        detail="Claim submission failed, claim id already exists",
+                    )
+        except BaseException:
+            # Blobs this submission created would otherwise stay on disk unreferenced
+            self.remove_unreferenced_blobs(new_blob_hashes)
+            raise
+
+    def has_claim(self, claim_id: int) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM claims WHERE claim_id = ?", (claim_id,)
+            ).fetchone()
+        return row is not None
+
+    def get_claim(self, claim_id: int) -> Optional[Tuple[str, List[StoredDocument]]]:
+        """Return the description and documents of a claim, or None if it is not stored."""
+        with self._lock:
+            claim_row = self._connection.execute(
+                "SELECT description FROM claims WHERE claim_id = ?", (claim_id,)
+            ).fetchone()
+            if claim_row is None:
+                return None
+            document_rows = self._connection.execute(
+                "SELECT file_name, blob_hash, size_bytes FROM claim_documents WHERE claim_id = ? ORDER BY file_name",
+                (claim_id,),
+            ).fetchall()
+        documents = [
+            StoredDocument(
+                file_name=file_name,
+                blob_hash=blob_hash,
+                path=self.blob_path(blob_hash),
+                size_bytes=size_bytes,
+            )
+            for file_name, blob_hash, size_bytes in document_rows
+        ]
+        return claim_row[0], documents
+
+    def list_claim_ids(self) -> List[int]:
+        with self._lock:
+            return [
+                row[0]
+                for row in self._connection.execute(
+                    "SELECT claim_id FROM claims ORDER BY claim_id"
+                )
+            ]
+
+
+@lru_cache(maxsize=1)
+def get_claim_store() -> ClaimStore:
+    return ClaimStore()
@@ -1,13 +1,82 @@
 import json
+import logging
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Literal
+from functools import lru_cache
+from typing import Dict, List, Literal, Optional, Type, Union
 
-from openai import OpenAI
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel
 
-from claim_processing.constants import MODEL_API_KEY, MODEL_API_URL, MODEL_NAME
-from claim_processing.prompts import ADVANCED_LLM_SYSTEM_PROMPT, CLAIM_PROMPT
-from claim_processing.pydantic_models import Claim, ClaimDecision
+from claim_processing.constants import (
+    BATCH_DIRECTORY,
+    BATCH_POLL_INTERVAL_SECONDS,
+    CASCADE_ESCALATE_DECISIONS,
+    CASCADE_ESCALATION_KEYWORDS,
+    CASCADE_FAST_MODEL_NAME,
+    CASCADE_MIN_CONFIDENCE,
+    CLAIM_ROUTES,
+    DECISION_CACHE_MAX_BYTES,
+    DECISION_CACHE_PATH,
+    DECISION_CACHE_TTL_SECONDS,
+    DEFAULT_CLAIM_ROUTE,
+    GENERAL_POLICY_SECTIONS,
+    MODEL_NAME,
+    POLICY_RETRIEVER,
+    POLICY_TOP_K,
+    REPORT_POLICY_TOKENS_SAVED,
+    ROUTER_CLASSIFIER,
+    STREAM_DECISION_TOKENS,
+    USE_DECISION_CACHE,
+    USE_PROMPT_CACHE_CONTROL,
+)
+from claim_processing.prompts import (
+    ADVANCED_LLM_SYSTEM_PROMPT,
+    CLAIM_PROMPT,
+    CONFIDENCE_LLM_SYSTEM_PROMPT,
+    POLICY_PROMPT,
+)
+from claim_processing.pydantic_models import (
+    Claim,
+    ClaimDecision,
+    ConfidentClaimDecision,
+    Document,
+    TokenUsage,
+)
+from claim_processing.utils.batch_api import (
+    BatchBackend,
+    BatchJob,
+    build_batch_request,
+    get_batch_backend,
+    get_response_content,
+)
+from claim_processing.utils.cache import DiskCache, make_cache_key
+from claim_processing.utils.claim_classifier import (
+    ClaimClassifier,
+    get_claim_classifier,
+)
+from claim_processing.utils.events import emit_event, is_listening
 from claim_processing.utils.load import load_policy
+from claim_processing.utils.metrics import (
+    get_current_trace,
+    get_metrics_registry,
+    record_cache_lookup,
+)
+from claim_processing.utils.openai_utils import (
+    create_chat_completion,
+    create_chat_completion_stream,
+    get_token_usage,
+)
+from claim_processing.utils.policy import (
+    build_policy_document,
+    select_policy_sections,
+    split_policy_sections,
+)
+from claim_processing.utils.policy_retrieval import get_policy_retriever
+
+logger = logging.getLogger()
 
 
 class DecisionEngine(ABC):
@@ -15,6 +84,10 @@ class DecisionEngine(ABC):
     def decide_claim(self, claim: Claim) -> ClaimDecision:
         pass
 
+    def fingerprint(self) -> str:
+        """Hash of everything, apart from the claim, that can change the decisions."""
+        return make_cache_key(type(self).__name__)
+
 
 class DummyDecisionEngine(DecisionEngine):
     def __init__(self, decision: Literal["APPROVE", "DENY", "UNCERTAIN"]):
@@ -25,35 +98,502 @@ class DummyDecisionEngine(DecisionEngine):
             decision=self.decision, reasoning="Policy covers the claim"
         )
 
+    def fingerprint(self) -> str:
+        return make_cache_key(type(self).__name__, self.decision)
+
+
+@lru_cache(maxsize=1)
+def get_decision_cache() -> DiskCache:
+    return DiskCache(
+        DECISION_CACHE_PATH,
+        max_bytes=DECISION_CACHE_MAX_BYTES,
+        ttl_seconds=DECISION_CACHE_TTL_SECONDS,
+    )
+
 
 class SimpleLLMDecisionEngine(DecisionEngine):
-    def __init__(self):
-        self.policy = load_policy()
-        # self.system_prompt = SIMPLE_LLM_SYSTEM_PROMPT
-        self.system_prompt = ADVANCED_LLM_SYSTEM_PROMPT
-        self.model_name = MODEL_NAME
-        self.client = OpenAI(
-            base_url=MODEL_API_URL,
-            api_key=MODEL_API_KEY,
+    def __init__(
+        self,
+        use_prompt_cache_control: bool = USE_PROMPT_CACHE_CONTROL,
+        use_cache: bool = USE_DECISION_CACHE,
+        model_name: str = MODEL_NAME,
+        system_prompt: str = ADVANCED_LLM_SYSTEM_PROMPT,
+        response_format: Type[BaseModel] = ClaimDecision,
+        policy: Optional[Document] = None,
+        policy_retriever: Optional[str] = POLICY_RETRIEVER,
+        policy_top_k: int = POLICY_TOP_K,
+        report_policy_tokens_saved: bool = REPORT_POLICY_TOKENS_SAVED,
+        stream_tokens: bool = STREAM_DECISION_TOKENS,
+    ):
+        self.policy = policy or load_policy()
+        # The policy index is built once here, requests only get the sections retrieved for their claim
+        self.policy_retriever = None
+        if policy_retriever is not None:
+            sections = split_policy_sections(self.policy)
+            self.policy_retriever = get_policy_retriever(sections, policy_retriever)
+            # Sections every claim needs, like definitions and exclusions, are always sent
+            self.pinned_policy_sections = select_policy_sections(
+                sections, GENERAL_POLICY_SECTIONS
+            )
+        self.policy_top_k = policy_top_k
+        self.report_policy_tokens_saved = report_policy_tokens_saved
+        self.system_prompt = system_prompt
+        self.model_name = model_name
+        self.response_format = response_format
+        self.use_prompt_cache_control = use_prompt_cache_control
+        self.use_cache = use_cache
+        self.stream_tokens = stream_tokens
+        # Running totals, the engine is long-lived in the API
+        self.n_calls = 0
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+        self.policy_tokens_saved = 0
+        self._token_usage_lock = threading.Lock()
+
+    def get_claim_policy(self, claim: Claim) -> Document:
+        """The policy sent with a claim, only its most relevant sections when a retriever is set."""
+        if self.policy_retriever is None:
+            return self.policy
+        retrieved_sections = self.policy_retriever.retrieve(
+            " ".join(
+                [claim.description.content, *map(str, claim.supporting_documents)]
+            ),
+            self.policy_top_k,
         )
+        policy = build_policy_document(
+            [
+                section
+                for section in self.policy_retriever.sections
+                if section in retrieved_sections
+                or section in self.pinned_policy_sections
+            ]
+        )
+        if self.report_policy_tokens_saved:
+            tokens_saved = (len(self.policy.content) - len(policy.content)) // 4
+            logger.info(
+                f"Policy retrieval saved about {tokens_saved} input tokens for claim {claim.claim_id}"
+            )
+            get_metrics_registry().inc("policy_tokens_saved_total", tokens_saved)
+            with self._token_usage_lock:
+                self.policy_tokens_saved += tokens_saved
+        return policy
 
-    def decide_claim(self, claim: Claim) -> ClaimDecision:
-        response = self.client.chat.completions.parse(
-            model=self.model_name,
-            messages=[
-                {"role": "system", "content": self.system_prompt},
-                {
-                    "role": "user",
-                    "content": CLAIM_PROMPT.format(
-                        claim_description=claim.description.content,
-                        claim_supporting_documents=claim.supporting_documents,
-                        policy=self.policy.content,
-                    ),
-                },
-            ],
-            response_format=ClaimDecision,
+    def build_messages(self, claim: Claim) -> List[Dict]:
+        # The system prompt, and the full policy when no retriever is set, are identical
+        # for every claim and form the prefix of the request, so the provider can serve
+        # them from its prompt cache. Retrieved sections differ per claim and are not marked
+        system_part = {"type": "text", "text": self.system_prompt}
+        policy_part = {
+            "type": "text",
+            "text": POLICY_PROMPT.format(policy=self.get_claim_policy(claim).content),
+        }
+        if self.use_prompt_cache_control:
+            cached_part = system_part if self.policy_retriever else policy_part
+            cached_part["cache_control"] = {"type": "ephemeral"}
+        return [
+            {"role": "system", "content": [system_part, policy_part]},
+            {
+                "role": "user",
+                "content": CLAIM_PROMPT.format(
+                    claim_description=claim.description.content,
+                    claim_supporting_documents=claim.supporting_documents,
+                ),
+            },
+        ]
+
+    def fingerprint(self) -> str:
+        parts = [
+            type(self).__name__,
+            self.model_name,
+            self.system_prompt,
+            POLICY_PROMPT.format(policy=self.policy.content),
+            CLAIM_PROMPT,
+            json.dumps(self.response_format.model_json_schema(), sort_keys=True),
+        ]
+        if self.policy_retriever is not None:
+            parts += [
+                self.policy_retriever.fingerprint(),
+                json.dumps(
+                    [
+                        self.policy_top_k,
+                        [section.title for section in self.pinned_policy_sections],
+                    ]
+                ),
+            ]
+        return make_cache_key(*parts)
+
+    def get_cache_key(self, messages: List[Dict]) -> str:
+        return make_cache_key(
+            json.dumps(messages, sort_keys=True),
+            self.model_name,
+            json.dumps(self.response_format.model_json_schema(), sort_keys=True),
         )
-        response_json = json.loads(response.choices[0].message.content)
+
+    def request_response(self, claim: Claim, bypass_cache: bool = False) -> str:
+        """Structured response of the model as JSON, from the decision cache when available."""
+        messages = self.build_messages(claim)
+        use_cache = self.use_cache and not bypass_cache
+        if use_cache:
+            cache_key = self.get_cache_key(messages)
+            cached_response = get_decision_cache().get(cache_key)
+            record_cache_lookup("decision", hit=cached_response is not None)
+            if cached_response is not None:
+                logger.info(f"Using cached decision for claim {claim.claim_id}")
+                return cached_response
+
+        if self.stream_tokens and is_listening():
+            # The claim events get the decision as it is written
+            response = create_chat_completion_stream(
+                model=self.model_name,
+                messages=messages,
+                on_delta=lambda text: emit_event("decision_token", text=text),
+                response_format=self.response_format,
+            )
+        else:
+            response = create_chat_completion(
+                model=self.model_name,
+                messages=messages,
+                response_format=self.response_format,
+            )
+        self.record_token_usage(get_token_usage(response))
+        response_json = self.response_format.model_validate_json(
+            response.choices[0].message.content
+        ).model_dump_json()
+        if use_cache:
+            get_decision_cache().set(cache_key, response_json)
+        return response_json
+
+    def decide_claim(self, claim: Claim, bypass_cache: bool = False) -> ClaimDecision:
+        return self.parse_decision(self.request_response(claim, bypass_cache))
+
+    def parse_decision(self, content: str) -> ClaimDecision:
+        response_json = json.loads(content)
         return ClaimDecision(
             decision=response_json["decision"], reasoning=response_json["reasoning"]
         )
+
+    def record_token_usage(self, token_usage: TokenUsage):
+        logger.info(
+            f"Decision used {token_usage.input_tokens} input tokens "
+            f"({token_usage.cached_input_tokens} cached) and {token_usage.output_tokens} output tokens"
+        )
+        with self._token_usage_lock:
+            self.n_calls += 1
+            self.input_tokens += token_usage.input_tokens
+            self.cached_input_tokens += token_usage.cached_input_tokens
+            self.output_tokens += token_usage.output_tokens
+
+    def usage_summary(self) -> Dict[str, Union[int, float]]:
+        with self._token_usage_lock:
+            input_tokens = self.input_tokens
+            cached_input_tokens = self.cached_input_tokens
+            output_tokens = self.output_tokens
+            n_calls = self.n_calls
+            policy_tokens_saved = self.policy_tokens_saved
+        return {
+            "n_calls": n_calls,
+            "input_tokens": input_tokens,
+            "cached_input_tokens": cached_input_tokens,
+            "uncached_input_tokens": input_tokens - cached_input_tokens,
+            "cached_input_ratio": cached_input_tokens / input_tokens
+            if input_tokens
+            else 0.0,
+            "output_tokens": output_tokens,
+            "policy_tokens_saved": policy_tokens_saved,
+        }
+
+
+class CascadeDecisionEngine(DecisionEngine):
+    """Decides with a fast model first and escalates to the expensive model only when needed.
+
+    Claims flagged by a rule, e.g. with an unreadable document or one of
+    `escalation_keywords`, go straight to the expensive model. A fast decision
+    escalates when its confidence is below `min_confidence` or when it is one
+    of `escalate_decisions`. The tier that decided is recorded on the claim trace.
+    """
+
+    def __init__(
+        self,
+        fast_model_name: str = CASCADE_FAST_MODEL_NAME,
+        model_name: str = MODEL_NAME,
+        min_confidence: int = CASCADE_MIN_CONFIDENCE,
+        escalate_decisions: List[str] = CASCADE_ESCALATE_DECISIONS,
+        escalation_keywords: List[str] = CASCADE_ESCALATION_KEYWORDS,
+        system_prompt: str = ADVANCED_LLM_SYSTEM_PROMPT,
+        use_cache: bool = USE_DECISION_CACHE,
+    ):
+        self.fast_engine = SimpleLLMDecisionEngine(
+            model_name=fast_model_name,
+            system_prompt=CONFIDENCE_LLM_SYSTEM_PROMPT,
+            response_format=ConfidentClaimDecision,
+            use_cache=use_cache,
+        )
+        self.engine = SimpleLLMDecisionEngine(
+            model_name=model_name, system_prompt=system_prompt, use_cache=use_cache
+        )
+        self.min_confidence = min_confidence
+        self.escalate_decisions = escalate_decisions
+        self.escalation_keywords = [keyword.lower() for keyword in escalation_keywords]
+        self.tier_counts: Dict[str, int] = {"fast": 0, "escalated": 0}
+        self._tier_counts_lock = threading.Lock()
+
+    def flag_claim(self, claim: Claim) -> Optional[str]:
+        """Reason to send a claim straight to the expensive model, None to try the fast model first."""
+        claim_text = " ".join(
+            [claim.description.content, *map(str, claim.supporting_documents)]
+        )
+        if "Supporting document could not be read" in claim_text:
+            return "unreadable supporting document"
+        lowered_claim_text = claim_text.lower()
+        for keyword in self.escalation_keywords:
+            if keyword in lowered_claim_text:
+                return f"keyword {keyword}"
+        return None
+
+    def get_escalation_reason(
+        self, fast_decision: ConfidentClaimDecision
+    ) -> Optional[str]:
+        if fast_decision.decision in self.escalate_decisions:
+            return f"fast decision {fast_decision.decision}"
+        if fast_decision.confidence < self.min_confidence:
+            return f"confidence {fast_decision.confidence}"
+        return None
+
+    def decide_claim(self, claim: Claim) -> ClaimDecision:
+        escalation_reason = self.flag_claim(claim)
+        if escalation_reason is None:
+            fast_decision = ConfidentClaimDecision.model_validate_json(
+                self.fast_engine.request_response(claim)
+            )
+            escalation_reason = self.get_escalation_reason(fast_decision)
+
+        if escalation_reason is None:
+            tier = "fast"
+            decision = ClaimDecision(
+                reasoning=fast_decision.reasoning, decision=fast_decision.decision
+            )
+        else:
+            tier = "escalated"
+            logger.info(
+                f"Escalating claim {claim.claim_id} to {self.engine.model_name}: {escalation_reason}"
+            )
+            decision = self.engine.decide_claim(claim)
+
+        trace = get_current_trace()
+        if trace is not None:
+            trace.decision_tier = tier
+            trace.escalation_reason = escalation_reason
+        get_metrics_registry().inc("decision_tier_total", tier=tier)
+        with self._tier_counts_lock:
+            self.tier_counts[tier] += 1
+        return decision
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            self.fast_engine.fingerprint(),
+            self.engine.fingerprint(),
+            json.dumps(
+                [
+                    self.min_confidence,
+                    self.escalate_decisions,
+                    self.escalation_keywords,
+                ]
+            ),
+        )
+
+    def usage_summary(self) -> Dict[str, Dict]:
+        with self._tier_counts_lock:
+            tier_counts = dict(self.tier_counts)
+        return {
+            "tiers": tier_counts,
+            "fast": self.fast_engine.usage_summary(),
+            "escalated": self.engine.usage_summary(),
+        }
+
+
+class RouterDecisionEngine(DecisionEngine):
+    """Classifies the claim type and sends the claim to a specialist engine for that type.
+
+    A specialist gets only the policy sections whose headings match its route,
+    plus the general sections every claim needs, which keeps its requests small.
+    Claims the classifier can not place go to an engine with the full policy.
+    """
+
+    def __init__(
+        self,
+        classifier: Optional[ClaimClassifier] = None,
+        routes: Dict[str, Dict] = CLAIM_ROUTES,
+        general_policy_sections: List[str] = GENERAL_POLICY_SECTIONS,
+        default_route: str = DEFAULT_CLAIM_ROUTE,
+        model_name: str = MODEL_NAME,
+        system_prompt: str = ADVANCED_LLM_SYSTEM_PROMPT,
+        use_cache: bool = USE_DECISION_CACHE,
+    ):
+        self.classifier = classifier or get_claim_classifier(
+            ROUTER_CLASSIFIER, routes=routes, default_route=default_route
+        )
+        self.default_route = default_route
+        policy = load_policy()
+        sections = split_policy_sections(policy)
+        general_sections = select_policy_sections(sections, general_policy_sections)
+
+        self.engines: Dict[str, SimpleLLMDecisionEngine] = {}
+        for route, config in routes.items():
+            route_sections = select_policy_sections(sections, config["policy_sections"])
+            if route_sections:
+                route_policy = build_policy_document(
+                    [
+                        section
+                        for section in sections
+                        if section in route_sections or section in general_sections
+                    ]
+                )
+            else:
+                logger.warning(
+                    f"No policy sections match route {route}, it gets the full policy"
+                )
+                route_policy = policy
+            logger.info(
+                f"Route {route} gets {len(route_policy.content) / max(len(policy.content), 1):.0%} of the policy"
+            )
+            self.engines[route] = SimpleLLMDecisionEngine(
+                model_name=config.get("model_name", model_name),
+                system_prompt=system_prompt,
+                use_cache=use_cache,
+                policy=route_policy,
+            )
+        self.engines[default_route] = SimpleLLMDecisionEngine(
+            model_name=model_name,
+            system_prompt=system_prompt,
+            use_cache=use_cache,
+            policy=policy,
+        )
+        self.route_counts: Dict[str, int] = {route: 0 for route in self.engines}
+        self._route_counts_lock = threading.Lock()
+
+    def decide_claim(self, claim: Claim) -> ClaimDecision:
+        route = self.classifier.classify_claim(claim)
+        engine = self.engines.get(route, self.engines[self.default_route])
+        logger.info(f"Routing claim {claim.claim_id} to the {route} engine")
+        start_time = time.perf_counter()
+        decision = engine.decide_claim(claim)
+
+        trace = get_current_trace()
+        if trace is not None:
+            trace.decision_route = route
+        registry = get_metrics_registry()
+        registry.inc("decision_route_total", route=route)
+        registry.observe(
+            "decision_route_seconds", time.perf_counter() - start_time, route=route
+        )
+        with self._route_counts_lock:
+            self.route_counts[route] = self.route_counts.get(route, 0) + 1
+        return decision
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            self.classifier.fingerprint(),
+            *[
+                make_cache_key(route, engine.fingerprint())
+                for route, engine in sorted(self.engines.items())
+            ],
+        )
+
+    def usage_summary(self) -> Dict[str, Dict]:
+        with self._route_counts_lock:
+            route_counts = dict(self.route_counts)
+        summary = {
+            "routes": route_counts,
+            **{route: engine.usage_summary() for route, engine in self.engines.items()},
+        }
+        classifier_usage = self.classifier.usage_summary()
+        if classifier_usage:
+            summary["classifier"] = classifier_usage
+        return summary
+
+
+class BatchDecisionEngine(SimpleLLMDecisionEngine):
+    """Makes the same decisions as `SimpleLLMDecisionEngine` through a batch backend.
+
+    Meant for bulk runs without latency requirements: claims are decided
+    together with `decide_claims`, at batch prices, and the job is
+    checkpointed to `batch_directory` so an interrupted run can be resumed.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[BatchBackend] = None,
+        batch_directory: str = os.path.join(BATCH_DIRECTORY, "decisions"),
+        poll_interval_seconds: float = BATCH_POLL_INTERVAL_SECONDS,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.backend = backend or get_batch_backend()
+        # Fails for a model the backend does not serve before any request is sent
+        self.batch_model_name = self.backend.get_model_name(self.model_name)
+        self.batch_directory = batch_directory
+        self.poll_interval_seconds = poll_interval_seconds
+
+    def is_valid_result(self, result: Dict) -> bool:
+        try:
+            self.parse_decision(get_response_content(result))
+        except Exception as e:
+            logger.warning(
+                f"Invalid decision in batch result {result['custom_id']}: {e}"
+            )
+            return False
+        return True
+
+    def decide_claims(self, claims: List[Claim]) -> Dict[int, ClaimDecision]:
+        """Decisions by claim id, claims whose request failed or returned an invalid decision are left out."""
+        decisions = {}
+        requests = {}
+        for claim in claims:
+            messages = self.build_messages(claim)
+            cache_key = self.get_cache_key(messages)
+            if self.use_cache:
+                cached_decision = get_decision_cache().get(cache_key)
+                record_cache_lookup("decision", hit=cached_decision is not None)
+                if cached_decision is not None:
+                    decisions[claim.claim_id] = self.parse_decision(cached_decision)
+                    continue
+            # The request hash in the id keeps results of changed claims from being reused on resume
+            custom_id = f"decision-{claim.claim_id}-{cache_key[:16]}"
+            requests[custom_id] = (claim.claim_id, cache_key, messages)
+
+        results = BatchJob(
+            self.batch_directory,
+            self.backend,
+            poll_interval_seconds=self.poll_interval_seconds,
+            is_valid=self.is_valid_result,
+        ).run(
+            {
+                custom_id: (
+                    lambda custom_id=custom_id, messages=messages: build_batch_request(
+                        custom_id, self.batch_model_name, messages, self.response_format
+                    )
+                )
+                for custom_id, (_, _, messages) in requests.items()
+            }
+        )
+        for custom_id, result in results.items():
+            claim_id, cache_key, _ = requests[custom_id]
+            decision = self.parse_decision(get_response_content(result))
+            self.record_token_usage(
+                get_token_usage(
+                    ChatCompletion.model_validate(result["response"]["body"])
+                )
+            )
+            if self.use_cache:
+                get_decision_cache().set(cache_key, decision.model_dump_json())
+            decisions[claim_id] = decision
+        return decisions
+
+    def decide_claim(self, claim: Claim) -> ClaimDecision:
+        decisions = self.decide_claims([claim])
+        if claim.claim_id not in decisions:
+            raise Exception(f"Batch decision request failed for claim {claim.claim_id}")
+        return decisions[claim.claim_id]
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+from claim_processing.constants import (
+    DECISION_STORE_BACKEND,
+    DECISION_STORE_PATH,
+    RESULTS_DIRECTORY,
+)
+from claim_processing.pydantic_models import ClaimDecision
+
+logger = logging.getLogger()
+
+
+class DecisionStore(ABC):
+    # Whether `put_many` is cheaper than a `put` per decision
+    supports_bulk_writes: bool = False
+
+    @abstractmethod
+    def put(self, claim_id: int, decision: ClaimDecision, overwrite: bool = False):
+        pass
+
+    def put_many(self, decisions: Dict[int, ClaimDecision], overwrite: bool = True):
+        for claim_id, decision in decisions.items():
+            self.put(claim_id, decision, overwrite=overwrite)
+
+    @abstractmethod
+    def get(self, claim_id: int) -> Optional[ClaimDecision]:
+        pass
+
+    @abstractmethod
+    def list_claim_ids(
+        self,
+        decision: Optional[str] = None,
+        after_claim_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[int]:
+        """List claim ids in ascending order, `after_claim_id` and `limit` paginate the result."""
+        pass
+
+    @abstractmethod
+    def load_all(self) -> Dict[int, ClaimDecision]:
+        pass
+
+
+class FileSystemDecisionStore(DecisionStore):
+    """Stores every decision as `claim {id} decision.json` in a results directory."""
+
+    def __init__(self, results_dir: str = RESULTS_DIRECTORY):
+        self.results_dir = results_dir
+
+    def _decision_path(self, claim_id: int) -> str:
+        return os.path.join(self.results_dir, f"claim {claim_id} decision.json")
+
+    def put(self, claim_id: int, decision: ClaimDecision, overwrite: bool = False):
+        os.makedirs(self.results_dir, exist_ok=True)
+        claim_decision_path = self._decision_path(claim_id)
+
+        if os.path.exists(claim_decision_path) and not overwrite:
+            raise HTTPException(
+                status_code=500,
+                detail="Claim decision already exists and overwrite is set to False",
+            )
+
+        with open(claim_decision_path, "w") as decision_file:
+            decision_file.write(decision.model_dump_json())
+
+    def get(self, claim_id: int) -> Optional[ClaimDecision]:
+        claim_decision_path = self._decision_path(claim_id)
+        if not os.path.exists(claim_decision_path):
+            return None
+        with open(claim_decision_path, "r") as decision_file:
+            decision = json.load(decision_file)
+        return ClaimDecision(
+            reasoning=decision["reasoning"], decision=decision["decision"]
+        )
+
+    def list_claim_ids(
+        self,
+        decision: Optional[str] = None,
+        after_claim_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[int]:
+        if not os.path.isdir(self.results_dir):
+            return []
+        claim_ids = sorted(
+            int(file_name.replace("claim ", "").replace(" decision.json", ""))
+            for file_name in os.listdir(self.results_dir)
+            if file_name.startswith("claim ") and file_name.endswith(" decision.json")
+        )
+        if after_claim_id is not None:
+            claim_ids = [
+                claim_id for claim_id in claim_ids if claim_id > after_claim_id
+            ]
+        if decision is not None:
+            claim_ids = [
+                claim_id
+                for claim_id in claim_ids
+                # A decision file can be removed between the listing and the read
+                if (claim_decision := self.get(claim_id)) is not None
+                and claim_decision.decision == decision
+            ]
+        return claim_ids[:limit] if limit is not None else claim_ids
+
+    def load_all(self) -> Dict[int, ClaimDecision]:
+        decisions = {}
+        for claim_id in self.list_claim_ids():
+            try:
+                decisions[claim_id] = self.get(claim_id)
+            except Exception:
+                logger.warning(
+                    f"Exception when loading decision of claim {claim_id}. Skipping..."
+                )
+        return decisions
+
+
+class SQLiteDecisionStore(DecisionStore):
+    """Stores decisions of all configurations in one indexed SQLite database."""
+
+    supports_bulk_writes = True
+
+    def __init__(self, path: str = DECISION_STORE_PATH, config: str = "latest"):
+        self.path = path
+        self.config = config
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS decisions (
+                config TEXT NOT NULL,
+                claim_id INTEGER NOT NULL,
+                decision TEXT NOT NULL,
+                reasoning TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (config, claim_id)
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS decisions_config_decision ON decisions (config, decision, claim_id)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS decisions_config_created_at ON decisions (config, created_at)"
+        )
+        self._connection.commit()
+
+    def put(self, claim_id: int, decision: ClaimDecision, overwrite: bool = False):
+        self.put_many({claim_id: decision}, overwrite=overwrite)
+
+    def put_many(self, decisions: Dict[int, ClaimDecision], overwrite: bool = True):
+        now = time.time()
+        rows = [
+            (self.config, claim_id, decision.decision, decision.reasoning, now)
+            for claim_id, decision in decisions.items()
+        ]
+        with self._lock:
+            if overwrite:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?)", rows
+                )
+            else:
+                try:
+                    self._connection.executemany(
+                        "INSERT INTO decisions VALUES (?, ?, ?, ?, ?)", rows
+                    )
+                except sqlite3.IntegrityError:
+                    self._connection.rollback()
+                    raise HTTPException(
+                        status_code=500,
+                        detail="Claim decision already exists and overwrite is set to False",
+                    )
+            self._connection.commit()
+
+    def get(self, claim_id: int) -> Optional[ClaimDecision]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT reasoning, decision FROM decisions WHERE config = ? AND claim_id = ?",
+                (self.config, claim_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return ClaimDecision(reasoning=row[0], decision=row[1])
+
+    def list_claim_ids(
+        self,
+        decision: Optional[str] = None,
+        after_claim_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[int]:
+        # Keyset pagination on the primary key, so every page is an index range scan
+        query = "SELECT claim_id FROM decisions WHERE config = ?"
+        parameters = [self.config]
+        if decision is not None:
+            query += " AND decision = ?"
+            parameters.append(decision)
+        if after_claim_id is not None:
+            query += " AND claim_id > ?"
+            parameters.append(after_claim_id)
+        query += " ORDER BY claim_id"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        with self._lock:
+            return [row[0] for row in self._connection.execute(query, parameters)]
+
+    def load_all(self) -> Dict[int, ClaimDecision]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT claim_id, reasoning, decision FROM decisions WHERE config = ?",
+                (self.config,),
+            ).fetchall()
+        return {
+            claim_id: ClaimDecision(reasoning=reasoning, decision=decision)
+            for claim_id, reasoning, decision in rows
+        }
+
+
+@lru_cache(maxsize=None)
+def get_decision_store(
+    results_dir: str = RESULTS_DIRECTORY, backend: str = DECISION_STORE_BACKEND
+) -> DecisionStore:
+    """Decision store of a results directory, with the SQLite backend the directory name is the config."""
+    if backend == "filesystem":
+        return FileSystemDecisionStore(results_dir)
+    elif backend == "sqlite":
+        config = os.path.basename(os.path.normpath(results_dir))
+        return SQLiteDecisionStore(DECISION_STORE_PATH, config=config)
+    raise ValueError(f"Unsupported decision store backend: {backend}")
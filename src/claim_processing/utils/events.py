@@ -0,0 +1,107 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from claim_processing.constants import CLAIM_EVENT_HISTORY_SIZE
+from claim_processing.pydantic_models import ClaimEvent
+
+# Events that end the stream of a claim job
+TERMINAL_EVENTS = ("done", "failed")
+
+EventListener = Callable[[str, Dict], None]
+
+_current_listener: contextvars.ContextVar[Optional[EventListener]] = (
+    contextvars.ContextVar("current_event_listener", default=None)
+)
+
+
+@contextmanager
+def listen_to_events(listener: EventListener) -> Iterator[None]:
+    """Send the events emitted in this context, and in threads submitted with its context, to the listener."""
+    token = _current_listener.set(listener)
+    try:
+        yield
+    finally:
+        _current_listener.reset(token)
+
+
+def is_listening() -> bool:
+    return _current_listener.get() is not None
+
+
+def emit_event(event: str, **data):
+    listener = _current_listener.get()
+    if listener is not None:
+        listener(event, data)
+
+
+class ClaimEventBroker:
+    """Fans the events of claims out to async subscribers, events can be published from any thread.
+
+    The events of the latest job of a claim are kept, so a client that
+    subscribes after processing started still gets every event.
+    """
+
+    def __init__(self, history_size: int = CLAIM_EVENT_HISTORY_SIZE):
+        self.history_size = history_size
+        self._history: "OrderedDict[int, List[ClaimEvent]]" = OrderedDict()
+        self._subscribers: Dict[
+            int, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, claim_id: int, event: str, data: Optional[Dict] = None):
+        claim_event = ClaimEvent(
+            claim_id=claim_id, event=event, data=data or {}, timestamp=time.time()
+        )
+        with self._lock:
+            if event == "queued" or claim_id not in self._history:
+                self._history[claim_id] = []
+            self._history[claim_id].append(claim_event)
+            self._history.move_to_end(claim_id)
+            while len(self._history) > self.history_size:
+                self._history.popitem(last=False)
+            subscribers = list(self._subscribers.get(claim_id, []))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, claim_event)
+
+    def listener(self, claim_id: int) -> EventListener:
+        return lambda event, data: self.publish(claim_id, event, data)
+
+    def has_history(self, claim_id: int) -> bool:
+        with self._lock:
+            return claim_id in self._history
+
+    def subscribe(self, claim_id: int) -> asyncio.Queue:
+        """Queue of the events of a claim, starting with the events of its latest job."""
+        queue = asyncio.Queue()
+        with self._lock:
+            for claim_event in self._history.get(claim_id, []):
+                queue.put_nowait(claim_event)
+            self._subscribers.setdefault(claim_id, []).append(
+                (asyncio.get_running_loop(), queue)
+            )
+        return queue
+
+    def unsubscribe(self, claim_id: int, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = [
+                subscriber
+                for subscriber in self._subscribers.get(claim_id, [])
+                if subscriber[1] is not queue
+            ]
+            if subscribers:
+                self._subscribers[claim_id] = subscribers
+            else:
+                self._subscribers.pop(claim_id, None)
+
+
+def format_server_sent_event(claim_event: Optional[ClaimEvent]) -> str:
+    """A claim event as a server-sent event, None as a comment that keeps the connection open."""
+    if claim_event is None:
+        return ": keepalive\n\n"
+    return f"event: {claim_event.event}\ndata: {claim_event.model_dump_json()}\n\n"
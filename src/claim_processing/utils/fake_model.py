@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from claim_processing.utils.rate_limit import estimate_tokens
+
+FAKE_TEXT = "Synthetic response of the fake model backend."
+# Highest authenticity score, so documents pass the authenticity check and every stage runs
+FAKE_INTEGER = 5
+
+
+def build_schema_instance(
+    schema: Dict, definitions: Dict, seed: int, path: str = ""
+) -> object:
+    """Build a minimal instance of a JSON schema, enum values are picked by the seed."""
+    if "$ref" in schema:
+        schema = definitions[schema["$ref"].split("/")[-1]]
+    if "enum" in schema:
+        values = schema["enum"]
+        return values[
+            int(hashlib.sha256(f"{seed}{path}".encode()).hexdigest(), 16) % len(values)
+        ]
+    if "const" in schema:
+        return schema["const"]
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        return build_schema_instance(options[0], definitions, seed, path)
+
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {
+            name: build_schema_instance(
+                property_schema, definitions, seed, f"{path}.{name}"
+            )
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [build_schema_instance(schema.get("items", {}), definitions, seed, path)]
+    if schema_type == "integer":
+        return FAKE_INTEGER
+    if schema_type == "number":
+        return float(FAKE_INTEGER)
+    if schema_type == "boolean":
+        return True
+    return FAKE_TEXT
+
+
+class _FakeModelMixin:
+    def __init__(
+        self,
+        latency_seconds: float = 0.0,
+        jitter_seconds: float = 0.0,
+        seconds_per_output_token: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.seconds_per_output_token = seconds_per_output_token
+        self.n_requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _respond(self, request: httpx.Request):
+        """Build a chat completion for the request and the latency to simulate before returning it."""
+        body = json.loads(request.content)
+        request_seed = int(hashlib.sha256(request.content).hexdigest()[:8], 16)
+
+        response_format: Optional[Dict] = body.get("response_format")
+        if response_format and response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            content = json.dumps(
+                build_schema_instance(schema, schema.get("$defs", {}), request_seed)
+            )
+        else:
+            content = FAKE_TEXT
+
+        input_tokens = estimate_tokens(body["messages"])
+        output_tokens = max(1, len(content) // 4)
+        completion = {
+            "id": f"fake-{request_seed:08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+        with self._lock:
+            self.n_requests += 1
+            jitter = self._random.uniform(-self.jitter_seconds, self.jitter_seconds)
+        latency = max(
+            0.0,
+            self.latency_seconds
+            + jitter
+            + output_tokens * self.seconds_per_output_token,
+        )
+        if body.get("stream"):
+            return self._stream_response(request, completion), latency
+        return httpx.Response(200, json=completion, request=request), latency
+
+    def _stream_response(
+        self, request: httpx.Request, completion: Dict
+    ) -> httpx.Response:
+        """The completion as server-sent chunks, the content in pieces of a few tokens."""
+        content = completion["choices"][0]["message"]["content"]
+        chunk = {key: completion[key] for key in ("id", "created", "model")}
+        chunk["object"] = "chat.completion.chunk"
+        chunks = [
+            {
+                **chunk,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": content[i : i + 16]},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            for i in range(0, len(content), 16)
+        ]
+        chunks.append(
+            {
+                **chunk,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+        )
+        chunks.append({**chunk, "choices": [], "usage": completion["usage"]})
+        body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks)
+        return httpx.Response(
+            200,
+            content=(body + "data: [DONE]\n\n").encode(),
+            headers={"content-type": "text/event-stream"},
+            request=request,
+        )
+
+
+class FakeModelTransport(_FakeModelMixin, httpx.BaseTransport):
+    """Local stand-in for the model API, answering chat completions after a tunable latency.
+
+    Structured output requests get a minimal instance of the requested schema,
+    other requests a fixed text. Streamed requests get the content in chunks.
+    """
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response, latency = self._respond(request)
+        time.sleep(latency)
+        return response
+
+
+class AsyncFakeModelTransport(_FakeModelMixin, httpx.AsyncBaseTransport):
+    """Async local stand-in for the model API, see `FakeModelTransport`."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response, latency = self._respond(request)
+        await asyncio.sleep(latency)
+        return response
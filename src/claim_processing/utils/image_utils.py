@@ -1,43 +1,334 @@
 import base64
+import io
 import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
-from claim_processing.constants import AUTHENTICITY_MODEL_NAME, OCR_MODEL_NAME, USE_OCR
+import numpy as np
+from openai import BaseModel
+from PIL import Image, ImageOps
+
+from claim_processing.constants import (
+    AUTHENTICITY_IMAGE_PROFILE,
+    AUTHENTICITY_MODEL_NAME,
+    FUSED_VISION_MODEL_NAME,
+    IMAGE_PREPROCESSING_WORKERS,
+    OCR_BACKEND,
+    OCR_IMAGE_PROFILE,
+    OCR_MODEL_NAME,
+    USE_OCR,
+    USE_VISION_CACHE,
+    VISION_CACHE_MAX_BYTES,
+    VISION_CACHE_PATH,
+)
 from claim_processing.prompts import (
     AUTHENTICITY_PROMPT,
+    DOCUMENT_ANALYSIS_PROMPT,
     DOCUMENT_FORMAT_PROMPT,
     OCR_PROMPT,
 )
-from claim_processing.pydantic_models import AuthenticityResponse, Document
-from claim_processing.utils.openai_utils import send_image_request_openai
+from claim_processing.pydantic_models import (
+    AuthenticityResponse,
+    Document,
+    DocumentAnalysisResponse,
+    OCRResult,
+)
+from claim_processing.utils.batch_api import build_batch_request
+from claim_processing.utils.cache import DiskCache, make_cache_key
+from claim_processing.utils.metrics import (
+    get_current_trace,
+    get_metrics_registry,
+    record_cache_lookup,
+)
+from claim_processing.utils.ocr import (
+    GatedOCRBackend,
+    OCRBackend,
+    TesseractOCRBackend,
+)
+from claim_processing.utils.openai_utils import (
+    build_image_messages,
+    send_image_request_openai,
+)
+
+logger = logging.getLogger()
+
+
+IMAGE_FORMAT_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg", "PNG": ".png"}
+
+
+@lru_cache(maxsize=1)
+def get_vision_cache() -> DiskCache:
+    return DiskCache(VISION_CACHE_PATH, max_bytes=VISION_CACHE_MAX_BYTES)
+
+
+@lru_cache(maxsize=1)
+def get_preprocessing_pool() -> ProcessPoolExecutor:
+    # Image pre-processing is CPU bound, run it outside of the threads making requests
+    return ProcessPoolExecutor(
+        max_workers=IMAGE_PREPROCESSING_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def estimate_skew_angle(
+    image: Image.Image, max_angle: float = 5.0, step: float = 0.5
+) -> float:
+    """Find the rotation that makes text lines most horizontal, based on row projections."""
+    sample = ImageOps.invert(image.convert("L"))
+    sample.thumbnail((800, 800))
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step, step):
+        rotated = np.asarray(sample.rotate(float(angle), fillcolor=0), dtype=np.float32)
+        score = float(np.var(rotated.sum(axis=1)))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def preprocess_image(image_bytes: bytes, profile: Dict) -> Tuple[bytes, str]:
+    """Resize and recompress an image following a pre-processing profile.
+
+    Returns the new image bytes and the file extension matching their format.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as original_image:
+        exif = original_image.info.get("exif")
+        # Apply the EXIF orientation, as the orientation tag is dropped with the metadata
+        image = ImageOps.exif_transpose(original_image)
+
+    if profile["grayscale"]:
+        image = image.convert("L")
+    if profile["deskew"]:
+        angle = estimate_skew_angle(image)
+        if angle != 0.0:
+            fill_color = 255 if image.mode == "L" else "white"
+            image = image.rotate(angle, expand=True, fillcolor=fill_color)
+    if profile["max_edge"] is not None:
+        image.thumbnail(
+            (profile["max_edge"], profile["max_edge"]), Image.Resampling.LANCZOS
+        )
+
+    image_format = profile["format"].upper()
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+
+    save_kwargs = {"format": image_format, "quality": profile["quality"]}
+    if exif and not profile["strip_exif"]:
+        save_kwargs["exif"] = exif
+    output = io.BytesIO()
+    image.save(output, **save_kwargs)
+    return output.getvalue(), IMAGE_FORMAT_EXTENSIONS[image_format]
+
+
+def prepare_image(document: Document, profile: Optional[Dict]) -> Tuple[str, str]:
+    """Return the file name and base64 content of an image as it should be sent to a model."""
+    image_bytes = document.read_bytes()
+    if profile is None or not profile["enabled"]:
+        return document.name, base64.b64encode(image_bytes).decode("utf-8")
+
+    try:
+        processed_bytes, extension = (
+            get_preprocessing_pool()
+            .submit(preprocess_image, image_bytes, profile)
+            .result()
+        )
+    except Exception as e:
+        logger.warning(
+            f"Pre-processing {document.name} failed with {e}, sending the original image"
+        )
+        return document.name, base64.b64encode(image_bytes).decode("utf-8")
+
+    logger.info(
+        f"Pre-processed {document.name} from {len(image_bytes)} to {len(processed_bytes)} bytes "
+        f"({len(processed_bytes) / len(image_bytes):.0%})"
+    )
+    image_filename = os.path.splitext(document.name)[0] + extension
+    return image_filename, base64.b64encode(processed_bytes).decode("utf-8")
+
+
+def get_vision_cache_key(
+    system_prompt: str,
+    document: Document,
+    vision_model_name: str,
+    response_format: Optional[BaseModel] = None,
+    image_profile: Optional[Dict] = None,
+) -> str:
+    return make_cache_key(
+        document.content_hash(),
+        vision_model_name,
+        system_prompt,
+        response_format.__name__ if response_format else "",
+        json.dumps(image_profile, sort_keys=True)
+        if image_profile and image_profile["enabled"]
+        else "",
+    )
 
 
-def judge_image_authenticity(image_bytestring: str, image_filename: str):
+def send_cached_image_request(
+    system_prompt: str,
+    document: Document,
+    vision_model_name: str,
+    response_format: Optional[BaseModel] = None,
+    image_profile: Optional[Dict] = None,
+    use_cache: bool = USE_VISION_CACHE,
+) -> str:
+    """Send an image request, reusing earlier responses for identical image bytes, model and prompt."""
+    if use_cache:
+        cache_key = get_vision_cache_key(
+            system_prompt, document, vision_model_name, response_format, image_profile
+        )
+        cached_response = get_vision_cache().get(cache_key)
+        record_cache_lookup("vision", hit=cached_response is not None)
+        if cached_response is not None:
+            logger.info(
+                f"Using cached {vision_model_name} response for {document.name}"
+            )
+            return cached_response
+
+    # The encoded image only lives for the duration of the request
+    image_filename, image_bytestring = prepare_image(document, image_profile)
     response = send_image_request_openai(
-        system_prompt=AUTHENTICITY_PROMPT,
+        system_prompt=system_prompt,
         image_filename=image_filename,
         image_bytestring=image_bytestring,
-        vision_model_name=AUTHENTICITY_MODEL_NAME,
+        vision_model_name=vision_model_name,
+        response_format=response_format,
+    )
+    if use_cache and response is not None:
+        get_vision_cache().set(cache_key, response)
+    return response
+
+
+def build_vision_batch_request(
+    custom_id: str,
+    system_prompt: str,
+    document: Document,
+    vision_model_name: str,
+    response_format: Optional[BaseModel] = None,
+    image_profile: Optional[Dict] = None,
+) -> Dict:
+    """Batch input line of an image request, the same request `send_cached_image_request` sends."""
+    image_filename, image_bytestring = prepare_image(document, image_profile)
+    return build_batch_request(
+        custom_id,
+        vision_model_name,
+        build_image_messages(system_prompt, image_filename, image_bytestring),
+        response_format,
+    )
+
+
+def judge_image_authenticity(
+    document: Document, vision_model_name: str = AUTHENTICITY_MODEL_NAME
+):
+    response = send_cached_image_request(
+        system_prompt=AUTHENTICITY_PROMPT,
+        document=document,
+        vision_model_name=vision_model_name,
         response_format=AuthenticityResponse,
+        image_profile=AUTHENTICITY_IMAGE_PROFILE,
     )
     response_json = json.loads(response)
     return response_json
 
 
-def extract_text_from_doc(document: Document, use_ocr: bool = USE_OCR) -> str:
+def analyze_document(
+    document: Document, vision_model_name: str = FUSED_VISION_MODEL_NAME
+) -> Dict:
+    """Text, authenticity score and reasoning of an image from a single request.
+
+    The image is sent with the authenticity profile, as recompression for OCR
+    can hide signs of editing.
+    """
+    response = send_cached_image_request(
+        system_prompt=DOCUMENT_ANALYSIS_PROMPT,
+        document=document,
+        vision_model_name=vision_model_name,
+        response_format=DocumentAnalysisResponse,
+        image_profile=AUTHENTICITY_IMAGE_PROFILE,
+    )
+    return json.loads(response)
+
+
+def format_document_analysis(document: Document, document_analysis: Dict) -> str:
+    """The parsed document of an image from its document analysis, as `extract_text_from_doc` returns it."""
+    return DOCUMENT_FORMAT_PROMPT.format(
+        document_name=document.name,
+        document_content=document_analysis["extracted_text"],
+    )
+
+
+class RemoteOCRBackend(OCRBackend):
+    """OCR with a vision model, responses are cached per image."""
+
+    name = "remote"
+
+    def __init__(self, model_name: str = OCR_MODEL_NAME):
+        self.model_name = model_name
+
+    def extract_text(self, document: Document) -> OCRResult:
+        text = send_cached_image_request(
+            system_prompt=OCR_PROMPT,
+            document=document,
+            vision_model_name=self.model_name,
+            image_profile=OCR_IMAGE_PROFILE,
+        )
+        return OCRResult(text=text, backend=self.name)
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            self.model_name,
+            OCR_PROMPT,
+            json.dumps(OCR_IMAGE_PROFILE, sort_keys=True),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_ocr_backend(
+    backend: str = OCR_BACKEND, ocr_model_name: str = OCR_MODEL_NAME
+) -> OCRBackend:
+    if backend == "remote":
+        return RemoteOCRBackend(ocr_model_name)
+    elif backend == "tesseract":
+        return TesseractOCRBackend()
+    elif backend == "gated":
+        try:
+            local_backend = TesseractOCRBackend()
+        except ImportError as e:
+            logger.warning(f"{e}, all images go to {ocr_model_name}")
+            return RemoteOCRBackend(ocr_model_name)
+        return GatedOCRBackend(local_backend, RemoteOCRBackend(ocr_model_name))
+    raise ValueError(f"Unsupported OCR backend: {backend}")
+
+
+def extract_text_from_doc(
+    document: Document,
+    use_ocr: bool = USE_OCR,
+    ocr_model_name: str = OCR_MODEL_NAME,
+    ocr_backend: str = OCR_BACKEND,
+) -> str:
     if document.type == "text supporting document":
         return DOCUMENT_FORMAT_PROMPT.format(
             document_name=document.name, document_content=document.content
         )
     else:
         if use_ocr:
-            image_content = send_image_request_openai(
-                system_prompt=OCR_PROMPT,
-                image_filename=document.name,
-                image_bytestring=document.content,
-                vision_model_name=OCR_MODEL_NAME,
+            ocr_result = get_ocr_backend(ocr_backend, ocr_model_name).extract_text(
+                document
             )
+            get_metrics_registry().inc(
+                "ocr_documents_total", backend=ocr_result.backend
+            )
+            trace = get_current_trace()
+            if trace is not None:
+                trace.ocr_backends[document.name] = ocr_result.backend
             return DOCUMENT_FORMAT_PROMPT.format(
-                document_name=document.name, document_content=image_content
+                document_name=document.name, document_content=ocr_result.text
             )
         else:
             return DOCUMENT_FORMAT_PROMPT.format(
@@ -49,12 +340,12 @@ def extract_text_from_doc(document: Document, use_ocr: bool = USE_OCR) -> str:
 if __name__ == "__main__":
     # file_path = "assignment/claim 7/Spanish_medical_15.webp"
     file_path = "assignment/claim 1/Spanish_medical_15.webp"
-
-    with open(file_path, "rb") as file:
-        file_bytestring = base64.b64encode(file.read()).decode("utf-8")
-
-    # response = judge_image_authenticity(file_bytestring, file_path)
-    response = extract_text_from_doc(
-        Document("test", file_bytestring, "text supporting document")
+    document = Document(
+        name=os.path.basename(file_path),
+        type="image supporting document",
+        path=file_path,
     )
+
+    # response = judge_image_authenticity(document)
+    response = extract_text_from_doc(document)
     print(response)
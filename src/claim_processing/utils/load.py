@@ -1,18 +1,21 @@
-import base64
 import json
 import logging
 import os
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 from fastapi import HTTPException
 
 from claim_processing.constants import (
     CLAIM_DIRECTORY,
     FILES_TO_EXCLUDE,
+    IMAGE_DOCUMENT_EXTENSIONS,
     POLICY_DIRECTORY,
     RESULTS_DIRECTORY,
+    TEXT_DOCUMENT_EXTENSIONS,
 )
 from claim_processing.pydantic_models import Claim, ClaimDecision, Document
+from claim_processing.utils.claim_store import get_claim_store
+from claim_processing.utils.decision_store import get_decision_store
 
 logger = logging.getLogger()
 
@@ -27,37 +30,61 @@ def load_description(claim_directory: str):
         return Document(name="description.txt", content=file.read(), type="description")
 
 
+def load_supporting_document(
+    file_name: str, file_path: str, size_bytes: Optional[int] = None
+) -> Document:
+    if file_name.endswith(TEXT_DOCUMENT_EXTENSIONS):
+        with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+            return Document(
+                name=file_name,
+                content=file.read(),
+                type="text supporting document",
+            )
+    elif file_name.endswith(IMAGE_DOCUMENT_EXTENSIONS):
+        return Document(
+            name=file_name,
+            type="image supporting document",
+            path=file_path,
+            size_bytes=size_bytes
+            if size_bytes is not None
+            else os.path.getsize(file_path),
+        )
+    else:
+        raise ValueError(f"Unsupported file type: {file_name}")
+
+
 def load_supporting_documents(claim_directory: str):
     supporting_documents = []
     for file_name in os.listdir(claim_directory):
-        file_path = os.path.join(claim_directory, file_name)
         if file_name in FILES_TO_EXCLUDE:
             continue
-        elif file_name.endswith(".md"):
-            with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-                supporting_documents.append(
-                    Document(
-                        name=file_name,
-                        content=file.read(),
-                        type="text supporting document",
-                    )
-                )
-        elif file_name.endswith((".png", ".jpg", ".jpeg", ".webp")):
-            with open(file_path, "rb") as file:
-                file_bytestring = base64.b64encode(file.read()).decode("utf-8")
-                supporting_documents.append(
-                    Document(
-                        name=file_name,
-                        content=file_bytestring,
-                        type="image supporting document",
-                    )
-                )
-        else:
-            raise ValueError(f"Unsupported file type: {file_name}")
+        supporting_documents.append(
+            load_supporting_document(
+                file_name, os.path.join(claim_directory, file_name)
+            )
+        )
     return supporting_documents
 
 
 def load_claim(claim_id: int):
+    # Claims submitted through the API are in the claim store, fall back to the
+    # claim directory for claims that were added to the data folder directly
+    stored_claim = get_claim_store().get_claim(claim_id)
+    if stored_claim is not None:
+        description_text, stored_documents = stored_claim
+        return Claim(
+            claim_id=claim_id,
+            description=Document(
+                name="description.txt", content=description_text, type="description"
+            ),
+            supporting_documents=[
+                load_supporting_document(
+                    stored_doc.file_name, stored_doc.path, stored_doc.size_bytes
+                )
+                for stored_doc in stored_documents
+            ],
+        )
+
     claim_directory = os.path.join(CLAIM_DIRECTORY, "claim " + str(claim_id))
     description = load_description(claim_directory)
     supporting_documents = load_supporting_documents(claim_directory)
@@ -73,44 +100,43 @@ def load_policy():
         return Document(name="policy.md", content=file.read(), type="policy")
 
 
-def load_claim_decision(claim_id: int) -> ClaimDecision:
-    claim_decision_file = os.path.join(
-        RESULTS_DIRECTORY, f"claim {claim_id} decision.json"
-    )
-
-    if not os.path.exists(claim_decision_file):
+def load_claim_decision(
+    claim_id: int, results_dir: str = RESULTS_DIRECTORY
+) -> ClaimDecision:
+    decision = get_decision_store(results_dir).get(claim_id)
+    if decision is None:
         raise HTTPException(
             status_code=404, detail="Claim decision is not available yet"
         )
-
-    with open(claim_decision_file, "r") as decision_file:
-        decision = json.load(decision_file)
-
-    return ClaimDecision(reasoning=decision["reasoning"], decision=decision["decision"])
+    return decision
 
 
 def load_all_decisions(
     results_dir: str = RESULTS_DIRECTORY,
 ) -> Dict[int, ClaimDecision]:
-    decisions = {}
-    for decision_file_name in os.listdir(results_dir):
-        if decision_file_name.endswith("decision.json"):
-            claim_id = int(
-                decision_file_name.replace("claim ", "").replace(" decision.json", "")
-            )
-            try:
-                with open(
-                    os.path.join(results_dir, decision_file_name), "r"
-                ) as decision_file:
-                    decision = json.load(decision_file)
-            except Exception:
-                logger.warning(
-                    f"Exception when loading results file {decision_file_name}. Skipping..."
-                )
-            decisions[claim_id] = ClaimDecision(
-                reasoning=decision["reasoning"], decision=decision["decision"]
-            )
-    return decisions
+    return get_decision_store(results_dir).load_all()
+
+
+# Parsed answers by path, with the modification time they were read at
+_answer_cache: Dict[str, Tuple[int, ClaimDecision]] = {}
+
+
+def load_answer(answer_path: str) -> ClaimDecision:
+    # Evaluations of many configurations read the same answers, only re-read changed files
+    modified_at = os.stat(answer_path).st_mtime_ns
+    cached_answer = _answer_cache.get(answer_path)
+    if cached_answer is not None and cached_answer[0] == modified_at:
+        return cached_answer[1]
+
+    with open(answer_path, "r") as answer_file:
+        answer = json.load(answer_file)
+    if "explanation" not in answer.keys():
+        answer["explanation"] = "NA"
+    claim_answer = ClaimDecision(
+        reasoning=answer["explanation"], decision=answer["decision"]
+    )
+    _answer_cache[answer_path] = (modified_at, claim_answer)
+    return claim_answer
 
 
 def load_all_answers() -> Dict[int, ClaimDecision]:
@@ -118,14 +144,8 @@ def load_all_answers() -> Dict[int, ClaimDecision]:
     for claim_dir in os.listdir(CLAIM_DIRECTORY):
         if claim_dir.startswith("claim"):
             claim_id = int(claim_dir.replace("claim ", ""))
-            with open(
-                os.path.join(CLAIM_DIRECTORY, claim_dir, "answer.json"), "r"
-            ) as answer_file:
-                answer = json.load(answer_file)
-            if "explanation" not in answer.keys():
-                answer["explanation"] = "NA"
-            answers[claim_id] = ClaimDecision(
-                reasoning=answer["explanation"], decision=answer["decision"]
+            answers[claim_id] = load_answer(
+                os.path.join(CLAIM_DIRECTORY, claim_dir, "answer.json")
             )
 
     return answers
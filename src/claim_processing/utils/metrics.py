@@ -0,0 +1,279 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from claim_processing.constants import (
+    MODEL_PRICES,
+    TRACE_HISTORY_SIZE,
+)
+from claim_processing.pydantic_models import ClaimTrace, StageSpan, TokenUsage
+from claim_processing.utils.events import emit_event
+
+logger = logging.getLogger()
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+
+METRIC_DESCRIPTIONS = {
+    "claims_processed_total": ("counter", "Processed claims by decision"),
+    "claim_seconds": ("histogram", "Wall time of processing one claim"),
+    "claim_stage_seconds": ("histogram", "Wall time of one pipeline stage"),
+    "model_requests_total": ("counter", "Model requests by model"),
+    "model_request_seconds": ("histogram", "Latency of model requests by model"),
+    "model_retries_total": ("counter", "Retried model requests by model"),
+    "model_tokens_total": ("counter", "Model tokens by model and kind"),
+    "model_cost_usd_total": ("counter", "Estimated model cost in USD by model"),
+    "cache_lookups_total": ("counter", "Cache lookups by cache and result"),
+    "claim_requests_total": (
+        "counter",
+        "Claim processing requests that were queued, coalesced with an in-flight job or served from the decision store",
+    ),
+    "decision_tier_total": ("counter", "Cascading decisions by deciding tier"),
+    "policy_tokens_saved_total": (
+        "counter",
+        "Estimated policy tokens left out of decision requests by retrieval",
+    ),
+    "ocr_documents_total": ("counter", "Image documents read by OCR backend"),
+    "ocr_gate_total": (
+        "counter",
+        "Local OCR results accepted, rejected or failed by the confidence gate",
+    ),
+    "decision_route_total": ("counter", "Routed decisions by claim type"),
+    "decision_route_seconds": (
+        "histogram",
+        "Latency of routed decisions by claim type",
+    ),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    formatted = ",".join(
+        f'{key}="{_escape_label_value(value)}"' for key, value in pairs
+    )
+    return "{" + formatted + "}"
+
+
+class MetricsRegistry:
+    """In-process counters and histograms, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[LabelKey, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[LabelKey, List]] = defaultdict(dict)
+        self._traces: deque = deque(maxlen=TRACE_HISTORY_SIZE)
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1.0, **labels: str):
+        label_key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[name][label_key] = (
+                self._counters[name].get(label_key, 0.0) + value
+            )
+
+    def observe(self, name: str, value: float, **labels: str):
+        label_key = tuple(sorted(labels.items()))
+        with self._lock:
+            # Per label set: [count per bucket, sum, count]
+            histogram = self._histograms[name].setdefault(
+                label_key, [[0] * len(self.buckets), 0.0, 0]
+            )
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_trace(self, trace: ClaimTrace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def recent_traces(self) -> List[ClaimTrace]:
+        with self._lock:
+            return list(self._traces)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, values in sorted(self._counters.items()):
+                metric_type, help_text = METRIC_DESCRIPTIONS.get(name, ("counter", ""))
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+                for label_key, value in sorted(values.items()):
+                    lines.append(f"{name}{_format_labels(label_key)} {value}")
+            for name, values in sorted(self._histograms.items()):
+                metric_type, help_text = METRIC_DESCRIPTIONS.get(
+                    name, ("histogram", "")
+                )
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+                for label_key, (bucket_counts, total, count) in sorted(values.items()):
+                    for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                        bucket_labels = _format_labels(label_key, ("le", str(bucket)))
+                        lines.append(f"{name}_bucket{bucket_labels} {bucket_count}")
+                    inf_labels = _format_labels(label_key, ("le", "+Inf"))
+                    lines.append(f"{name}_bucket{inf_labels} {count}")
+                    lines.append(f"{name}_sum{_format_labels(label_key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(label_key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+@lru_cache(maxsize=1)
+def get_metrics_registry() -> MetricsRegistry:
+    return MetricsRegistry()
+
+
+_current_trace: contextvars.ContextVar[Optional[ClaimTrace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+_current_span: contextvars.ContextVar[Optional[StageSpan]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def get_current_trace() -> Optional[ClaimTrace]:
+    return _current_trace.get()
+
+
+def submit_with_context(
+    executor: Executor, function: Callable, *args, **kwargs
+) -> Future:
+    """Submit to an executor while keeping the current trace, which threads do not inherit."""
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+@contextmanager
+def trace_claim(claim_id: int) -> Iterator[ClaimTrace]:
+    """Trace the processing of a claim, a trace that is already active for the claim is reused."""
+    current_trace = _current_trace.get()
+    if current_trace is not None and current_trace.claim_id == claim_id:
+        yield current_trace
+        return
+
+    trace = ClaimTrace(claim_id=claim_id, started_at=time.time())
+    token = _current_trace.set(trace)
+    start_time = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.seconds = time.perf_counter() - start_time
+        _current_trace.reset(token)
+        registry = get_metrics_registry()
+        registry.observe("claim_seconds", trace.seconds)
+        registry.inc("claims_processed_total", decision=trace.decision or "FAILED")
+        registry.add_trace(trace)
+
+
+@contextmanager
+def trace_stage(stage: str, name: Optional[str] = None) -> Iterator[StageSpan]:
+    trace = _current_trace.get()
+    span = StageSpan(
+        stage=stage,
+        name=name,
+        start_offset_seconds=time.time() - trace.started_at if trace else 0.0,
+    )
+    token = _current_span.set(span)
+    start_time = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span.seconds = time.perf_counter() - start_time
+        _current_span.reset(token)
+        get_metrics_registry().observe("claim_stage_seconds", span.seconds, stage=stage)
+        emit_event("stage", stage=stage, name=name, seconds=span.seconds)
+        if trace is not None:
+            trace.spans.append(span)
+
+
+def run_stage(stage: str, name: Optional[str], function: Callable, *args, **kwargs):
+    with trace_stage(stage, name):
+        return function(*args, **kwargs)
+
+
+def get_model_cost(model: str, token_usage: TokenUsage) -> float:
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # Providers can report a versioned model name, e.g. "google/gemini-2.5-pro-preview"
+        prices = next(
+            (
+                model_prices
+                for priced_model, model_prices in MODEL_PRICES.items()
+                if model.startswith(priced_model)
+            ),
+            None,
+        )
+    if prices is None:
+        return 0.0
+    uncached_input_tokens = token_usage.input_tokens - token_usage.cached_input_tokens
+    return (
+        uncached_input_tokens * prices["input"]
+        + token_usage.cached_input_tokens * prices["cached_input"]
+        + token_usage.output_tokens * prices["output"]
+    ) / 1_000_000
+
+
+def record_model_call(
+    model: str,
+    token_usage: TokenUsage,
+    seconds: Optional[float],
+    price_factor: float = 1.0,
+):
+    """Record a model call, `seconds` is None when the latency is unknown, e.g. for batch requests."""
+    cost = get_model_cost(model, token_usage) * price_factor
+    registry = get_metrics_registry()
+    registry.inc("model_requests_total", model=model)
+    if seconds is not None:
+        registry.observe("model_request_seconds", seconds, model=model)
+    registry.inc(
+        "model_tokens_total", token_usage.input_tokens, model=model, kind="input"
+    )
+    registry.inc(
+        "model_tokens_total",
+        token_usage.cached_input_tokens,
+        model=model,
+        kind="cached_input",
+    )
+    registry.inc(
+        "model_tokens_total", token_usage.output_tokens, model=model, kind="output"
+    )
+    registry.inc("model_cost_usd_total", cost, model=model)
+
+    span = _current_span.get()
+    if span is not None:
+        span.model_calls += 1
+        if model not in span.models:
+            span.models.append(model)
+        span.input_tokens += token_usage.input_tokens
+        span.cached_input_tokens += token_usage.cached_input_tokens
+        span.output_tokens += token_usage.output_tokens
+        span.cost_usd += cost
+
+
+def record_model_retry(model: str):
+    get_metrics_registry().inc("model_retries_total", model=model)
+    span = _current_span.get()
+    if span is not None:
+        span.retries += 1
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    get_metrics_registry().inc(
+        "cache_lookups_total", cache=cache, result="hit" if hit else "miss"
+    )
+    span = _current_span.get()
+    if span is not None:
+        if hit:
+            span.cache_hits += 1
+        else:
+            span.cache_misses += 1
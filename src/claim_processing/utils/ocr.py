@@ -0,0 +1,153 @@
+import io
+import json
+import logging
+import multiprocessing
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+from claim_processing.constants import (
+    OCR_LOCAL_LANGUAGE,
+    OCR_LOCAL_MIN_CONFIDENCE,
+    OCR_LOCAL_MIN_WORDS,
+    OCR_LOCAL_WORKERS,
+)
+from claim_processing.pydantic_models import Document, OCRResult
+from claim_processing.utils.cache import make_cache_key
+from claim_processing.utils.metrics import get_metrics_registry
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+logger = logging.getLogger()
+
+
+class OCRBackend(ABC):
+    name: str
+
+    @abstractmethod
+    def extract_text(self, document: Document) -> OCRResult:
+        pass
+
+    def fingerprint(self) -> str:
+        """Hash of everything, apart from the document, that can change the extracted text."""
+        return make_cache_key(type(self).__name__)
+
+
+@lru_cache(maxsize=1)
+def get_ocr_pool() -> ProcessPoolExecutor:
+    # Local OCR is CPU bound, run it outside of the threads making requests
+    return ProcessPoolExecutor(
+        max_workers=OCR_LOCAL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def run_tesseract(image_bytes: bytes, language: str) -> Tuple[str, float, int]:
+    """Text, mean word confidence (0 to 100) and number of words Tesseract reads in an image."""
+    with Image.open(io.BytesIO(image_bytes)) as original_image:
+        image = ImageOps.exif_transpose(original_image).convert("L")
+    data = pytesseract.image_to_data(
+        image, lang=language, output_type=pytesseract.Output.DICT
+    )
+
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        if not word.strip() or confidence < 0:
+            continue
+        line_key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(line_key, []).append(word)
+        confidences.append(confidence)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    mean_confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    return text, mean_confidence, len(confidences)
+
+
+class TesseractOCRBackend(OCRBackend):
+    """CPU-only OCR with Tesseract, in a process pool and without network access."""
+
+    name = "tesseract"
+
+    def __init__(self, language: str = OCR_LOCAL_LANGUAGE):
+        if pytesseract is None:
+            raise ImportError("Local OCR needs pytesseract and the tesseract binary")
+        self.language = language
+
+    def extract_text(self, document: Document) -> OCRResult:
+        text, confidence, n_words = (
+            get_ocr_pool()
+            .submit(run_tesseract, document.read_bytes(), self.language)
+            .result()
+        )
+        return OCRResult(
+            text=text, backend=self.name, confidence=confidence, n_words=n_words
+        )
+
+    def fingerprint(self) -> str:
+        return make_cache_key(type(self).__name__, self.language)
+
+
+class GatedOCRBackend(OCRBackend):
+    """Reads a document locally first and sends it to the fallback backend when the local result is not trusted.
+
+    Handwritten, blurry or sparse pages get a low Tesseract confidence or too
+    few words and go to the fallback, usually a remote vision model.
+    """
+
+    name = "gated"
+
+    def __init__(
+        self,
+        local_backend: OCRBackend,
+        fallback_backend: OCRBackend,
+        min_confidence: float = OCR_LOCAL_MIN_CONFIDENCE,
+        min_words: int = OCR_LOCAL_MIN_WORDS,
+    ):
+        self.local_backend = local_backend
+        self.fallback_backend = fallback_backend
+        self.min_confidence = min_confidence
+        self.min_words = min_words
+
+    def extract_text(self, document: Document) -> OCRResult:
+        try:
+            local_result = self.local_backend.extract_text(document)
+        except Exception as e:
+            logger.warning(f"Local OCR of {document.name} failed with {e}")
+            local_result = None
+
+        if local_result is None:
+            gate_result = "failed"
+        elif (
+            local_result.confidence >= self.min_confidence
+            and local_result.n_words >= self.min_words
+        ):
+            gate_result = "accepted"
+        else:
+            gate_result = "rejected"
+        get_metrics_registry().inc(
+            "ocr_gate_total", backend=self.local_backend.name, result=gate_result
+        )
+
+        if gate_result == "accepted":
+            return local_result
+        if local_result is not None:
+            logger.info(
+                f"Local OCR of {document.name} read {local_result.n_words} words with "
+                f"confidence {local_result.confidence:.0f}, using {self.fallback_backend.name}"
+            )
+        return self.fallback_backend.extract_text(document)
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            self.local_backend.fingerprint(),
+            self.fallback_backend.fingerprint(),
+            json.dumps([self.min_confidence, self.min_words]),
+        )
@@ -1,9 +1,36 @@
 import os
-from typing import Optional
+import time
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
 
-from openai import BaseModel, OpenAI
+import httpx
+from openai import (
+    AsyncOpenAI,
+    BaseModel,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
+from openai.types.chat import ChatCompletion
 
-from claim_processing.constants import MODEL_API_KEY, MODEL_API_URL
+from claim_processing.constants import (
+    MODEL_API_CONNECT_TIMEOUT,
+    MODEL_API_KEEPALIVE_EXPIRY,
+    MODEL_API_KEY,
+    MODEL_API_MAX_CONNECTIONS,
+    MODEL_API_MAX_KEEPALIVE_CONNECTIONS,
+    MODEL_API_MODE,
+    MODEL_API_TIMEOUT,
+    MODEL_API_URL,
+)
+from claim_processing.pydantic_models import TokenUsage
+from claim_processing.utils.metrics import record_model_call
+from claim_processing.utils.rate_limit import estimate_tokens, get_model_call_scheduler
+from claim_processing.utils.replay import (
+    AsyncRecordReplayTransport,
+    RecordReplayTransport,
+    get_recording,
+)
 
 
 def get_image_mime_type(image_path: str) -> str:
@@ -20,11 +47,218 @@ def get_image_mime_type(image_path: str) -> str:
     return mime_types.get(ext, "image/png")  # Default to PNG if unknown
 
 
-def get_openai_client():
+def get_http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=MODEL_API_MAX_CONNECTIONS,
+        max_keepalive_connections=MODEL_API_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=MODEL_API_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(MODEL_API_TIMEOUT, connect=MODEL_API_CONNECT_TIMEOUT)
+
+
+# Transports that replace the model API for all clients, see `set_model_api_transports`
+_model_api_transports: Optional[
+    Tuple[httpx.BaseTransport, httpx.AsyncBaseTransport]
+] = None
+
+
+def set_model_api_transports(
+    transport: Optional[httpx.BaseTransport],
+    async_transport: Optional[httpx.AsyncBaseTransport],
+):
+    """Route all model requests through the given transports, e.g. a local fake backend.
+
+    Passing None for both restores the configured `MODEL_API_MODE`.
+    """
+    global _model_api_transports
+    _model_api_transports = (
+        (transport, async_transport) if transport or async_transport else None
+    )
+    get_openai_client.cache_clear()
+    get_async_openai_client.cache_clear()
+
+
+def get_api_key(mode: str = MODEL_API_MODE) -> Optional[str]:
+    # Replayed and faked requests never reach the API, so offline runs do not need a key
+    if mode == "replay" or _model_api_transports is not None:
+        return MODEL_API_KEY or "offline"
+    return MODEL_API_KEY
+
+
+def get_http_client(mode: str = MODEL_API_MODE) -> httpx.Client:
+    if _model_api_transports is not None:
+        return DefaultHttpxClient(transport=_model_api_transports[0])
+    if mode == "live":
+        return DefaultHttpxClient(limits=get_http_limits())
+    # The connection limits belong to the transport once a custom transport is used
+    return DefaultHttpxClient(
+        transport=RecordReplayTransport(
+            mode, get_recording(), httpx.HTTPTransport(limits=get_http_limits())
+        )
+    )
+
+
+def get_async_http_client(mode: str = MODEL_API_MODE) -> httpx.AsyncClient:
+    if _model_api_transports is not None:
+        return DefaultAsyncHttpxClient(transport=_model_api_transports[1])
+    if mode == "live":
+        return DefaultAsyncHttpxClient(limits=get_http_limits())
+    return DefaultAsyncHttpxClient(
+        transport=AsyncRecordReplayTransport(
+            mode, get_recording(), httpx.AsyncHTTPTransport(limits=get_http_limits())
+        )
+    )
+
+
+@lru_cache(maxsize=1)
+def get_openai_client() -> OpenAI:
+    """Shared client, reusing keep-alive connections across all model requests."""
     return OpenAI(
         base_url=MODEL_API_URL,
-        api_key=MODEL_API_KEY,
+        api_key=get_api_key(),
+        timeout=get_http_timeout(),
+        # Retries are handled by the model call scheduler
+        max_retries=0,
+        http_client=get_http_client(),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_async_openai_client() -> AsyncOpenAI:
+    """Shared async client, reusing keep-alive connections across all model requests."""
+    return AsyncOpenAI(
+        base_url=MODEL_API_URL,
+        api_key=get_api_key(),
+        timeout=get_http_timeout(),
+        # Retries are handled by the model call scheduler
+        max_retries=0,
+        http_client=get_async_http_client(),
+    )
+
+
+def create_chat_completion(
+    model: str,
+    messages: List[Dict],
+    response_format: Optional[BaseModel] = None,
+) -> ChatCompletion:
+    client = get_openai_client()
+
+    def request() -> ChatCompletion:
+        if response_format:
+            return client.chat.completions.parse(
+                model=model, messages=messages, response_format=response_format
+            )
+        return client.chat.completions.create(model=model, messages=messages)
+
+    start_time = time.perf_counter()
+    response = get_model_call_scheduler().call(
+        model, request, estimated_tokens=estimate_tokens(messages)
     )
+    record_model_call(
+        model, get_token_usage(response), time.perf_counter() - start_time
+    )
+    return response
+
+
+def create_chat_completion_stream(
+    model: str,
+    messages: List[Dict],
+    on_delta: Callable[[str], None],
+    response_format: Optional[BaseModel] = None,
+) -> ChatCompletion:
+    """Chat completion streamed from the model, `on_delta` gets each piece of content as it arrives."""
+    client = get_openai_client()
+
+    def request() -> ChatCompletion:
+        kwargs = {"response_format": response_format} if response_format else {}
+        with client.chat.completions.stream(
+            model=model,
+            messages=messages,
+            # Token usage is only reported in the last chunk when asked for
+            stream_options={"include_usage": True},
+            **kwargs,
+        ) as stream:
+            for event in stream:
+                if event.type == "content.delta":
+                    on_delta(event.delta)
+            return stream.get_final_completion()
+
+    start_time = time.perf_counter()
+    response = get_model_call_scheduler().call(
+        model, request, estimated_tokens=estimate_tokens(messages)
+    )
+    record_model_call(
+        model, get_token_usage(response), time.perf_counter() - start_time
+    )
+    return response
+
+
+async def acreate_chat_completion(
+    model: str,
+    messages: List[Dict],
+    response_format: Optional[BaseModel] = None,
+) -> ChatCompletion:
+    client = get_async_openai_client()
+
+    async def request() -> ChatCompletion:
+        if response_format:
+            return await client.chat.completions.parse(
+                model=model, messages=messages, response_format=response_format
+            )
+        return await client.chat.completions.create(model=model, messages=messages)
+
+    start_time = time.perf_counter()
+    response = await get_model_call_scheduler().acall(
+        model, request, estimated_tokens=estimate_tokens(messages)
+    )
+    record_model_call(
+        model, get_token_usage(response), time.perf_counter() - start_time
+    )
+    return response
+
+
+def get_token_usage(response: ChatCompletion) -> TokenUsage:
+    usage = response.usage
+    if usage is None:
+        return TokenUsage(
+            model=response.model, input_tokens=0, cached_input_tokens=0, output_tokens=0
+        )
+    prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+    cached_input_tokens = (
+        getattr(prompt_tokens_details, "cached_tokens", None) or 0
+        if prompt_tokens_details is not None
+        else 0
+    )
+    return TokenUsage(
+        model=response.model,
+        input_tokens=usage.prompt_tokens or 0,
+        cached_input_tokens=cached_input_tokens,
+        output_tokens=usage.completion_tokens or 0,
+    )
+
+
+def build_image_messages(
+    system_prompt: str, image_filename: str, image_bytestring: str
+) -> List[Dict]:
+    mime_type = get_image_mime_type(image_filename)
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": system_prompt,
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{mime_type};base64,{image_bytestring}"},
+                },
+            ],
+        }
+    ]
 
 
 def send_image_request_openai(
@@ -34,54 +268,24 @@ def send_image_request_openai(
     vision_model_name: str,
     response_format: Optional[BaseModel] = None,
 ) -> str:
-    client = OpenAI(
-        base_url=MODEL_API_URL,
-        api_key=MODEL_API_KEY,
+    response = create_chat_completion(
+        model=vision_model_name,
+        messages=build_image_messages(system_prompt, image_filename, image_bytestring),
+        response_format=response_format,
     )
+    return response.choices[0].message.content
 
-    mime_type = get_image_mime_type(image_filename)
 
-    if response_format:
-        response = client.chat.completions.parse(
-            model=vision_model_name,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": system_prompt,
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{image_bytestring}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            response_format=response_format,
-        )
-    else:
-        response = client.chat.completions.create(
-            model=vision_model_name,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": system_prompt,
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{image_bytestring}"
-                            },
-                        },
-                    ],
-                }
-            ],
-        )
+async def asend_image_request_openai(
+    system_prompt: str,
+    image_filename: str,
+    image_bytestring: str,
+    vision_model_name: str,
+    response_format: Optional[BaseModel] = None,
+) -> str:
+    response = await acreate_chat_completion(
+        model=vision_model_name,
+        messages=build_image_messages(system_prompt, image_filename, image_bytestring),
+        response_format=response_format,
+    )
     return response.choices[0].message.content
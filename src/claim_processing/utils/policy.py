@@ -0,0 +1,70 @@
+import os
+import re
+from typing import List
+
+from claim_processing.pydantic_models import Document, PolicySection
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+
+
+def split_policy_sections(policy: Document) -> List[PolicySection]:
+    """Split a markdown policy into one section per heading, text before the first heading is its own section."""
+    sections = []
+    heading_stack = []
+    title, path, lines = "", [], []
+
+    def add_section():
+        if any(line.strip() for line in lines):
+            sections.append(
+                PolicySection(title=title, path=path, content="\n".join(lines))
+            )
+
+    for line in policy.content.splitlines():
+        match = HEADING_PATTERN.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        add_section()
+        level = len(match.group(1))
+        heading_stack = [
+            (heading_level, heading_title)
+            for heading_level, heading_title in heading_stack
+            if heading_level < level
+        ] + [(level, match.group(2))]
+        title = match.group(2)
+        path = [heading_title for _, heading_title in heading_stack]
+        lines = [line]
+    add_section()
+    return sections
+
+
+def select_policy_sections(
+    sections: List[PolicySection], keywords: List[str]
+) -> List[PolicySection]:
+    """Sections with one of the keywords in their heading or in one of the enclosing headings.
+
+    Headings shared by all sections, like the title of the policy, are ignored.
+    Text before the first heading has no headings and does not count.
+    """
+    keywords = [keyword.lower() for keyword in keywords]
+    n_shared_headings = len(
+        os.path.commonprefix([section.path for section in sections if section.path])
+    )
+    return [
+        section
+        for section in sections
+        if any(
+            keyword in " ".join(section.path[n_shared_headings:]).lower()
+            for keyword in keywords
+        )
+    ]
+
+
+def build_policy_document(
+    sections: List[PolicySection], name: str = "policy.md"
+) -> Document:
+    return Document(
+        name=name,
+        content="\n".join(section.content for section in sections),
+        type="policy",
+    )
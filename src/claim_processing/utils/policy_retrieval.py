@@ -0,0 +1,142 @@
+import json
+import logging
+import math
+import re
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import List
+
+import numpy as np
+
+from claim_processing.constants import BM25_B, BM25_K1
+from claim_processing.pydantic_models import PolicySection
+from claim_processing.utils.cache import make_cache_key
+
+logger = logging.getLogger()
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class PolicyRetriever(ABC):
+    """Index over the sections of a policy, built once when the retriever is created."""
+
+    def __init__(self, sections: List[PolicySection]):
+        self.sections = sections
+
+    @abstractmethod
+    def score(self, query: str) -> List[float]:
+        """Relevance of every section to the query, in section order."""
+        pass
+
+    def retrieve(self, query: str, top_k: int) -> List[PolicySection]:
+        """The `top_k` most relevant sections in policy order, all sections when none is relevant."""
+        scores = self.score(query)
+        ranked_indices = sorted(
+            (index for index, score in enumerate(scores) if score > 0),
+            key=lambda index: -scores[index],
+        )[:top_k]
+        if not ranked_indices:
+            return self.sections
+        return [self.sections[index] for index in sorted(ranked_indices)]
+
+    def fingerprint(self) -> str:
+        return make_cache_key(
+            type(self).__name__,
+            json.dumps([section.model_dump() for section in self.sections]),
+        )
+
+
+class BM25PolicyRetriever(PolicyRetriever):
+    def __init__(
+        self, sections: List[PolicySection], k1: float = BM25_K1, b: float = BM25_B
+    ):
+        super().__init__(sections)
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [
+            Counter(tokenize(" ".join([*section.path, section.content])))
+            for section in sections
+        ]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1)
+        document_frequencies = Counter(
+            term for counts in self.term_counts for term in counts
+        )
+        n_sections = len(sections)
+        self.idf = {
+            term: math.log(1 + (n_sections - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def score(self, query: str) -> List[float]:
+        query_terms = set(tokenize(query)) & self.idf.keys()
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            length_norm = self.k1 * (
+                1 - self.b + self.b * length / max(self.average_length, 1)
+            )
+            scores.append(
+                sum(
+                    self.idf[term]
+                    * counts[term]
+                    * (self.k1 + 1)
+                    / (counts[term] + length_norm)
+                    for term in query_terms
+                    if term in counts
+                )
+            )
+        return scores
+
+    def fingerprint(self) -> str:
+        return make_cache_key(super().fingerprint(), json.dumps([self.k1, self.b]))
+
+
+class TfidfPolicyRetriever(PolicyRetriever):
+    """Cosine similarity of TF-IDF vectors, kept as one normalized matrix."""
+
+    def __init__(self, sections: List[PolicySection]):
+        super().__init__(sections)
+        section_terms = [
+            Counter(tokenize(" ".join([*section.path, section.content])))
+            for section in sections
+        ]
+        self.vocabulary = {
+            term: index
+            for index, term in enumerate(
+                sorted({term for terms in section_terms for term in terms})
+            )
+        }
+        document_frequencies = np.zeros(len(self.vocabulary))
+        counts = np.zeros((len(sections), len(self.vocabulary)))
+        for row, terms in enumerate(section_terms):
+            for term, count in terms.items():
+                counts[row, self.vocabulary[term]] = count
+                document_frequencies[self.vocabulary[term]] += 1
+        self.idf = np.log((1 + len(sections)) / (1 + document_frequencies)) + 1
+        self.matrix = self.normalize(counts * self.idf)
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def score(self, query: str) -> List[float]:
+        query_vector = np.zeros(len(self.vocabulary))
+        for term, count in Counter(tokenize(query)).items():
+            if term in self.vocabulary:
+                query_vector[self.vocabulary[term]] = count
+        return (self.matrix @ self.normalize(query_vector * self.idf)).tolist()
+
+
+def get_policy_retriever(
+    sections: List[PolicySection], retriever: str
+) -> PolicyRetriever:
+    if retriever == "bm25":
+        return BM25PolicyRetriever(sections)
+    elif retriever == "tfidf":
+        return TfidfPolicyRetriever(sections)
+    raise ValueError(f"Unsupported policy retriever: {retriever}")
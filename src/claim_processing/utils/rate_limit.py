@@ -0,0 +1,312 @@
+import asyncio
+import email.utils
+import json
+import logging
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import openai
+
+from claim_processing.constants import (
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    CIRCUIT_BREAKER_RESET_TIMEOUT,
+    DEFAULT_MODEL_RATE_LIMIT,
+    IMAGE_TOKEN_ESTIMATE,
+    MODEL_API_MAX_RETRIES,
+    MODEL_RATE_LIMITS,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+)
+from claim_processing.utils.metrics import record_model_retry
+
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations, callers wait the returned delay."""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._tokens = capacity
+        self._paused_until = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._tokens = min(
+            self.capacity, self._tokens + elapsed * self.refill_per_second
+        )
+        self._last_refill = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` tokens, possibly going into debt, and return the seconds to wait."""
+        # A single reservation can never exceed the bucket, otherwise it would never fit
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= amount
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.refill_per_second
+            return max(wait, self._paused_until - now)
+
+    def adjust(self, amount: float):
+        """Correct an earlier reservation once the actual usage is known."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+    def pause(self, seconds: float):
+        """Make all following reservations wait at least `seconds`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """Stops sending requests to a model after consecutive failures, until a cool-down passed."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._n_failures = 0
+        self._opened_at: Optional[float] = None
+        # Token of the single trial request let through while half-open
+        self._trial: Optional[object] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self) -> Optional[object]:
+        """Raise while the circuit is open, return a token when the call is the half-open trial."""
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._trial is not None):
+                raise CircuitOpenError(
+                    f"Circuit is open after {self._n_failures} consecutive failures"
+                )
+            if state == "half-open":
+                # Let exactly one trial request through
+                self._trial = object()
+                return self._trial
+            return None
+
+    def release_trial(self, trial: object):
+        """Let a new trial through when a trial ended without a success or failure being recorded."""
+        with self._lock:
+            if self._trial is trial:
+                self._trial = None
+
+    def record_success(self):
+        with self._lock:
+            self._n_failures = 0
+            self._opened_at = None
+            self._trial = None
+
+    def record_failure(self):
+        with self._lock:
+            self._n_failures += 1
+            self._trial = None
+            if self._n_failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Read the delay requested by the provider from the `Retry-After` headers."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_date.timestamp() - time.time())
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Rough token estimate of a request, used to reserve tokens up front."""
+    n_tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            n_tokens += len(content) // 4
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                n_tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                n_tokens += len(json.dumps(part)) // 4
+    return n_tokens
+
+
+class ModelCallScheduler:
+    """Schedules model calls within per-model request and token limits.
+
+    Failed calls are retried with jittered exponential backoff, honouring the
+    `Retry-After` header of the provider, and each model gets a circuit breaker
+    that stops sending requests after repeated server errors.
+    """
+
+    def __init__(
+        self,
+        rate_limits: Dict[str, Dict[str, int]] = MODEL_RATE_LIMITS,
+        max_retries: int = MODEL_API_MAX_RETRIES,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+    ):
+        self.rate_limits = rate_limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._request_buckets: Dict[str, TokenBucket] = {}
+        self._token_buckets: Dict[str, TokenBucket] = {}
+        self._circuit_breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _get_limiters(self, model: str):
+        with self._lock:
+            if model not in self._circuit_breakers:
+                rate_limit = self.rate_limits.get(model, DEFAULT_MODEL_RATE_LIMIT)
+                self._request_buckets[model] = TokenBucket(
+                    rate_limit["requests_per_minute"],
+                    rate_limit["requests_per_minute"] / 60,
+                )
+                self._token_buckets[model] = TokenBucket(
+                    rate_limit["tokens_per_minute"],
+                    rate_limit["tokens_per_minute"] / 60,
+                )
+                self._circuit_breakers[model] = CircuitBreaker(
+                    CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT
+                )
+            return (
+                self._request_buckets[model],
+                self._token_buckets[model],
+                self._circuit_breakers[model],
+            )
+
+    def _reserve(
+        self, model: str, estimated_tokens: int
+    ) -> Tuple[float, Optional[object]]:
+        """Delay before the call and the circuit breaker trial token of the call."""
+        request_bucket, token_bucket, circuit_breaker = self._get_limiters(model)
+        trial = circuit_breaker.before_call()
+        return (
+            max(request_bucket.reserve(1), token_bucket.reserve(estimated_tokens)),
+            trial,
+        )
+
+    def _settle_trial(self, model: str, trial: Optional[object], error: Exception):
+        """Settle a half-open trial that ended in an error that does not count as a failure."""
+        if trial is None:
+            return
+        _, _, circuit_breaker = self._get_limiters(model)
+        if isinstance(error, Exception) and not is_retryable(error):
+            # The model answered, only server and connection errors count against the circuit
+            circuit_breaker.record_success()
+        elif not isinstance(error, Exception) or isinstance(
+            error, openai.RateLimitError
+        ):
+            # Cancelled or rate limited calls say nothing about the model
+            circuit_breaker.release_trial(trial)
+
+    def _record_success(self, model: str, result, estimated_tokens: int):
+        _, token_bucket, circuit_breaker = self._get_limiters(model)
+        circuit_breaker.record_success()
+        usage = getattr(result, "usage", None)
+        if usage is not None and usage.total_tokens is not None:
+            token_bucket.adjust(usage.total_tokens - estimated_tokens)
+
+    def _record_failure(self, model: str, error: Exception, attempt: int) -> float:
+        """Register a retryable failure and return the delay before the next attempt."""
+        request_bucket, _, circuit_breaker = self._get_limiters(model)
+        record_model_retry(model)
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+
+        if isinstance(error, openai.RateLimitError):
+            # The provider limit is shared, hold back every caller of this model
+            request_bucket.pause(delay)
+        else:
+            circuit_breaker.record_failure()
+        logger.warning(
+            f"Call to {model} failed with {error.__class__.__name__} "
+            f"(attempt {attempt + 1}/{self.max_retries + 1})"
+        )
+        return delay
+
+    def call(self, model: str, request: Callable[[], T], estimated_tokens: int) -> T:
+        for attempt in range(self.max_retries + 1):
+            delay, trial = self._reserve(model, estimated_tokens)
+            try:
+                # Inside the try, so an interrupted wait still settles the trial
+                time.sleep(delay)
+                result = request()
+            except BaseException as e:
+                self._settle_trial(model, trial, e)
+                if not is_retryable(e):
+                    raise
+                delay = self._record_failure(model, e, attempt)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+                continue
+            self._record_success(model, result, estimated_tokens)
+            return result
+
+    async def acall(
+        self, model: str, request: Callable[[], Awaitable[T]], estimated_tokens: int
+    ) -> T:
+        for attempt in range(self.max_retries + 1):
+            delay, trial = self._reserve(model, estimated_tokens)
+            try:
+                await asyncio.sleep(delay)
+                result = await request()
+            except BaseException as e:
+                self._settle_trial(model, trial, e)
+                if not is_retryable(e):
+                    raise
+                delay = self._record_failure(model, e, attempt)
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._record_success(model, result, estimated_tokens)
+            return result
+
+
+@lru_cache(maxsize=1)
+def get_model_call_scheduler() -> ModelCallScheduler:
+    return ModelCallScheduler()
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from claim_processing.constants import (
+    MODEL_API_RECORDING_PATH,
+    REPLAY_ERROR_RATE,
+    REPLAY_ERROR_STATUS_CODES,
+    REPLAY_LATENCY_SCALE,
+    REPLAY_LATENCY_SECONDS,
+    REPLAY_SEED,
+)
+from claim_processing.utils.cache import make_cache_key
+
+logger = logging.getLogger()
+
+MODEL_API_MODES = ("live", "record", "replay")
+
+# Headers that describe the transfer rather than the content, httpx sets them again
+EXCLUDED_RESPONSE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+def get_request_key(request: httpx.Request) -> str:
+    """Key a request by method, path and body, ignoring headers and JSON key order."""
+    body = request.content
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        pass
+    return make_cache_key(request.method, request.url.raw_path, body)
+
+
+def is_recordable(response: httpx.Response) -> bool:
+    # Rate limits and server errors are transient, replaying them would make runs flaky
+    return response.status_code != 429 and response.status_code < 500
+
+
+class Recording:
+    """Request/response pairs, stored as one JSON line per exchange.
+
+    Exchanges are appended as they are recorded, a later exchange for the same
+    request replaces the earlier one when the recording is loaded.
+    """
+
+    def __init__(self, path: str = MODEL_API_RECORDING_PATH):
+        self.path = path
+        self._exchanges: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r") as recording_file:
+                for line in recording_file:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        self._exchanges[exchange["key"]] = exchange
+            logger.info(f"Loaded {len(self._exchanges)} recorded exchanges from {path}")
+
+    def __len__(self) -> int:
+        return len(self._exchanges)
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            return self._exchanges.get(key)
+
+    def add(self, request: httpx.Request, response: httpx.Response, seconds: float):
+        exchange = {
+            "key": get_request_key(request),
+            "method": request.method,
+            "path": request.url.path,
+            "status_code": response.status_code,
+            "headers": [
+                [name, value]
+                for name, value in response.headers.items()
+                if name.lower() not in EXCLUDED_RESPONSE_HEADERS
+            ],
+            "body": response.content.decode("utf-8"),
+            "seconds": seconds,
+        }
+        with self._lock:
+            self._exchanges[exchange["key"]] = exchange
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as recording_file:
+                recording_file.write(json.dumps(exchange) + "\n")
+
+
+@lru_cache(maxsize=None)
+def get_recording(path: str = MODEL_API_RECORDING_PATH) -> Recording:
+    return Recording(path)
+
+
+class _RecordReplayMixin:
+    def __init__(
+        self,
+        mode: str,
+        recording: Recording,
+        latency_scale: float = REPLAY_LATENCY_SCALE,
+        latency_seconds: Optional[float] = REPLAY_LATENCY_SECONDS,
+        error_rate: float = REPLAY_ERROR_RATE,
+        error_status_codes: List[int] = REPLAY_ERROR_STATUS_CODES,
+        seed: int = REPLAY_SEED,
+    ):
+        if mode not in MODEL_API_MODES:
+            raise ValueError(f"Unsupported model API mode: {mode}")
+        self.mode = mode
+        self.recording = recording
+        self.latency_scale = latency_scale
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.error_status_codes = error_status_codes
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def _replay(self, request: httpx.Request) -> Tuple[httpx.Response, float]:
+        """Build the replayed response and the latency to simulate before returning it."""
+        with self._random_lock:
+            inject_error = self._random.random() < self.error_rate
+            error_status_code = self._random.choice(self.error_status_codes)
+
+        exchange = self.recording.get(get_request_key(request))
+        if exchange is None:
+            # A client error, so the scheduler does not retry a request that can never succeed
+            return self._json_response(
+                request,
+                404,
+                f"No recorded response for {request.method} {request.url.path}, record it with MODEL_API_MODE=record",
+            ), 0.0
+
+        if self.latency_seconds is not None:
+            latency = self.latency_seconds
+        else:
+            latency = exchange["seconds"] * self.latency_scale
+
+        if inject_error:
+            return self._json_response(
+                request, error_status_code, "Injected replay error"
+            ), latency
+
+        response = httpx.Response(
+            status_code=exchange["status_code"],
+            headers=exchange["headers"],
+            content=exchange["body"].encode("utf-8"),
+            request=request,
+        )
+        return response, latency
+
+    @staticmethod
+    def _json_response(
+        request: httpx.Request, status_code: int, message: str
+    ) -> httpx.Response:
+        return httpx.Response(
+            status_code=status_code,
+            json={"error": {"message": message, "code": status_code}},
+            request=request,
+        )
+
+
+class RecordReplayTransport(_RecordReplayMixin, httpx.BaseTransport):
+    """Transport under the OpenAI client that records or replays model API exchanges."""
+
+    def __init__(
+        self, mode: str, recording: Recording, transport: httpx.BaseTransport, **kwargs
+    ):
+        super().__init__(mode, recording, **kwargs)
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if self.mode == "replay":
+            response, latency = self._replay(request)
+            time.sleep(latency)
+            return response
+
+        start_time = time.perf_counter()
+        response = self.transport.handle_request(request)
+        if self.mode == "record" and is_recordable(response):
+            response.read()
+            self.recording.add(request, response, time.perf_counter() - start_time)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRecordReplayTransport(_RecordReplayMixin, httpx.AsyncBaseTransport):
+    """Async transport under the OpenAI client that records or replays model API exchanges."""
+
+    def __init__(
+        self,
+        mode: str,
+        recording: Recording,
+        transport: httpx.AsyncBaseTransport,
+        **kwargs,
+    ):
+        super().__init__(mode, recording, **kwargs)
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.mode == "replay":
+            response, latency = self._replay(request)
+            await asyncio.sleep(latency)
+            return response
+
+        start_time = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        if self.mode == "record" and is_recordable(response):
+            await response.aread()
+            self.recording.add(request, response, time.perf_counter() - start_time)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -1,6 +1,6 @@
 import requests
 import base64
-import time
+import json
 
 # Submit a claim
 with open("assignment/claim 1/booking confirmation 2.png", "rb") as f:
@@ -20,16 +20,17 @@ claim_data = {
 response = requests.post("http://localhost:8000/claims", json=claim_data)
 print(response.json())
 
-print("Successfully uploaded claim, waiting max 100 seconds until is processed")
+print("Successfully uploaded claim, following its processing")
 
-# Retrieve decision (after processing completes)
-decision = requests.get(f"http://localhost:8000/claims/26")
-max_retries = 10
-n_retries = 0
-while decision.status_code == 404 and n_retries<max_retries:
-    print(f"Decision is not available yet, try {n_retries+1}/{max_retries}")
-    time.sleep(10)
-    n_retries += 1
-    decision = requests.get(f"http://localhost:8000/claims/26")
-
-print(decision.json())
\ No newline at end of file
+# Stream the processing events until the decision is made
+with requests.get("http://localhost:8000/claims/26/events", stream=True) as events:
+    for line in events.iter_lines(decode_unicode=True):
+        if not line.startswith("data: "):
+            continue
+        event = json.loads(line[len("data: "):])
+        if event["event"] == "decision_token":
+            print(event["data"]["text"], end="", flush=True)
+            continue
+        print(f"\n{event['event']}: {event['data']}")
+        if event["event"] in ("done", "failed"):
+            break